@@ -74,6 +74,72 @@ class BaseGRULayer( object ):
         idx = (self._dropout_keep != 1) * (self._dropout_input + self._dropout_output)
         return dropout_masks[:idx], dropout_masks[idx:]
 
+    def project_input(self, ipt, dropout_masks=Ellipsis):
+        """
+        Compute the input's contribution to the reset, update, and activation layers. If the same
+        input is used for many steps, or a whole input sequence is known in advance, this can be
+        done once, outside of the loop, and the result passed to step_projected.
+
+        Params:
+            ipt: The input. Should be a tensor of shape (..., self.input_width)
+            dropout_masks: Masks from get_dropout_masks
+
+        Returns: The projected input, of shape (..., 3*self.output_width)
+        """
+        if dropout_masks is Ellipsis:
+            dropout_masks = None
+            append_masks = False
+        else:
+            append_masks = True
+
+        if self._dropout_keep != 1 and self._dropout_input and dropout_masks not in ([], None):
+                ipt_masks = dropout_masks[0]
+                ipt = apply_dropout(ipt, ipt_masks)
+                dropout_masks = dropout_masks[1:]
+
+        w = self._input_width
+        input_W = T.concatenate([self._reset_W[:w], self._update_W[:w], self._activation_W[:w]], 1)
+        input_b = T.concatenate([self._reset_b, self._update_b, self._activation_b])
+        projected = T.dot(ipt, input_W) + input_b
+
+        if append_masks:
+            return projected, dropout_masks
+        else:
+            return projected
+
+    def project_input_indices(self, indices, dropout_masks=Ellipsis):
+        """
+        Like project_input, but for one-hot inputs given by the index of the hot entry. The
+        projection is then just a lookup of rows of the weights, so its gradient only
+        touches the rows that were used.
+
+        Params:
+            indices: Int tensor of any shape, with values less than self.input_width
+            dropout_masks: Masks from get_dropout_masks
+
+        Returns: The projected input, of shape (..., 3*self.output_width)
+        """
+        if dropout_masks is Ellipsis:
+            dropout_masks = None
+            append_masks = False
+        else:
+            append_masks = True
+
+        flat_indices = indices.flatten()
+        rows = T.concatenate([self._reset_W[flat_indices], self._update_W[flat_indices], self._activation_W[flat_indices]], 1)
+        if self._dropout_keep != 1 and self._dropout_input and dropout_masks not in ([], None):
+                ipt_masks = dropout_masks[0]
+                rows = rows * T.shape_padright(ipt_masks.flatten()[flat_indices])
+                dropout_masks = dropout_masks[1:]
+        input_b = T.concatenate([self._reset_b, self._update_b, self._activation_b])
+        flat_projected = rows + input_b
+        projected = flat_projected.reshape(T.concatenate([indices.shape, [3*self._output_width]]), ndim=indices.ndim+1)
+
+        if append_masks:
+            return projected, dropout_masks
+        else:
+            return projected
+
     def step(self, ipt, state, dropout_masks=Ellipsis):
         """
         Perform a single step of the network
@@ -83,6 +149,26 @@ class BaseGRULayer( object ):
             state: The previous state. Should be a float tensor of shape (n_batch, self.output_width)
             dropout_masks: Masks from get_dropout_masks
 
+        Returns: The next output state
+        """
+        if dropout_masks is Ellipsis:
+            projected = self.project_input(ipt)
+            return self.step_projected(projected, state)
+        else:
+            projected, dropout_masks = self.project_input(ipt, dropout_masks)
+            return self.step_projected(projected, state, dropout_masks)
+
+    def step_projected(self, projected_ipt, state, dropout_masks=Ellipsis):
+        """
+        Perform a single step of the network, using an input already transformed by project_input.
+        Only the state needs to be multiplied by the weights here, and the reset and update
+        layers share a single product.
+
+        Params:
+            projected_ipt: The current projected input. Should be a tensor of shape (n_batch, 3*self.output_width)
+            state: The previous state. Should be a float tensor of shape (n_batch, self.output_width)
+            dropout_masks: Masks from get_dropout_masks, after any used by project_input
+
         Returns: The next output state
         """
         if dropout_masks is Ellipsis:
@@ -91,18 +177,13 @@ class BaseGRULayer( object ):
         else:
             append_masks = True
 
-        if self._dropout_keep != 1 and self._dropout_input and dropout_masks is not None:
-                ipt_masks = dropout_masks[0]
-                ipt = apply_dropout(ipt, ipt_masks)
-                dropout_masks = dropout_masks[1:]
-
-        cat_ipt_state = T.concatenate([ipt, state], 1)
-        reset = do_layer( T.nnet.sigmoid, cat_ipt_state,
-                            self._reset_W, self._reset_b )
-        update = do_layer( T.nnet.sigmoid, cat_ipt_state,
-                            self._update_W, self._update_b )
-        candidate_act = do_layer( T.tanh, T.concatenate([ipt, (reset * state)], 1),
-                            self._activation_W, self._activation_b )
+        w = self._input_width
+        n = self._output_width
+        gates_state_W = T.concatenate([self._reset_W[w:], self._update_W[w:]], 1)
+        gates_act = projected_ipt[:,:2*n] + T.dot(state, gates_state_W)
+        reset = T.nnet.sigmoid(gates_act[:,:n])
+        update = T.nnet.sigmoid(gates_act[:,n:])
+        candidate_act = T.tanh(projected_ipt[:,2*n:] + T.dot(reset * state, self._activation_W[w:]))
 
         newstate = update * state + (1-update) * candidate_act
 
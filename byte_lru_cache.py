@@ -0,0 +1,94 @@
+import threading
+import collections
+import numpy as np
+
+def estimate_nbytes(value):
+    """
+    Estimate the memory used by a value made of numpy arrays, possibly nested
+    inside tuples, lists and dicts
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sum(estimate_nbytes(v) for v in value.values())
+    elif isinstance(value, (tuple, list)):
+        return sum(estimate_nbytes(v) for v in value)
+    else:
+        return 8
+
+class ByteLRUCache( object ):
+    """
+    A thread-safe least-recently-used cache with a limit on the total size of its
+    values in bytes. Keeps hit and miss counts.
+    """
+    def __init__(self, max_bytes):
+        """
+        Params:
+            max_bytes: Memory budget. Least recently used entries are evicted to stay under this
+        """
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.cur_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Look up a key, counting a hit or miss and marking it as recently used
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            else:
+                self.misses += 1
+                return default
+
+    def put(self, key, value, nbytes=None):
+        """
+        Add a value to the cache, evicting old entries if necessary. Values larger
+        than the whole budget are not stored.
+        """
+        if nbytes is None:
+            nbytes = estimate_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.cur_bytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self.cur_bytes += nbytes
+            while self.cur_bytes > self.max_bytes:
+                _, (_, old_nbytes) = self._entries.popitem(last=False)
+                self.cur_bytes -= old_nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.cur_bytes = 0
+
+    def stats(self):
+        """
+        Get a dict of cache statistics
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return collections.OrderedDict([
+                ("cache_hits", self.hits),
+                ("cache_misses", self.misses),
+                ("cache_hit_rate", self.hits/total if total > 0 else 0.0),
+                ("cache_entries", len(self._entries)),
+                ("cache_bytes", self.cur_bytes),
+                ("cache_evictions", self.evictions),
+            ])
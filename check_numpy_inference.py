@@ -0,0 +1,104 @@
+import sys
+import argparse
+import collections
+import numpy as np
+
+import model
+import numpy_inference
+
+ParityConfig = collections.namedtuple("ParityConfig", ["name", "model_kwargs"])
+
+BASE_KWARGS = dict(num_input_words=8, num_output_words=5, num_node_ids=3, node_state_size=4, num_edge_types=2,
+                   input_repr_size=6, output_repr_size=6, propose_repr_size=5, propagate_repr_size=5,
+                   new_nodes_per_iter=2, final_propagate=2, word_node_mapping={1:0, 2:1},
+                   intermediate_propagate=1)
+
+CONFIGS = [
+    ParityConfig("category", dict(output_format=model.ModelOutputFormat.category)),
+    ParityConfig("subset", dict(output_format=model.ModelOutputFormat.subset)),
+    ParityConfig("sequence", dict(output_format=model.ModelOutputFormat.sequence)),
+    ParityConfig("category, no mask padding", dict(output_format=model.ModelOutputFormat.category, mask_padding=False)),
+    ParityConfig("subset, multi query", dict(output_format=model.ModelOutputFormat.subset, multi_query=True)),
+    ParityConfig("sequence, multi query", dict(output_format=model.ModelOutputFormat.sequence, multi_query=True)),
+    ParityConfig("category, multi query, no mask padding", dict(output_format=model.ModelOutputFormat.category, multi_query=True, mask_padding=False)),
+    ParityConfig("category, sequence representation, old aggregate", dict(output_format=model.ModelOutputFormat.category, sequence_representation=True, use_old_aggregate=True)),
+    ParityConfig("subset, static nodes, no direct reference", dict(output_format=model.ModelOutputFormat.subset, dynamic_nodes=False, word_node_mapping={})),
+]
+
+def make_batch(rng, model_kwargs, n_batch=3, n_sentences=4, sentence_length=4, max_seq_len=3):
+    """
+    Build a random batch of function arguments for model_kwargs, with stories (and
+    sentences and queries) of different lengths, so that padding is exercised
+    """
+    num_words = model_kwargs["num_input_words"]
+    def random_words(n_rows):
+        words = rng.randint(1, num_words, size=(n_rows, sentence_length)).astype(np.int32)
+        for row, length in zip(words, rng.randint(1, sentence_length+1, size=n_rows)):
+            row[length:] = 0
+        return words
+    story_lengths = [n_sentences, 2, 3][:n_batch]
+    sents = random_words(n_batch*n_sentences).reshape([n_batch, n_sentences, sentence_length])
+    for story, length in zip(sents, story_lengths):
+        story[length:] = 0
+    if model_kwargs.get("multi_query", False):
+        # Some stories have fewer queries, padded with position 0
+        positions = np.array([[1, n_sentences, 2], [2, 0, 0], [3, 1, 0]][:n_batch], np.int32)
+        queries = random_words(positions.size).reshape(positions.shape + (sentence_length,))
+        queries[positions == 0] = 0
+        args = [sents, queries, positions]
+    else:
+        args = [sents, random_words(n_batch)]
+    if model_kwargs["output_format"] == model.ModelOutputFormat.sequence:
+        args.append(max_seq_len)
+    return args
+
+def compare(name, expected, actual, atol):
+    """
+    Compare the outputs of a Theano function and the NumPy engine. Returns a list of problems.
+    """
+    if len(expected) != len(actual):
+        return ["{}: got {} outputs, expected {}".format(name, len(actual), len(expected))]
+    problems = []
+    for part, e, a in zip(["final_output", "node_strengths", "node_ids", "node_states", "edge_strengths"], expected, actual):
+        e, a = np.asarray(e), np.asarray(a)
+        if e.shape != a.shape:
+            problems.append("{} {}: shape {}, expected {}".format(name, part, a.shape, e.shape))
+        elif not np.allclose(e, a, atol=atol):
+            problems.append("{} {}: max difference {}".format(name, part, np.max(np.abs(e - a))))
+    return problems
+
+def main(atol, seed):
+    sys.setrecursionlimit(100000)
+    rng = np.random.RandomState(seed)
+    failures = []
+    for config in CONFIGS:
+        model_kwargs = dict(BASE_KWARGS, **config.model_kwargs)
+        print("### {} ###".format(config.name))
+        m = model.Model(**model_kwargs)
+        # The initial parameters are small enough that most differences would barely change the
+        # outputs, so use larger random values instead
+        for p in m.params:
+            value = p.get_value()
+            p.set_value(rng.uniform(-1, 1, size=value.shape).astype(value.dtype))
+        nm = numpy_inference.NumpyModel(params=[p.get_value() for p in m.params], **model_kwargs)
+        args = make_batch(rng, model_kwargs)
+        problems = compare("fuzzy_test", m.fuzzy_test(*args), nm.fuzzy_test(*args), atol) \
+                 + compare("snap_test", m.snap_test(*args), nm.snap_test(*args), atol)
+        for problem in problems:
+            print("MISMATCH " + problem)
+        if len(problems) == 0:
+            print("OK")
+        else:
+            failures.append(config.name)
+    if len(failures) > 0:
+        print("NumPy inference does not match the model for: {}".format(", ".join(failures)))
+        sys.exit(1)
+    print("NumPy inference matches the model for all {} configurations".format(len(CONFIGS)))
+
+parser = argparse.ArgumentParser(description='Check that numpy_inference.NumpyModel gives the same outputs and graph states as model.Model, using random parameters.')
+parser.add_argument('--atol', type=float, default=1e-4, help="Largest allowed absolute difference between outputs")
+parser.add_argument('--seed', type=int, default=0, help="Random seed for the batches")
+
+if __name__ == '__main__':
+    args = vars(parser.parse_args())
+    main(**args)
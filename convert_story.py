@@ -2,7 +2,8 @@ import argparse
 import os
 import numpy as np
 import ggtnn_graph_parse
-from ggtnn_graph_parse import PreppedStory
+from ggtnn_graph_parse import PreppedStory, MetadataList
+import packed_dataset
 import gzip
 import pickle
 
@@ -32,26 +33,44 @@ def convert(story):
 
     return tuple(x[np.newaxis,...] for x in (all_node_strengths, all_node_ids, all_node_states, all_edges))
 
-def main(storyfile, outputdir):
-    
-    with gzip.open(storyfile,'rb') as f:
-        story, sents, query, ans = pickle.load(f)
+def load_packed_story(bucket_dir, index):
+    """
+    Load a story from a packed bucket, along with its text
+    """
+    with open(os.path.join(bucket_dir, os.pardir, 'metadata.p'),'rb') as f:
+        metadata = pickle.load(f)
+    bucket = packed_dataset.PackedBucket(bucket_dir)
+    story = packed_dataset.load_converted_story(bucket[index])
+    sentence_arr, _, query_arr, answer_arr = story
+    def decode(word_idxs):
+        return [metadata.wordlist[w] for w in word_idxs if metadata.wordlist[w] != ggtnn_graph_parse.PAD_WORD]
+    sents = [decode(s) for s in sentence_arr]
+    sents = [s for s in sents if len(s) > 0]
+    query = decode(query_arr)
+    ans = [metadata.anslist[w] for w in answer_arr]
+    return story, sents, query, ans
 
+def main(storyfile, outputdir, index=None):
+    if index is not None:
+        story, sents, query, ans = load_packed_story(storyfile, index)
+    else:
+        with gzip.open(storyfile,'rb') as f:
+            story, sents, query, ans = pickle.load(f)
+
+    if not os.path.exists(outputdir):
+        os.makedirs(outputdir)
     with open(os.path.join(outputdir,'story.txt'),'w') as f:
         f.write("{}\n{}\n{}".format("\n".join(" ".join(s) for s in sents), " ".join(query), " ".join(ans)))
 
     results = convert(story)
-    if not os.path.exists(outputdir):
-        os.makedirs(outputdir)
     for i,res in enumerate(results):
         np.save(os.path.join(outputdir,'result_{}.npy'.format(i)), res)
 
 parser = argparse.ArgumentParser(description='Convert a story to graph')
-parser.add_argument("storyfile", help="Story filename")
+parser.add_argument("storyfile", help="Story filename, or bucket directory of a packed task")
 parser.add_argument("outputdir", help="Output directory")
+parser.add_argument("--index", type=int, default=None, help="Index of the story in the bucket, if storyfile is a packed bucket directory")
 
 if __name__ == '__main__':
     args = vars(parser.parse_args())
     main(**args)
-
-
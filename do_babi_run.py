@@ -3,7 +3,7 @@ import argparse
 import os
 import shlex
 
-def main(tasks_dir, output_dir, excluding=[], including_only=None, run_sequential_set=False, just_setup=False, stop_on_error=False, extra_args=[], dataset_sizes=None, direct_ref_enabled=None):
+def main(tasks_dir, output_dir, excluding=[], including_only=None, run_sequential_set=False, just_setup=False, stop_on_error=False, extra_args=[], dataset_sizes=None, direct_ref_enabled=None, parse_workers=1):
     base_params = " ".join([
         "20",
         "--mutable-nodes",
@@ -74,7 +74,7 @@ def main(tasks_dir, output_dir, excluding=[], including_only=None, run_sequentia
     if including_only is not None:
         specs = [x for x in specs if x.task_name[5:] in including_only]
     # from pprint import pprint; pprint(specs); return
-    run_harness.run(tasks_dir, output_dir, base_params, specs, stop_on_error=stop_on_error, skip_complete=just_setup)
+    run_harness.run(tasks_dir, output_dir, base_params, specs, stop_on_error=stop_on_error, skip_complete=just_setup, parse_workers=parse_workers)
 
 parser = argparse.ArgumentParser(description="Train all bAbI tasks.")
 parser.add_argument('tasks_dir', help="Directory with tasks")
@@ -87,6 +87,7 @@ parser.add_argument('--stop-on-error', action="store_true", help="Stop if execut
 parser.add_argument('--dataset-sizes', nargs='+', default=None, type=int, help="Run the model on these sizes of input")
 parser.add_argument('--direct-reference', action="store_true", dest="direct_ref_enabled", default=None, help="Only train with direct reference")
 parser.add_argument('--no-direct-reference', action="store_false", dest="direct_ref_enabled", default=None, help="Only train without direct reference")
+parser.add_argument('--parse-workers', type=int, default=1, help="Number of processes to use when preprocessing task files")
 
 if __name__ == '__main__':
     namespace, extra = parser.parse_known_args()
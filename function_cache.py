@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import enum
+import fcntl
+import pickle
+import argparse
+import contextlib
+import collections
+import numpy as np
+import theano
+
+import model
+import util
+
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = "manifest.lock"
+
+def compile_settings():
+    """
+    Get the Theano settings that affect the compiled functions, and the version of their
+    inputs. Cached functions are only reused if these match.
+    """
+    return collections.OrderedDict([
+        ("function_inputs_version", model.FUNCTION_INPUTS_VERSION),
+        ("theano_version", theano.__version__),
+        ("floatX", theano.config.floatX),
+        ("device", theano.config.device),
+        ("optimizer", theano.config.optimizer),
+        ("optimizer_including", theano.config.optimizer_including),
+        ("optimizer_excluding", theano.config.optimizer_excluding),
+    ])
+
+def _jsonable(thing):
+    """
+    Convert model kwargs into plain JSON values, with enums replaced by their names
+    (as in util.object_hash, so the hash of the result is unchanged)
+    """
+    class EnumEncoder(json.JSONEncoder):
+        def default(self, obj):
+            if isinstance(obj, enum.Enum):
+                return obj.name
+            return super().default(obj)
+    return json.loads(json.dumps(thing, sort_keys=True, cls=EnumEncoder))
+
+def _weight_variables(m):
+    """
+    Get the shared variables holding weight-sized values used by a model: its
+    parameters, and any optimizer state (such as Adam moments) in its compiled
+    functions. Scalars (like the learning rate) and random number generator states
+    (which are integers) are not included.
+    """
+    found = collections.OrderedDict((p, None) for p in m.params)
+    for fn in m.compiled_functions.values():
+        for var in fn.get_shared():
+            value = var.get_value(borrow=True)
+            if isinstance(value, np.ndarray) and value.ndim > 0 and np.issubdtype(value.dtype, np.floating):
+                found[var] = None
+    return list(found.keys())
+
+class FunctionCache( object ):
+    """
+    A directory of models with compiled functions, keyed by the model's kwargs and the
+    Theano compile settings. Parameter values are not stored, so entries are small and
+    a loaded model starts from a fresh initialization, exactly as if it had just been
+    built. A JSON manifest describes each entry, so the cache can be inspected and
+    pruned without unpickling anything.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, model_kwargs):
+        return util.object_hash({"model_kwargs": model_kwargs, "settings": compile_settings()})
+
+    def _path(self, filename):
+        return os.path.join(self.cache_dir, filename)
+
+    @contextlib.contextmanager
+    def _locked_manifest(self):
+        """
+        Hold an exclusive lock on the manifest, for runs sharing the cache directory,
+        and yield it as a dict. Changes to the dict are written back on exit.
+        """
+        with open(self._path(LOCK_FILE), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = self.manifest()
+            yield manifest
+            tmp_path = self._path(MANIFEST_FILE + ".tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self._path(MANIFEST_FILE))
+
+    def manifest(self):
+        """
+        Get the manifest, a dict from key to entry information
+        """
+        if not os.path.isfile(self._path(MANIFEST_FILE)):
+            return {}
+        with open(self._path(MANIFEST_FILE), 'r') as f:
+            return json.load(f)
+
+    def load(self, model_kwargs):
+        """
+        Load the cached model for model_kwargs, with freshly initialized parameters,
+        or return None if there is no matching entry
+        """
+        key = self.key(model_kwargs)
+        entry = self.manifest().get(key)
+        if entry is None or not os.path.isfile(self._path(entry["file"])):
+            return None
+        sys.setrecursionlimit(100000)
+        with open(self._path(entry["file"]), 'rb') as f:
+            m, blanked = pickle.load(f)
+        if not all(model.shares_shared_storage(fn) for fn in m.compiled_functions.values()):
+            # Saved with functions compiled by an older version of --compile-workers, which did not
+            # update the model's own parameters
+            print("Cached functions {} are not connected to the model's parameters. Evicting them.".format(key))
+            self.evict([key])
+            return None
+        fresh = model.Model(**dict(model_kwargs, setup=False))
+        fresh_values = dict(zip((id(p) for p in m.params), (p.get_value() for p in fresh.params)))
+        for var, shape, dtype in blanked:
+            var.set_value(fresh_values[id(var)] if id(var) in fresh_values else np.zeros(shape, dtype))
+        with self._locked_manifest() as manifest:
+            if key in manifest:
+                manifest[key]["last_used"] = time.time()
+        return m
+
+    def save(self, m, model_kwargs):
+        """
+        Store a set-up model in the cache. Its weights are blanked out while it is
+        pickled, and restored afterward.
+        """
+        key = self.key(model_kwargs)
+        filename = "functions_{}.p".format(key)
+        weight_vars = _weight_variables(m)
+        saved_values = [var.get_value(borrow=True) for var in weight_vars]
+        blanked = [(var, value.shape, value.dtype.str) for var, value in zip(weight_vars, saved_values)]
+        sys.setrecursionlimit(100000)
+        tmp_path = self._path(filename + ".tmp")
+        try:
+            for var, value in zip(weight_vars, saved_values):
+                var.set_value(np.zeros((0,)*value.ndim, value.dtype), borrow=True)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((m, blanked), f, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            for var, value in zip(weight_vars, saved_values):
+                var.set_value(value, borrow=True)
+        os.replace(tmp_path, self._path(filename))
+        now = time.time()
+        with self._locked_manifest() as manifest:
+            manifest[key] = {
+                "file": filename,
+                "model_kwargs": _jsonable(model_kwargs),
+                "settings": compile_settings(),
+                "size_bytes": os.path.getsize(self._path(filename)),
+                "created": now,
+                "last_used": now,
+            }
+        return key
+
+    def evict(self, keys):
+        """
+        Remove entries from the cache
+        """
+        with self._locked_manifest() as manifest:
+            for key in keys:
+                entry = manifest.pop(key, None)
+                if entry is not None and os.path.isfile(self._path(entry["file"])):
+                    os.remove(self._path(entry["file"]))
+
+    def prune(self, max_bytes=None, max_age=None):
+        """
+        Evict entries not used in the last max_age seconds, then evict least recently
+        used entries until the cache takes up at most max_bytes. Returns the evicted keys.
+        """
+        manifest = self.manifest()
+        by_use = sorted(manifest.keys(), key=lambda k: manifest[k]["last_used"])
+        evicted = []
+        if max_age is not None:
+            evicted.extend(k for k in by_use if time.time() - manifest[k]["last_used"] > max_age)
+        if max_bytes is not None:
+            total = sum(manifest[k]["size_bytes"] for k in by_use if k not in evicted)
+            for k in by_use:
+                if total <= max_bytes:
+                    break
+                if k not in evicted:
+                    evicted.append(k)
+                    total -= manifest[k]["size_bytes"]
+        self.evict(evicted)
+        return evicted
+
+    def rehash(self):
+        """
+        Recompute the key of every entry, filling in defaults for model kwargs that were
+        added since it was stored (as update_cache_compatibility.py does for --autopickle).
+        Only uses the manifest, so nothing needs to be unpickled.
+        """
+        with self._locked_manifest() as manifest:
+            for old_key, entry in list(manifest.items()):
+                kwargs = util.get_compatible_kwargs(model.Model, entry["model_kwargs"])
+                new_key = util.object_hash({"model_kwargs": kwargs, "settings": entry["settings"]})
+                if new_key != old_key:
+                    del manifest[old_key]
+                    entry["model_kwargs"] = _jsonable(kwargs)
+                    manifest[new_key] = entry
+                    print("{} -> {}".format(old_key, new_key))
+
+def main(cache_dir, evict, max_mb, max_age_days, rehash):
+    cache = FunctionCache(cache_dir)
+    if rehash:
+        cache.rehash()
+    if evict:
+        cache.evict(evict)
+    if max_mb is not None or max_age_days is not None:
+        evicted = cache.prune(None if max_mb is None else max_mb*1024*1024,
+                              None if max_age_days is None else max_age_days*24*60*60)
+        print("Evicted {} entries".format(len(evicted)))
+    manifest = cache.manifest()
+    for key, entry in sorted(manifest.items(), key=lambda kv: kv[1]["last_used"]):
+        print("{}  {:8.1f} MB  last used {}  (theano {}, {})".format(
+            key, entry["size_bytes"]/(1024*1024), time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_used"])),
+            entry["settings"]["theano_version"], entry["settings"]["floatX"]))
+    print("{} entries, {:.1f} MB total".format(len(manifest), sum(e["size_bytes"] for e in manifest.values())/(1024*1024)))
+
+parser = argparse.ArgumentParser(description='Inspect or prune a compiled function cache directory.')
+parser.add_argument('cache_dir', help="Directory of the function cache")
+parser.add_argument('--evict', nargs="+", metavar="KEY", default=[], help="Remove these entries")
+parser.add_argument('--max-mb', type=float, default=None, help="Remove least recently used entries until the cache is at most this size")
+parser.add_argument('--max-age-days', type=float, default=None, help="Remove entries that have not been used for this many days")
+parser.add_argument('--rehash', action="store_true", help="Update the keys of the entries after new model options are added")
+
+if __name__ == '__main__':
+    args = vars(parser.parse_args())
+    main(**args)
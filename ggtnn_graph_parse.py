@@ -7,9 +7,12 @@ import scipy
 import json
 import itertools
 import pickle
-import gc
+import bisect
+import shutil
+import multiprocessing
 import gzip
 import argparse
+import packed_dataset
 
 def tokenize(sent):
     '''Return the tokens of a sentence including punctuation.
@@ -22,11 +25,12 @@ def list_to_map(l):
     '''Convert a list of values to a map from values to indices'''
     return {val:i for i,val in enumerate(l)}
 
-def parse_stories(lines):
+def iter_parse_stories(lines):
     '''
     Parse stories provided in the bAbi tasks format, with knowledge graph.
+    Yields each (substory, query, answer) as soon as its question is read, so
+    lines can be any iterable (such as an open file).
     '''
-    data = []
     story = []
     for line in lines:
         if line[-1] == "\n":
@@ -35,20 +39,123 @@ def parse_stories(lines):
         nid = int(nid)
         if nid == 1:
             story = []
-            questions = []
         if '\t' in line:
             q, apre = line.split('\t')[:2]
             a = apre.split(',')
             q = tokenize(q)
             substory = [x for x in story if x]
-            data.append((substory, q, a))
+            yield (substory, q, a)
             story.append('')
         else:
             line, graph = line.split('=', 1)
             sent = tokenize(line)
             graph_parsed = json.loads(graph)
             story.append((sent, graph_parsed))
-    return data
+
+def iter_parse_multiquery_stories(lines):
+    '''
+    Parse stories provided in the bAbi tasks format, with knowledge graph, keeping
+    every question of a story together instead of repeating the story for each one.
+    Yields each (sents_graphs, queries), where queries is a list of (position, query, answer)
+    and position is the number of sentences before the question. Sentences after the
+    last question of a story are dropped. Every question must come after at least one
+    sentence, since position 0 marks padding queries in a batch.
+    '''
+    story = []
+    queries = []
+    for line in lines:
+        if line[-1] == "\n":
+            line = line[:-1]
+        nid, line = line.split(' ', 1)
+        nid = int(nid)
+        if nid == 1:
+            if len(queries) > 0:
+                yield (story[:queries[-1][0]], queries)
+            story = []
+            queries = []
+        if '\t' in line:
+            q, apre = line.split('\t')[:2]
+            a = apre.split(',')
+            q = tokenize(q)
+            assert len(story) > 0, "Question {} is asked before any sentence of its story".format(nid)
+            queries.append((len(story), q, a))
+        else:
+            line, graph = line.split('=', 1)
+            sent = tokenize(line)
+            graph_parsed = json.loads(graph)
+            story.append((sent, graph_parsed))
+    if len(queries) > 0:
+        yield (story[:queries[-1][0]], queries)
+
+def parse_stories(lines):
+    '''
+    Parse stories provided in the bAbi tasks format, with knowledge graph.
+    '''
+    return list(iter_parse_stories(lines))
+
+def iter_stories(taskname, multi_query=False):
+    '''
+    Lazily read and parse the stories in a file, one at a time.
+    '''
+    with open(taskname, 'r') as f:
+        if multi_query:
+            yield from iter_parse_multiquery_stories(f)
+        else:
+            yield from iter_parse_stories(f)
+
+def story_queries(story):
+    '''
+    Get the list of (position, query, answer) of a story, in either the single-query
+    format (sents_graphs, query, answer) or the multi-query format (sents_graphs, queries)
+    '''
+    if len(story) == 2:
+        return story[1]
+    sents_graphs, query, answer = story
+    return [(len(sents_graphs), query, answer)]
+
+class StoryFile( object ):
+    '''
+    A re-iterable stream of the stories in a file. Each iteration reads the file
+    again from the start, so only one story needs to be in memory at a time.
+    If multi_query, each story is read in the multi-query format (see
+    iter_parse_multiquery_stories).
+    '''
+    def __init__(self, taskname, multi_query=False):
+        self.taskname = taskname
+        self.multi_query = multi_query
+
+    def __iter__(self):
+        return iter_stories(self.taskname, self.multi_query)
+
+    def iter_line_chunks(self, chunk_size):
+        '''
+        Split the raw lines of the file into chunks that each start at a story
+        boundary and contain at least chunk_size stories (except possibly the last).
+
+        Yields: (start_index, lines), where start_index is the index of the first
+            story of the chunk in the whole file
+        '''
+        start_index = 0
+        chunk_lines = []
+        chunk_stories = 0
+        seen_query = False
+        with open(self.taskname, 'r') as f:
+            for line in f:
+                if line.split(' ', 1)[0] == "1":
+                    seen_query = False
+                    if chunk_stories >= chunk_size:
+                        yield start_index, chunk_lines
+                        start_index += chunk_stories
+                        chunk_lines = []
+                        chunk_stories = 0
+                chunk_lines.append(line)
+                if '\t' in line:
+                    # In multi-query mode, a story counts once no matter how many questions it has
+                    if not (self.multi_query and seen_query):
+                        chunk_stories += 1
+                    seen_query = True
+        if len(chunk_lines) > 0:
+            yield start_index, chunk_lines
 
 def get_stories(taskname):
     with open(taskname, 'r') as f:
@@ -76,10 +183,14 @@ def get_max_nodes_per_iter(stories):
             prev_nodes = cur_nodes
     return result
 
-def get_buckets(stories, max_ignore_unbatched=100, max_pad_amount=25):
-    sentencecounts = [len(sents_graphs) for (sents_graphs, query, answer) in stories]
-    countpairs = sorted(collections.Counter(sentencecounts).items())
+def get_length_counts(stories):
+    '''
+    Get sorted (sentence count, number of stories) pairs
+    '''
+    sentencecounts = collections.Counter(len(sents_graphs) for (sents_graphs, query, answer) in stories)
+    return sorted(sentencecounts.items())
 
+def get_buckets_from_counts(countpairs, max_ignore_unbatched=100, max_pad_amount=25):
     buckets = []
     smallest_left_val = 0
     num_unbatched = max_ignore_unbatched
@@ -94,6 +205,93 @@ def get_buckets(stories, max_ignore_unbatched=100, max_pad_amount=25):
 
     return buckets
 
+def get_buckets(stories, max_ignore_unbatched=100, max_pad_amount=25):
+    return get_buckets_from_counts(get_length_counts(stories), max_ignore_unbatched, max_pad_amount)
+
+def bucket_edge_cost(bucket_size, new_nodes_per_iter, num_edge_types, sequence_representation=False):
+    '''
+    Estimate the cost (in edge array entries) of running one story padded to bucket_size
+    sentences. This grows cubically with bucket size, since the graph gains nodes every
+    sentence and the edges of every sentence are processed.
+    '''
+    edge_size = (bucket_size**3) * (new_nodes_per_iter**2) * num_edge_types
+    if sequence_representation:
+        # In sequence representation mode, we are doing stuff with all objects at the same time
+        # so add a multiple of the edge size to get a nice bound
+        edge_size = edge_size * 4
+    return edge_size
+
+def get_padded_cost(countpairs, buckets, cost_fn):
+    '''
+    Compute the total cost of a set of stories when padded into buckets, along with
+    the cost they would have without any padding.
+
+    Returns: padded_cost, unpadded_cost
+    '''
+    padded_cost = sum(ct*cost_fn(buckets[get_bucket_index(buckets, val)]) for val,ct in countpairs)
+    unpadded_cost = sum(ct*cost_fn(val) for val,ct in countpairs)
+    return padded_cost, unpadded_cost
+
+def get_optimal_buckets_from_counts(countpairs, num_buckets, cost_fn):
+    '''
+    Choose at most num_buckets bucket sizes that minimize the total cost of the padded
+    stories, using dynamic programming over the sorted sentence counts.
+
+    Params:
+        countpairs: Sorted (sentence count, number of stories) pairs
+        num_buckets: Maximum number of buckets to use
+        cost_fn: Function from a bucket size to the cost of one story in that bucket
+    '''
+    lengths = [val for val,ct in countpairs]
+    cum_counts = np.cumsum([0] + [ct for val,ct in countpairs])
+    costs = [cost_fn(val) for val in lengths]
+    n = len(lengths)
+    num_buckets = min(num_buckets, n)
+    # best[j] is the cheapest cost for the first j+1 lengths, with the last bucket ending at j
+    best = [cum_counts[j+1]*costs[j] for j in range(n)]
+    choices = [[None]*n]
+    for _ in range(1, num_buckets):
+        new_best = list(best)
+        choice = [None]*n
+        for j in range(1, n):
+            for i in range(j):
+                # Previous bucket ends at i, new bucket covers i+1 through j
+                cand = best[i] + (cum_counts[j+1] - cum_counts[i+1])*costs[j]
+                if cand < new_best[j]:
+                    new_best[j] = cand
+                    choice[j] = i
+        best = new_best
+        choices.append(choice)
+
+    buckets = []
+    j = n-1
+    for k in reversed(range(num_buckets)):
+        if k == 0:
+            buckets.append(lengths[j])
+        elif choices[k][j] is not None:
+            # Otherwise, this solution didn't need another bucket
+            buckets.append(lengths[j])
+            j = choices[k][j]
+    return sorted(buckets)
+
+def print_padding_report(countpairs, bucket_sets, cost_fn, file=sys.stdout):
+    '''
+    Print the cost of padding for each named set of buckets in bucket_sets
+    '''
+    for name, buckets in bucket_sets:
+        padded, unpadded = get_padded_cost(countpairs, buckets, cost_fn)
+        waste = padded - unpadded
+        print("{} buckets {}: padded cost {}, padding waste {} ({:.1%})".format(
+            name, buckets, padded, waste, waste/padded if padded > 0 else 0.0), file=file)
+
+def get_bucket_index(buckets, num_sentences):
+    '''
+    Get the index of the smallest bucket that can hold a story with num_sentences sentences
+    '''
+    idx = bisect.bisect_left(buckets, num_sentences)
+    assert idx < len(buckets), "Couldn't put story of length {} into buckets {}".format(num_sentences, buckets)
+    return idx
+
 PAD_WORD = "<PAD>"
 
 def get_wordlist(stories):
@@ -120,6 +318,15 @@ def pad_story(story, num_sentences, sentence_length):
     sentgraph_padding = (pad([],sentence_length,PAD_WORD), padded_sents_graphs[-1][1])
     return (pad(padded_sents_graphs, num_sentences, sentgraph_padding), padded_query, answer)
 
+def pad_multiquery_story(story, num_sentences, sentence_length):
+    '''
+    Like pad_story, but for a story in the multi-query format
+    '''
+    sents_graphs, queries = story
+    padded_sents_graphs, _, _ = pad_story((sents_graphs, [], []), num_sentences, sentence_length)
+    padded_queries = [(pos, q + [PAD_WORD]*(sentence_length - len(q)), a) for pos, q, a in queries]
+    return (padded_sents_graphs, padded_queries)
+
 def get_unqualified_id(s):
     return s.split("#")[0]
 
@@ -136,11 +343,26 @@ def get_graph_lists(stories):
     edgemap = list_to_map(edge_words)
     return node_words, nodemap, edge_words, edgemap
 
+def get_graph_size(num_sentences, new_nodes_per_iter, num_node_ids, dynamic=True):
+    """
+    Get the number of node slots in the graph after num_sentences sentences. In dynamic
+    mode, each sentence adds new_nodes_per_iter slots to an initial padding node.
+    """
+    if dynamic:
+        return num_sentences*new_nodes_per_iter + 1
+    else:
+        return num_node_ids
+
 def convert_graph(graphs, nodemap, edgemap, new_nodes_per_iter, dynamic=True):
-    num_node_ids = len(nodemap)
-    num_edge_types = len(edgemap)
+    """
+    Convert a sequence of graphs into new-node arrays and a sparse edge list.
 
-    full_size = len(graphs)*new_nodes_per_iter + 1
+    Returns: num_new_nodes, new_node_strengths, new_node_ids, edges
+        edges is an int array of shape (n_edges, 4), where each row is
+        (sentence index, source node slot, dest node slot, edge type). See
+        packed_dataset.densify_edges to expand it.
+    """
+    num_node_ids = len(nodemap)
 
     prev_size = 1
     processed_nodes = []
@@ -153,9 +375,8 @@ def convert_graph(graphs, nodemap, edgemap, new_nodes_per_iter, dynamic=True):
         processed_nodes = list(nodemap.keys())
         index_map = nodemap.copy()
         prev_size = num_node_ids
-        full_size = prev_size
         new_nodes_per_iter = 0
-    for g in graphs:
+    for step, g in enumerate(graphs):
         active_nodes = g["nodes"]
         active_edges = g["edges"]
 
@@ -173,21 +394,21 @@ def convert_graph(graphs, nodemap, edgemap, new_nodes_per_iter, dynamic=True):
             new_node_ids[i,nodemap[get_unqualified_id(node)]] = 1.0
             index_map[node] = prev_size + i
 
-        next_edges = np.zeros([full_size, full_size, num_edge_types])
         for edge in active_edges:
-            next_edges[index_map[edge["from"]],
-                       index_map[edge["to"]],
-                       edgemap[get_unqualified_id(edge["type"])]] = 1.0
+            all_edges.append((step,
+                              index_map[edge["from"]],
+                              index_map[edge["to"]],
+                              edgemap[get_unqualified_id(edge["type"])]))
 
         processed_nodes.extend(new_nodes)
         prev_size += new_nodes_per_iter
 
         all_num_nodes.append(num_new_nodes)
         all_node_ids.append(new_node_ids)
-        all_edges.append(next_edges)
         all_node_strengths.append(new_node_strengths)
 
-    return np.stack(all_num_nodes), np.stack(all_node_strengths), np.stack(all_node_ids), np.stack(all_edges)
+    edges = np.array(all_edges, np.int32).reshape([-1, 4])
+    return np.stack(all_num_nodes), np.stack(all_node_strengths), np.stack(all_node_ids), edges
 
 def convert_story(story, wordmap, answer_map, graph_node_map, graph_edge_map, new_nodes_per_iter, dynamic=True):
     """
@@ -205,6 +426,31 @@ def convert_story(story, wordmap, answer_map, graph_node_map, graph_edge_map, ne
     answer_arr = [answer_map[w] for w in answer]
     return (sentence_arr, graphs, query_arr, answer_arr)
 
+def convert_multiquery_story(story, wordmap, answer_map, graph_node_map, graph_edge_map, new_nodes_per_iter, dynamic=True):
+    """
+    Like convert_story, but for a story in the multi-query format. Produces a
+    consolidated story in format
+        (sentence_arr, [graph_arr_dict], [(position, query_arr, answer_arr)])
+    """
+    sents_graphs, queries = story
+
+    sentence_arr = [[wordmap[w] for w in s] for s,g in sents_graphs]
+    graphs = convert_graph([g for s,g in sents_graphs], graph_node_map, graph_edge_map, new_nodes_per_iter, dynamic)
+    query_list = [(pos, [wordmap[w] for w in q], [answer_map[w] for w in a]) for pos, q, a in queries]
+    return (sentence_arr, graphs, query_list)
+
+def pad_and_convert_story(story, num_sentences, metadata, maps, dynamic=True, multi_query=False):
+    '''
+    Pad and convert a story, in either format, and split it into packed columns
+    '''
+    wordmap, answer_map, graph_node_map, graph_edge_map = maps
+    if multi_query:
+        cvtd = convert_multiquery_story(pad_multiquery_story(story, num_sentences, metadata.sentence_length), wordmap, answer_map, graph_node_map, graph_edge_map, metadata.new_nodes_per_iter, dynamic)
+        return packed_dataset.multiquery_to_columns(cvtd)
+    else:
+        cvtd = convert_story(pad_story(story, num_sentences, metadata.sentence_length), wordmap, answer_map, graph_node_map, graph_edge_map, metadata.new_nodes_per_iter, dynamic)
+        return packed_dataset.converted_to_columns(cvtd)
+
 def process_story(s,bucket_len):
     return convert_story(pad_story(s, bucket_len, sentence_length), wordmap, answer_map, graph_node_map, graph_edge_map, new_nodes_per_iter, dynamic)
 
@@ -224,6 +470,9 @@ def prepare_stories(stories, dynamic=True):
     return sentence_length, new_nodes_per_iter, buckets, wordlist, anslist, graph_node_list, graph_edge_list, bucketed
 
 def print_batch(story, wordlist, anslist, file=sys.stdout):
+    if len(story) == 4:
+        print_multiquery_batch(story, wordlist, anslist, file)
+        return
     sents, query, answer = story
     for batch,(s,q,a) in enumerate(zip(sents,query,answer)):
         file.write("Story {}\n".format(batch))
@@ -232,27 +481,88 @@ def print_batch(story, wordlist, anslist, file=sys.stdout):
         file.write(" ".join(wordlist[word] for word in q) + "\n")
         file.write(" ".join(anslist[word] for word in a.nonzero()[1]) + "\n")
 
+def print_multiquery_batch(story, wordlist, anslist, file=sys.stdout):
+    sents, queries, positions, answers = story
+    for batch,(s,qs,ps,ans) in enumerate(zip(sents,queries,positions,answers)):
+        file.write("Story {}\n".format(batch))
+        for sent in s:
+            file.write(" ".join([wordlist[word] for word in sent]) + "\n")
+        for q,p,a in zip(qs,ps,ans):
+            if p > 0:
+                file.write("After sentence {}: ".format(p) + " ".join(wordlist[word] for word in q) + "\n")
+                file.write(" ".join(anslist[word] for word in a.nonzero()[1]) + "\n")
+
 MetadataList = collections.namedtuple("MetadataList", ["sentence_length", "new_nodes_per_iter", "buckets", "wordlist", "anslist", "graph_node_list", "graph_edge_list"])
 PreppedStory = collections.namedtuple("PreppedStory", ["converted", "sentences", "query", "answer"])
+def scan_stories(stories):
+    '''
+    Compute the metadata for a set of stories, along with their sentence count
+    histogram, in a single pass. stories may be any iterable.
+
+    Returns: metadata, countpairs
+        metadata: A MetadataList
+        countpairs: Sorted (sentence count, number of stories) pairs
+    '''
+    max_sentence_length = 0
+    max_query_length = 0
+    new_nodes_per_iter = 0
+    words = set()
+    answer_words = set()
+    node_words = set()
+    edge_words = set()
+    sentencecounts = collections.Counter()
+    for story in stories:
+        sents_graphs = story[0]
+        sentencecounts[len(sents_graphs)] += 1
+        for (position, query, answer) in story_queries(story):
+            max_query_length = max(max_query_length, len(query))
+            words.update(query)
+            answer_words.update(answer)
+        prev_nodes = set()
+        for (sentence, graph) in sents_graphs:
+            max_sentence_length = max(max_sentence_length, len(sentence))
+            words.update(sentence)
+            cur_nodes = set(graph["nodes"])
+            new_nodes_per_iter = max(new_nodes_per_iter, len(cur_nodes - prev_nodes))
+            prev_nodes = cur_nodes
+            node_words.update(get_unqualified_id(node) for node in graph["nodes"])
+            edge_words.update(get_unqualified_id(edge["type"]) for edge in graph["edges"])
+
+    countpairs = sorted(sentencecounts.items())
+    metadata = MetadataList(sentence_length=max(max_sentence_length, max_query_length),
+                            new_nodes_per_iter=new_nodes_per_iter,
+                            buckets=get_buckets_from_counts(countpairs),
+                            wordlist=[PAD_WORD] + sorted(words),
+                            anslist=sorted(answer_words),
+                            graph_node_list=sorted(node_words),
+                            graph_edge_list=sorted(edge_words))
+    return metadata, countpairs
+
 def generate_metadata(stories, dynamic=True):
-    sentence_length = max(get_max_sentence_length(stories), get_max_query_length(stories))
-    buckets = get_buckets(stories)
-    wordlist, wordmap = get_wordlist(stories)
-    anslist, ansmap = get_answer_list(stories)
-    new_nodes_per_iter = get_max_nodes_per_iter(stories)
-    graph_node_list, graph_node_map, graph_edge_list, graph_edge_map = get_graph_lists(stories)
-    metadata = MetadataList(sentence_length, new_nodes_per_iter, buckets, wordlist, anslist, graph_node_list, graph_edge_list)
+    metadata, _ = scan_stories(stories)
     return metadata
 
-def preprocess_stories(stories, savedir, dynamic=True, metadata_file=None):
-    if metadata_file is None:
-        metadata = generate_metadata(stories, dynamic)
-    else:
+def preprocess_stories(stories, savedir, dynamic=True, metadata_file=None, workers=1, chunk_size=1000, num_buckets=None, multi_query=False):
+    '''
+    Convert stories and save them into savedir. stories must be iterable twice (for
+    instance, a list or a StoryFile): once to gather metadata and once to convert.
+    If workers > 1, conversion is split across that many processes, and stories
+    must be a StoryFile. If num_buckets is given, bucket sizes are chosen to minimize
+    the cost of padding using at most that many buckets. If multi_query, stories must
+    be in the multi-query format, and are saved with all of their queries together.
+    '''
+    metadata, countpairs = scan_stories(stories)
+    if metadata_file is not None:
         with open(metadata_file,'rb') as f:
             metadata = pickle.load(f)
 
-    buckets = get_buckets(stories)
+    buckets = get_buckets_from_counts(countpairs)
     sentence_length, new_nodes_per_iter, old_buckets, wordlist, anslist, graph_node_list, graph_edge_list = metadata
+    if num_buckets is not None:
+        cost_fn = lambda size: bucket_edge_cost(size, new_nodes_per_iter, len(graph_edge_list))
+        greedy_buckets = buckets
+        buckets = get_optimal_buckets_from_counts(countpairs, num_buckets, cost_fn)
+        print_padding_report(countpairs, [("Greedy", greedy_buckets), ("Optimized", buckets)], cost_fn)
     metadata = metadata._replace(buckets=buckets)
 
     if not os.path.exists(savedir):
@@ -261,41 +571,95 @@ def preprocess_stories(stories, savedir, dynamic=True, metadata_file=None):
     with open(os.path.join(savedir,'metadata.p'),'wb') as f:
         pickle.dump(metadata, f)
 
-    bucketed_files = [[] for _ in buckets] 
-
-    for i,story in enumerate(stories):
-        bucket_idx, cur_bucket = next(((i,bmax) for (i,(bstart, bmax)) in enumerate(zip([0]+buckets,buckets))
-                                        if bstart < len(story[0]) <= bmax), (None,None))
-        assert cur_bucket is not None, "Couldn't put story of length {} into buckets {}".format(len(story[0]), buckets)
-        bucket_dir = os.path.join(savedir, "bucket_{}".format(cur_bucket))
-        if not os.path.exists(bucket_dir):
-            os.makedirs(bucket_dir)
-        story_fn = os.path.join(bucket_dir, "story_{}.pz".format(i))
-
-        sents_graphs, query, answer = story
-        sents = [s for s,g in sents_graphs]
-        cvtd = convert_story(pad_story(story, cur_bucket, sentence_length), list_to_map(wordlist), list_to_map(anslist), list_to_map(graph_node_list), list_to_map(graph_edge_list), new_nodes_per_iter, dynamic)
-
-        prepped = PreppedStory(cvtd, sents, query, answer)
+    bucket_dirs = [os.path.join(savedir, "bucket_{}".format(bmax)) for bmax in buckets]
+    writers = [packed_dataset.PackedBucketWriter(d, attrs={
+                    "graph_size": get_graph_size(bmax, new_nodes_per_iter, len(graph_node_list), dynamic),
+                    "num_edge_types": len(graph_edge_list),
+                    "multi_query": multi_query})
+                for d, bmax in zip(bucket_dirs, buckets)]
+
+    if workers > 1:
+        assert isinstance(stories, StoryFile), "Preprocessing with multiple workers requires a StoryFile"
+        assert stories.multi_query == multi_query, "StoryFile must be read in the same format the stories are converted to"
+        convert_stories_parallel(stories, savedir, metadata, writers, dynamic, workers, chunk_size, multi_query)
+    else:
+        maps = tuple(list_to_map(l) for l in (wordlist, anslist, graph_node_list, graph_edge_list))
+        for i,story in enumerate(stories):
+            bucket_idx = get_bucket_index(buckets, len(story[0]))
+            cur_bucket = buckets[bucket_idx]
 
-        with gzip.open(story_fn, 'wb') as zf:
-            pickle.dump(prepped, zf)
+            fixed, ragged = pad_and_convert_story(story, cur_bucket, metadata, maps, dynamic, multi_query)
+            writers[bucket_idx].append(i, fixed, ragged)
 
-        bucketed_files[bucket_idx].append(os.path.relpath(story_fn, savedir))
-        gc.collect() # we don't want to use too much memory, so try to clean it up
+    for writer in writers:
+        writer.close()
+    packed_dataset.write_bucket_list(savedir, bucket_dirs)
 
-    with open(os.path.join(savedir,'file_list.p'),'wb') as f:
-        pickle.dump(bucketed_files, f)
+_worker_setup = None
+def _init_convert_worker(metadata, dynamic, multi_query=False):
+    global _worker_setup
+    maps = tuple(list_to_map(l) for l in (metadata.wordlist, metadata.anslist, metadata.graph_node_list, metadata.graph_edge_list))
+    _worker_setup = (metadata, maps, dynamic, multi_query)
 
-def main(file, dynamic, metadata_file=None):
-    stories = get_stories(file)
+def _convert_chunk(shard_dir, start_index, lines):
+    '''
+    Convert a chunk of lines in a worker process, writing one shard bucket directory
+    per bucket the chunk's stories fall into. Returns the indices of those buckets.
+    '''
+    metadata, maps, dynamic, multi_query = _worker_setup
+    parse_fn = iter_parse_multiquery_stories if multi_query else iter_parse_stories
+    writers = {}
+    for i,story in enumerate(parse_fn(lines), start_index):
+        bucket_idx = get_bucket_index(metadata.buckets, len(story[0]))
+        cur_bucket = metadata.buckets[bucket_idx]
+        if bucket_idx not in writers:
+            writers[bucket_idx] = packed_dataset.PackedBucketWriter(os.path.join(shard_dir, "bucket_{}".format(cur_bucket)))
+        fixed, ragged = pad_and_convert_story(story, cur_bucket, metadata, maps, dynamic, multi_query)
+        writers[bucket_idx].append(i, fixed, ragged)
+    for writer in writers.values():
+        writer.close()
+    return sorted(writers.keys())
+
+def convert_stories_parallel(stories, savedir, metadata, writers, dynamic, workers, chunk_size, multi_query=False):
+    '''
+    Convert the stories of a StoryFile using a pool of worker processes. Each worker
+    converts a contiguous chunk of stories into its own shard, and shards are merged
+    into writers in file order, so the result is identical to converting serially.
+    '''
+    shards_root = os.path.join(savedir, "shards")
+    pending = collections.deque()
+
+    def merge_oldest():
+        shard_dir, result = pending.popleft()
+        for bucket_idx in result.get():
+            writers[bucket_idx].extend_from(os.path.join(shard_dir, "bucket_{}".format(metadata.buckets[bucket_idx])))
+        shutil.rmtree(shard_dir)
+
+    with multiprocessing.Pool(workers, _init_convert_worker, (metadata, dynamic, multi_query)) as pool:
+        for chunk_idx, (start_index, lines) in enumerate(stories.iter_line_chunks(chunk_size)):
+            shard_dir = os.path.join(shards_root, "chunk_{}".format(chunk_idx))
+            pending.append((shard_dir, pool.apply_async(_convert_chunk, (shard_dir, start_index, lines))))
+            # Only keep a few chunks in flight, so that memory use stays bounded
+            while len(pending) > 2*workers:
+                merge_oldest()
+        while len(pending) > 0:
+            merge_oldest()
+    if os.path.isdir(shards_root):
+        os.rmdir(shards_root)
+
+def main(file, dynamic, metadata_file=None, workers=1, chunk_size=1000, num_buckets=None, multi_query=False):
+    stories = StoryFile(file, multi_query)
     dirname, ext = os.path.splitext(file)
-    preprocess_stories(stories, dirname, dynamic, metadata_file)
+    preprocess_stories(stories, dirname, dynamic, metadata_file, workers, chunk_size, num_buckets, multi_query)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Parse a graph file')
     parser.add_argument("file", help="Graph file to parse")
     parser.add_argument("--static", dest="dynamic", action="store_false", help="Don't use dynamic nodes")
     parser.add_argument("--metadata-file", default=None, help="Use this particular metadata file instead of building it from scratch")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes to use when converting stories")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Number of stories to give each worker at a time")
+    parser.add_argument("--num-buckets", type=int, default=None, help="Choose at most this many bucket sizes to minimize padded computation, instead of using the default greedy bucketing")
+    parser.add_argument("--multi-query", action="store_true", help="Store each story once with all of its questions, instead of once per question")
     args = vars(parser.parse_args())
     main(**args)
@@ -6,8 +6,13 @@ import random
 import ggtnn_graph_parse
 import convert_story
 import gzip
+import queue
+import threading
+import packed_dataset
 from enum import Enum
-from ggtnn_graph_parse import MetadataList, PreppedStory
+from ggtnn_graph_parse import MetadataList, PreppedStory, bucket_edge_cost
+from packed_dataset import PackedStoryRef
+from byte_lru_cache import ByteLRUCache
 from graceful_interrupt import GracefulInterruptHandler
 from pprint import pformat
 import util
@@ -47,33 +52,96 @@ def get_effective_answer_words(answer_words, format_spec):
     else:
         return answer_words
 
-def sample_batch(matching_stories, batch_size, num_answer_words, format_spec):
+def sample_batch(matching_stories, batch_size, num_answer_words, format_spec, compact_nodes=False):
     chosen_stories = [random.choice(matching_stories) for _ in range(batch_size)]
-    return assemble_batch(chosen_stories, num_answer_words, format_spec)
+    return assemble_batch(chosen_stories, num_answer_words, format_spec, compact_nodes)
 
-def assemble_batch(story_fns, num_answer_words, format_spec):
-    stories = []
-    for sfn in story_fns:
-        with gzip.open(sfn,'rb') as f:
-            cvtd_story, _, _, _ = pickle.load(f)
-        stories.append(cvtd_story)
+story_cache = None
+
+def enable_story_cache(max_bytes):
+    """
+    Keep decoded stories in memory, up to a budget of max_bytes, so that
+    stories sampled repeatedly are only read from disk once
+    """
+    global story_cache
+    story_cache = ByteLRUCache(max_bytes)
+
+def _load_packed_columns(story_refs):
+    bucket = story_refs[0].bucket
+    assert all(ref.bucket is bucket for ref in story_refs), "Batch contains stories from multiple buckets"
+    if story_cache is None:
+        return bucket, bucket.load([ref.index for ref in story_refs])
+    keys = [(bucket.bucket_dir, ref.index) for ref in story_refs]
+    story_cols = [story_cache.get(key) for key in keys]
+    missing = [i for i,c in enumerate(story_cols) if c is None]
+    if len(missing) > 0:
+        loaded = packed_dataset.split_columns(bucket.load([story_refs[i].index for i in missing]))
+        for i, cols in zip(missing, loaded):
+            story_cache.put(keys[i], cols)
+            story_cols[i] = cols
+    return bucket, packed_dataset.stack_columns(bucket, story_cols)
+
+def load_converted_story(story_fn):
+    """
+    Load a single converted story, either from a packed bucket or from a story file
+    """
+    if isinstance(story_fn, PackedStoryRef):
+        sents, queries, answers, graphs = load_converted_stories([story_fn])
+        return (sents[0], tuple(g[0] for g in graphs), packed_dataset.index_queries(queries, 0), answers[0])
+    if story_cache is not None:
+        cvtd_story = story_cache.get(story_fn)
+        if cvtd_story is not None:
+            return cvtd_story
+    with gzip.open(story_fn,'rb') as f:
+        cvtd_story, _, _, _ = pickle.load(f)
+    if story_cache is not None:
+        story_cache.put(story_fn, cvtd_story)
+    return cvtd_story
+
+def load_converted_stories(story_fns, compact_nodes=False):
+    """
+    Load a batch of converted stories. If compact_nodes, node slots in the edges are
+    renumbered so that only nodes that are actually added get a slot (see
+    packed_dataset.compact_edges).
+
+    Returns: sents, queries, answers, graphs
+        where graphs is (num_new_nodes, new_node_strengths, new_node_ids, next_edges)
+    """
+    if isinstance(story_fns[0], PackedStoryRef):
+        bucket, cols = _load_packed_columns(story_fns)
+        return packed_dataset.columns_to_batch(bucket, cols, compact_nodes)
+    stories = [load_converted_story(sfn) for sfn in story_fns]
     sents, graphs, queries, answers = zip(*stories)
+    graphs = tuple(np.stack(x) for x in zip(*graphs))
+    num_new_nodes, new_node_strengths, new_node_ids, next_edges = graphs
+    if compact_nodes and new_node_strengths.shape[2] > 0:
+        next_edges = packed_dataset.compact_dense_edges(next_edges, num_new_nodes, new_node_strengths.shape[2])
+        graphs = (num_new_nodes, new_node_strengths, new_node_ids, next_edges)
+    return np.array(sents, np.int32), np.array(queries, np.int32), answers, graphs
+
+def assemble_batch(story_fns, num_answer_words, format_spec, compact_nodes=False):
+    story_fns = list(story_fns)
+    sents, queries, answers, graphs = load_converted_stories(story_fns, compact_nodes)
     cvtd_sents = np.array(sents, np.int32)
+    num_new_nodes, new_node_strengths, new_node_ids, next_edges = graphs
+    if isinstance(queries, packed_dataset.MultiQuery):
+        # Each story has an answer for each of its queries, padded with empty answers
+        max_ans_len = max(len(a) for story_answers in answers for a in story_answers)
+        max_queries = queries.positions.shape[1]
+        empty_answer = np.zeros_like(convert_answer(answers[0][0], num_answer_words, format_spec, max_ans_len))
+        cvtd_answers = np.stack([np.stack([convert_answer(answer, num_answer_words, format_spec, max_ans_len) for answer in story_answers]
+                                          + [empty_answer]*(max_queries - len(story_answers)))
+                                 for story_answers in answers])
+        return cvtd_sents, queries.words, queries.positions, cvtd_answers, num_new_nodes, new_node_strengths, new_node_ids, next_edges
     cvtd_queries = np.array(queries, np.int32)
     max_ans_len = max(len(a) for a in answers)
     cvtd_answers = np.stack([convert_answer(answer, num_answer_words, format_spec, max_ans_len) for answer in answers])
-    num_new_nodes, new_node_strengths, new_node_ids, next_edges = zip(*graphs)
-    num_new_nodes = np.stack(num_new_nodes)
-    new_node_strengths = np.stack(new_node_strengths)
-    new_node_ids = np.stack(new_node_ids)
-    next_edges = np.stack(next_edges)
     return cvtd_sents, cvtd_queries, cvtd_answers, num_new_nodes, new_node_strengths, new_node_ids, next_edges
 
 def assemble_correct_graphs(story_fns):
     correct_strengths, correct_ids, correct_edges = [], [], []
     for sfn in story_fns:
-        with gzip.open(sfn,'rb') as f:
-            cvtd_story, _, _, _ = pickle.load(f)
+        cvtd_story = load_converted_story(sfn)
         strengths, ids, _, edges = convert_story.convert(cvtd_story)
         correct_strengths.append(strengths)
         correct_ids.append(ids)
@@ -82,18 +150,19 @@ def assemble_correct_graphs(story_fns):
 
 def visualize(m, story_buckets, wordlist, answerlist, output_format, outputdir, batch_size=1, seq_len=5, debugmode=False, snap=False):
     cur_bucket = random.choice(story_buckets)
-    sampled_batch = sample_batch(cur_bucket, batch_size, len(answerlist), output_format)
-    part_sampled_batch = sampled_batch[:3]
+    sampled_batch = sample_batch(cur_bucket, batch_size, len(answerlist), output_format, m.compact_nodes)
+    # Everything but the graph arrays, ending with the answers
+    part_sampled_batch = sampled_batch[:-4]
     with open(os.path.join(outputdir,'stories.txt'),'w') as f:
         ggtnn_graph_parse.print_batch(part_sampled_batch, wordlist, answerlist, file=f)
     with open(os.path.join(outputdir,'answer_list.txt'),'w') as f:
         f.write('\n'.join(answerlist) + '\n')
     if debugmode:
         args = sampled_batch
-        fn = m.debug_test_fn
+        fn = m.debug_test
     else:
-        args = part_sampled_batch[:2] + ((seq_len,) if output_format == model.ModelOutputFormat.sequence else ())
-        fn = m.snap_test_fn if snap else m.fuzzy_test_fn
+        args = part_sampled_batch[:-1] + ((seq_len,) if output_format == model.ModelOutputFormat.sequence else ())
+        fn = m.snap_test if snap else m.fuzzy_test
     results = fn(*args)
     for i,result in enumerate(results):
         np.save(os.path.join(outputdir,'result_{}.npy'.format(i)), result)
@@ -105,21 +174,28 @@ def test_accuracy(m, story_buckets, bucket_sizes, num_answer_words, format_spec,
         cur_batch_size = adj_size(m, bucket_size, batch_size, batch_auto_adjust)
         for start_idx in range(0, len(bucket), cur_batch_size):
             stories = bucket[start_idx:start_idx+cur_batch_size]
-            batch = assemble_batch(stories, num_answer_words, format_spec)
-            answers = batch[2]
-            args = batch[:2] + ((answers.shape[1],) if format_spec == model.ModelOutputFormat.sequence else ())
+            batch = assemble_batch(stories, num_answer_words, format_spec, m.compact_nodes)
+            # The answers come right before the four graph arrays
+            answers = batch[-5]
+            args = batch[:-5] + ((answers.shape[-2],) if format_spec == model.ModelOutputFormat.sequence else ())
 
             if test_graph:
                 _, batch_close, _ = m.eval(*batch, with_accuracy=True)
             else:
-                out_answers, out_strengths, out_ids, out_states, out_edges = m.snap_test_fn(*args)
+                out_answers, out_strengths, out_ids, out_states, out_edges = m.snap_test(*args)
                 close = np.isclose(out_answers, answers)
-                batch_close = np.all(close, (1,2))
+                batch_close = np.all(close, (-2,-1))
 
             print(batch_close)
 
-            batch_correct = np.sum(batch_close).tolist()
-            batch_out_of = len(stories)
+            if batch_close.ndim == 2:
+                # Multi-query stories: count each real query separately
+                query_mask = batch[2] > 0
+                batch_correct = np.sum(batch_close & query_mask).tolist()
+                batch_out_of = np.sum(query_mask).tolist()
+            else:
+                batch_correct = np.sum(batch_close).tolist()
+                batch_out_of = len(stories)
             correct +=  batch_correct
             out_of += batch_out_of
 
@@ -128,23 +204,101 @@ def test_accuracy(m, story_buckets, bucket_sizes, num_answer_words, format_spec,
 def adj_size(m, cur_bucket_size, batch_size, batch_auto_adjust):
     if batch_auto_adjust is not None:
         # Adjust batch size for this bucket
-        edge_size = (cur_bucket_size**3) * (m.new_nodes_per_iter**2) * m.num_edge_types
-        if m.sequence_representation:
-            # In sequence representation mode, we are doing stuff with all objects at the same time
-            # so add a multiple of the edge size to get a nice bound
-            edge_size = edge_size * 4
+        edge_size = bucket_edge_cost(cur_bucket_size, m.new_nodes_per_iter, m.num_edge_types, m.sequence_representation)
         max_batch_size = batch_auto_adjust//edge_size
         return min(batch_size, max_batch_size)
     else:
         return batch_size
 
-def train(m, story_buckets, bucket_sizes, len_answers, output_format, num_updates, outputdir, start=0, batch_size=BATCH_SIZE, validation_buckets=None, validation_bucket_sizes=None, stop_at_accuracy=None, stop_at_loss=None, stop_at_overfitting=None, save_params=1000, validation_interval=1000, batch_auto_adjust=None, interrupt_file=None):
+class BatchPrefetcher( object ):
+    """
+    Samples and assembles training batches in background threads, so that they are
+    ready before the model asks for them. Each batch is drawn from a random bucket,
+    with the batch size adjusted for that bucket, and kept in a bounded queue.
+    """
+    def __init__(self, m, story_buckets, bucket_sizes, num_answer_words, format_spec, batch_size, batch_auto_adjust=None, queue_size=4, num_workers=1):
+        """
+        Params:
+            m: The model (used to adjust batch sizes)
+            story_buckets: List of buckets to sample from
+            bucket_sizes: Number of sentences in each bucket
+            queue_size: Maximum number of ready batches to hold
+            num_workers: Number of threads assembling batches
+        """
+        self._m = m
+        self._choices = list(zip(story_buckets, bucket_sizes))
+        self._num_answer_words = num_answer_words
+        self._format_spec = format_spec
+        self._batch_size = batch_size
+        self._batch_auto_adjust = batch_auto_adjust
+        self._queue = queue.Queue(queue_size)
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for t in self._threads:
+            t.start()
+
+    def _work(self):
+        try:
+            while not self._stop.is_set():
+                cur_bucket, cur_bucket_size = random.choice(self._choices)
+                cur_batch_size = adj_size(self._m, cur_bucket_size, self._batch_size, self._batch_auto_adjust)
+                batch = sample_batch(cur_bucket, cur_batch_size, self._num_answer_words, self._format_spec, self._m.compact_nodes)
+                self._put((batch, None))
+        except Exception as e:
+            self._put((None, e))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        """
+        Get the next ready batch, waiting for one if necessary
+        """
+        batch, error = self._queue.get()
+        if error is not None:
+            raise error
+        return batch
+
+    def close(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+def train(m, story_buckets, bucket_sizes, len_answers, output_format, num_updates, outputdir, start=0, batch_size=BATCH_SIZE, validation_buckets=None, validation_bucket_sizes=None, stop_at_accuracy=None, stop_at_loss=None, stop_at_overfitting=None, save_params=1000, validation_interval=1000, batch_auto_adjust=None, interrupt_file=None, prefetch=4):
+    if prefetch > 0:
+        prefetcher = BatchPrefetcher(m, story_buckets, bucket_sizes, len_answers, output_format, batch_size, batch_auto_adjust, queue_size=prefetch)
+        valid_prefetcher = None if validation_buckets is None else \
+            BatchPrefetcher(m, validation_buckets, validation_bucket_sizes, len_answers, output_format, batch_size, batch_auto_adjust, queue_size=1)
+    else:
+        prefetcher = valid_prefetcher = None
+    try:
+        return _train_loop(m, story_buckets, bucket_sizes, len_answers, output_format, num_updates, outputdir, start, batch_size, validation_buckets, validation_bucket_sizes, stop_at_accuracy, stop_at_loss, stop_at_overfitting, save_params, validation_interval, batch_auto_adjust, interrupt_file, prefetcher, valid_prefetcher)
+    finally:
+        for p in (prefetcher, valid_prefetcher):
+            if p is not None:
+                p.close()
+
+def _train_loop(m, story_buckets, bucket_sizes, len_answers, output_format, num_updates, outputdir, start, batch_size, validation_buckets, validation_bucket_sizes, stop_at_accuracy, stop_at_loss, stop_at_overfitting, save_params, validation_interval, batch_auto_adjust, interrupt_file, prefetcher, valid_prefetcher):
     with GracefulInterruptHandler() as interrupt_h:
         for i in range(start+1,num_updates+1):
             exit_with = None
-            cur_bucket, cur_bucket_size = random.choice(list(zip(story_buckets, bucket_sizes)))
-            cur_batch_size = adj_size(m, cur_bucket_size, batch_size, batch_auto_adjust)
-            sampled_batch = sample_batch(cur_bucket, cur_batch_size, len_answers, output_format)
+            if prefetcher is not None:
+                sampled_batch = prefetcher.get()
+            else:
+                cur_bucket, cur_bucket_size = random.choice(list(zip(story_buckets, bucket_sizes)))
+                cur_batch_size = adj_size(m, cur_bucket_size, batch_size, batch_auto_adjust)
+                sampled_batch = sample_batch(cur_bucket, cur_batch_size, len_answers, output_format, m.compact_nodes)
             loss, info = m.train(*sampled_batch)
             if np.any(np.isnan(loss)):
                 print("Loss at timestep {} was nan! Aborting".format(i))
@@ -154,18 +308,24 @@ def train(m, story_buckets, bucket_sizes, len_answers, output_format, num_update
                     f.seek(0)
                     f.truncate()
                     keylist = "iter, loss, " + ", ".join(k for k,v in sorted(info.items())) + "\n"
-                    f.write(keylist)
+                    f.write(keylist if story_cache is None else keylist[:-1] + ", " + ", ".join(story_cache.stats().keys()) + "\n")
                     if validation_buckets is not None:
                         with open(os.path.join(outputdir,'valid.csv'),'w') as f2:
                             f2.write(keylist)
-                f.write("{}, {},".format(i,loss) + ", ".join(str(v) for k,v in sorted(info.items())) + "\n")
+                f.write("{}, {},".format(i,loss) + ", ".join(str(v) for k,v in sorted(info.items()))
+                        + ("" if story_cache is None else ", " + ", ".join(str(v) for v in story_cache.stats().values())) + "\n")
             if i % 1 == 0:
                 print("update {}: {}\n{}".format(i,loss,pformat(info)))
+                if story_cache is not None:
+                    print("story cache: {}".format(", ".join("{}={}".format(k,v) for k,v in story_cache.stats().items())))
             if i % validation_interval == 0:
                 if validation_buckets is not None:
-                    cur_bucket, cur_bucket_size = random.choice(list(zip(validation_buckets, validation_bucket_sizes)))
-                    cur_batch_size = adj_size(m, cur_bucket_size, batch_size, batch_auto_adjust)
-                    sampled_batch = sample_batch(cur_bucket, cur_batch_size, len_answers, output_format)
+                    if valid_prefetcher is not None:
+                        sampled_batch = valid_prefetcher.get()
+                    else:
+                        cur_bucket, cur_bucket_size = random.choice(list(zip(validation_buckets, validation_bucket_sizes)))
+                        cur_batch_size = adj_size(m, cur_bucket_size, batch_size, batch_auto_adjust)
+                        sampled_batch = sample_batch(cur_bucket, cur_batch_size, len_answers, output_format, m.compact_nodes)
                     valid_loss, valid_info = m.eval(*sampled_batch)
                     print("validation at {}: {}\n{}".format(i,valid_loss,pformat(valid_info)))
                     with open(os.path.join(outputdir,'valid.csv'),'a') as f:
@@ -178,4 +178,137 @@ class GraphState( object ):
         cls = type(self)
         return cls(next_node_strengths, next_node_ids, next_node_states, next_edge_strengths)
 
+    def with_placed_nodes(self, new_node_strengths, new_node_ids, placement):
+        """
+        Helper function to generate a new state with new nodes written into empty node
+        slots, instead of appended to the end.
+
+        Params:
+            new_node_strengths: Tensor of shape (n_batch, n_new_nodes)
+            new_node_ids: Tensor of shape (n_batch, n_new_nodes, num_node_ids)
+            placement: Tensor of shape (n_batch, n_new_nodes, n_nodes), where placement[b,i,j] is 1 if
+                new node i should be put in slot j. Each row should have at most one 1, and each
+                slot should be empty and receive at most one node.
+
+        Returns: A new graph state with the changes
+        """
+        placed_mask = T.sum(placement, 1)
+        next_node_strengths = self.node_strengths + T.batched_dot(new_node_strengths, placement)
+        next_node_ids = self.node_ids + T.batched_dot(placement.dimshuffle(0,2,1), new_node_ids)
+        # New nodes start with zero state, as in with_additional_nodes
+        next_node_states = self.node_states * T.shape_padright(1 - placed_mask)
+        return self.with_updates(node_strengths=next_node_strengths, node_ids=next_node_ids, node_states=next_node_states)
+
+
+
+class CapacityGraphState( GraphState ):
+    """
+    A graph state stored in preallocated buffers with room for a fixed number of
+    nodes, of which only the first n_nodes are live. Buffer entries for slots that
+    are not live are always zero.
+
+    The node and edge properties are views of the live part of the buffers, so
+    transformations can use this like a normal GraphState. Updates and new nodes
+    are written into the buffers with set_subtensor, instead of concatenating and
+    padding a copy of the edge tensor at each step.
+    """
+    def __init__(self, node_strengths_buf, node_ids_buf, node_states_buf, edge_strengths_buf, n_nodes):
+        """
+        Create a graph state from existing buffers.
+
+            node_strengths_buf: Tensor of shape (batch, capacity)
+            node_ids_buf: Tensor of shape (batch, capacity, num_node_ids)
+            node_states_buf: Tensor of shape (batch, capacity, node_state_size)
+            edge_strengths_buf: Tensor of shape (batch, capacity, capacity, num_edge_types)
+            n_nodes: Scalar giving the number of live nodes
+        """
+        self._node_strengths_buf = node_strengths_buf
+        self._node_ids_buf = node_ids_buf
+        self._node_states_buf = node_states_buf
+        self._edge_strengths_buf = edge_strengths_buf
+        self._n_nodes = n_nodes
+
+    @classmethod
+    def from_graph_state(cls, gstate, capacity):
+        """
+        Copy a graph state into buffers with room for capacity nodes
+        """
+        return cls.unflatten_from_const_size(gstate.flatten_to_const_size(capacity))
+
+    @property
+    def node_strengths(self):
+        return self._node_strengths_buf[:,:self._n_nodes]
+
+    @property
+    def node_states(self):
+        return self._node_states_buf[:,:self._n_nodes,:]
+
+    @property
+    def node_ids(self):
+        return self._node_ids_buf[:,:self._n_nodes,:]
+
+    @property
+    def edge_strengths(self):
+        return self._edge_strengths_buf[:,:self._n_nodes,:self._n_nodes,:]
 
+    @property
+    def n_nodes(self):
+        return self._n_nodes
+
+    @property
+    def capacity(self):
+        return self._node_strengths_buf.shape[1]
+
+    @property
+    def live_mask(self):
+        """
+        Tensor of shape (capacity), 1 for live node slots and 0 for the rest
+        """
+        return T.cast(T.lt(T.arange(self.capacity), self._n_nodes), 'floatX')
+
+    def flatten_to_const_size(self, const_n_nodes=None):
+        """
+        Get the buffers and node count. The buffers are already of constant size, so
+        const_n_nodes (if given) should be the capacity.
+        """
+        return [self._node_strengths_buf, self._node_ids_buf, self._node_states_buf, self._edge_strengths_buf, self._n_nodes]
+
+    @classmethod
+    def unflatten_from_const_size(cls, vals):
+        return cls(*vals)
+
+    def with_updates(self, node_strengths=None, node_ids=None, node_states=None, edge_strengths=None):
+        """
+        Helper function to generate a new state with changes applied. Params are values for
+        the live nodes, like the properties, or None to use current values
+
+        Returns: A new graph state with the changes
+        """
+        n = self._n_nodes
+        node_strengths_buf = self._node_strengths_buf if node_strengths is None else T.set_subtensor(self._node_strengths_buf[:,:n], node_strengths)
+        node_ids_buf = self._node_ids_buf if node_ids is None else T.set_subtensor(self._node_ids_buf[:,:n,:], node_ids)
+        node_states_buf = self._node_states_buf if node_states is None else T.set_subtensor(self._node_states_buf[:,:n,:], node_states)
+        edge_strengths_buf = self._edge_strengths_buf if edge_strengths is None else T.set_subtensor(self._edge_strengths_buf[:,:n,:n,:], edge_strengths)
+        cls = type(self)
+        return cls(node_strengths_buf, node_ids_buf, node_states_buf, edge_strengths_buf, n)
+
+    def with_additional_nodes(self, new_node_strengths, new_node_ids, new_node_states=None):
+        """
+        Helper function to generate a new state with new nodes written into the next
+        free slots. Since slots that are not live are zero, the new nodes start with
+        no edges, and with zero state if new_node_states is not provided.
+
+        Params: See GraphState.with_additional_nodes
+
+        Returns: A new graph state with the changes
+        """
+        start = self._n_nodes
+        stop = start + new_node_strengths.shape[1]
+        node_strengths_buf = T.set_subtensor(self._node_strengths_buf[:,start:stop], new_node_strengths)
+        node_ids_buf = T.set_subtensor(self._node_ids_buf[:,start:stop,:], new_node_ids)
+        if new_node_states is None:
+            node_states_buf = self._node_states_buf
+        else:
+            node_states_buf = T.set_subtensor(self._node_states_buf[:,start:stop,:], new_node_states)
+        cls = type(self)
+        return cls(node_strengths_buf, node_ids_buf, node_states_buf, self._edge_strengths_buf, stop)
@@ -0,0 +1,434 @@
+import os
+import json
+import time
+import pickle
+import socket
+import argparse
+import threading
+import collections
+import socketserver
+import concurrent.futures
+import numpy as np
+
+import ggtnn_graph_parse
+import numpy_inference
+from ggtnn_graph_parse import MetadataList
+
+LATENCY_WINDOW = 10000
+
+InferenceRequest = collections.namedtuple("InferenceRequest", ["sentences", "query", "snap", "return_graph", "future", "arrival"])
+
+def load_model(outputdir, paramfile=None, backend="theano", function_cache_dir=None, needed_functions=("snap_test_fn", "fuzzy_test_fn")):
+    """
+    Load a model trained by main.py, from the model_kwargs.json and params files in its
+    output directory, and compile the functions it will use
+
+    Params:
+        outputdir: Output directory of the training run
+        paramfile: Params file to load. Defaults to the latest one in outputdir
+        backend: "theano" to use model.Model, or "numpy" to use numpy_inference.NumpyModel
+        function_cache_dir: If given, a function_cache directory to load compiled functions from
+        needed_functions: Names of the functions to compile, for the theano backend
+    """
+    if backend == "numpy":
+        return numpy_inference.NumpyModel.from_output_dir(outputdir, paramfile)
+
+    import model
+    import util
+    import function_cache
+    kwargs = numpy_inference.load_model_kwargs(os.path.join(outputdir, numpy_inference.MODEL_KWARGS_FILE))
+    kwargs["output_format"] = model.ModelOutputFormat[kwargs["output_format"]]
+    if "node_matching" in kwargs:
+        kwargs["node_matching"] = model.NodeMatching[kwargs["node_matching"]]
+    kwargs = util.get_compatible_kwargs(model.Model, kwargs)
+    if function_cache_dir is not None:
+        cache = function_cache.FunctionCache(function_cache_dir)
+        m = cache.load(kwargs)
+        if m is None:
+            m = model.Model(**kwargs)
+        if len(m.compile_functions(needed_functions)) > 0:
+            cache.save(m, kwargs)
+    else:
+        m = model.Model(**kwargs)
+        m.compile_functions(needed_functions)
+
+    if paramfile is None:
+        found = numpy_inference.find_recent_params(outputdir)
+        assert found is not None, "No params files in {}".format(outputdir)
+        _, paramfile = found
+    with open(paramfile, 'rb') as f:
+        util.load_params(m.params, f)
+    return m
+
+class StoryEncoder( object ):
+    """
+    Converts stories given as text into word index arrays, using the wordlist of a
+    parsed dataset, and converts model outputs back into answer words and graphs
+    """
+    def __init__(self, metadata, output_format):
+        """
+        Params:
+            metadata: MetadataList of the dataset the model was trained on
+            output_format: Name of the model's output format
+        """
+        self.metadata = metadata
+        self.output_format = output_format
+        self.wordmap = ggtnn_graph_parse.list_to_map(metadata.wordlist)
+
+    def encode_sentence(self, sentence):
+        """
+        Convert a sentence (a string, or a list of words) into a row of word indices,
+        padded to the dataset's sentence length
+        """
+        words = ggtnn_graph_parse.tokenize(sentence) if isinstance(sentence, str) else list(sentence)
+        if len(words) > self.metadata.sentence_length:
+            raise ValueError("Sentence {!r} has {} words, but the model only accepts {}".format(
+                sentence, len(words), self.metadata.sentence_length))
+        unknown = [w for w in words if w not in self.wordmap]
+        if len(unknown) > 0:
+            raise ValueError("Words not in the model's vocabulary: {}".format(", ".join(unknown)))
+        return [self.wordmap[w] for w in words] + [0]*(self.metadata.sentence_length - len(words))
+
+    def encode_story(self, sentences):
+        if len(sentences) == 0:
+            raise ValueError("Stories must have at least one sentence")
+        return np.array([self.encode_sentence(s) for s in sentences], np.int32)
+
+    def decode_answer(self, output):
+        """
+        Convert the output of the model for one query, of shape (?, num_output_words),
+        into a list of answer words
+        """
+        anslist = self.metadata.anslist
+        if self.output_format == "category":
+            return [anslist[np.argmax(output[0])]]
+        elif self.output_format == "subset":
+            return [anslist[i] for i in np.nonzero(output[0] >= 0.5)[0]]
+        elif self.output_format == "sequence":
+            # Indices past the answer list are the stop word
+            words = []
+            for idx in np.argmax(output, -1):
+                if idx >= len(anslist):
+                    break
+                words.append(anslist[idx])
+            return words
+
+    def decode_graph(self, node_strengths, node_ids, edge_strengths, threshold):
+        """
+        Convert a graph state into a dict of the nodes and edges with strength above threshold
+        """
+        node_list, edge_list = self.metadata.graph_node_list, self.metadata.graph_edge_list
+        kept = [i for i in range(len(node_strengths)) if node_strengths[i] > threshold]
+        nodes = [{"index": i, "id": node_list[np.argmax(node_ids[i])], "strength": float(node_strengths[i])}
+                 for i in kept]
+        edges = [{"from": i, "to": j, "type": edge_list[e], "strength": float(edge_strengths[i,j,e])}
+                 for i in kept for j in kept for e in range(len(edge_list))
+                 if edge_strengths[i,j,e] > threshold]
+        return {"nodes": nodes, "edges": edges}
+
+class DynamicBatcher( object ):
+    """
+    Groups requests submitted from many threads into batches, and runs them through a
+    model on a single worker thread. Requests are grouped by the bucket their story
+    length falls into, and whether they snap, so each batch is padded only up to its
+    bucket size. A batch is run as soon as it is full, or once its oldest request has
+    waited max_wait seconds.
+
+    With a streaming_inference.PrefixCache, requests that snap like it are instead run
+    one story at a time through the model's step and query functions, so that stories
+    starting with a cached prefix only run their remaining sentences.
+    """
+    def __init__(self, m, buckets, max_batch_size=32, max_wait=0.01, max_answer_length=5, prefix_cache=None):
+        """
+        Params:
+            m: A model.Model or numpy_inference.NumpyModel
+            buckets: Sorted story lengths to pad batches to. Longer stories are batched with
+                other stories of exactly the same length
+            max_batch_size: Most requests to run in one batch
+            max_wait: Longest time in seconds to wait for a batch to fill up
+            max_answer_length: Number of words to generate, for the sequence output format
+            prefix_cache: A streaming_inference.PrefixCache for the model, or None
+        """
+        self.m = m
+        self.buckets = sorted(buckets)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_answer_length = max_answer_length
+        self.prefix_cache = prefix_cache
+        self.output_format = getattr(m.output_format, "name", m.output_format)
+        self._pending = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def bucket_size(self, num_sentences):
+        if len(self.buckets) == 0 or num_sentences > self.buckets[-1]:
+            return num_sentences
+        return self.buckets[ggtnn_graph_parse.get_bucket_index(self.buckets, num_sentences)]
+
+    def submit(self, sentences, query, snap=True, return_graph=False):
+        """
+        Queue a story to be answered
+
+        Params:
+            sentences: Word indices of shape (n_sentences, sentence_length)
+            query: Word indices of shape (sentence_length,)
+            snap: Whether to use snap_test (otherwise fuzzy_test)
+            return_graph: Whether to include the graph after the last sentence in the result
+
+        Returns: A concurrent.futures.Future, whose result is a tuple of the output for the
+            query, and the (node_strengths, node_ids, edge_strengths) of the graph, or None
+        """
+        request = InferenceRequest(sentences, query, snap, return_graph, concurrent.futures.Future(), time.time())
+        key = (self.bucket_size(len(sentences)), snap)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Batcher is closed")
+            self._pending.setdefault(key, []).append(request)
+            self._cond.notify()
+        return request.future
+
+    def _next_batch(self):
+        """
+        Wait until a batch is ready, and take it from the queue. Returns None once closed.
+        """
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                now = time.time()
+                deadlines = {key: reqs[0].arrival + self.max_wait for key, reqs in self._pending.items()}
+                ready = [key for key, reqs in self._pending.items()
+                         if len(reqs) >= self.max_batch_size or deadlines[key] <= now]
+                if len(ready) > 0:
+                    # The batch whose oldest request has waited longest goes first
+                    key = min(ready, key=lambda k: deadlines[k])
+                    reqs = self._pending[key]
+                    batch, rest = reqs[:self.max_batch_size], reqs[self.max_batch_size:]
+                    if len(rest) > 0:
+                        self._pending[key] = rest
+                    else:
+                        del self._pending[key]
+                    return key, batch
+                self._cond.wait(min(deadlines.values()) - now if len(deadlines) > 0 else None)
+
+    def _work(self):
+        while True:
+            found = self._next_batch()
+            if found is None:
+                return
+            (bucket_size, snap), batch = found
+            try:
+                results = self._run_batch(bucket_size, snap, batch)
+            except Exception as e:
+                self.num_errors += len(batch)
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            done = time.time()
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            for request, result in zip(batch, results):
+                self._latencies.append(done - request.arrival)
+                request.future.set_result(result)
+
+    def _run_batch(self, bucket_size, snap, batch):
+        if self.prefix_cache is not None and snap == self.prefix_cache.snap:
+            return [self._run_cached(request) for request in batch]
+        n_batch = len(batch)
+        sentence_length = batch[0].query.shape[0]
+        sents = np.zeros([n_batch, bucket_size, sentence_length], np.int32)
+        for i, request in enumerate(batch):
+            sents[i,:len(request.sentences)] = request.sentences
+        queries = np.stack([request.query for request in batch])
+        if self.m.multi_query:
+            # One query per story, asked after its last sentence
+            positions = np.array([[len(request.sentences)] for request in batch], np.int32)
+            args = [sents, queries[:,None,:], positions]
+        else:
+            args = [sents, queries]
+        if self.output_format == "sequence":
+            args.append(self.max_answer_length + 1)
+        fn = self.m.snap_test if snap else self.m.fuzzy_test
+        final_output, node_strengths, node_ids, _, edge_strengths = fn(*args)
+        if self.m.multi_query:
+            final_output = final_output[:,0]
+
+        results = []
+        for i, request in enumerate(batch):
+            graph = None
+            if request.return_graph:
+                # With masked padding, a story's graph stops changing after its last sentence.
+                # Otherwise the padding sentences are run too, and the answer uses the final graph.
+                step = (len(request.sentences) if self.m.mask_padding else bucket_size) - 1
+                graph = (node_strengths[i,step], node_ids[i,step], edge_strengths[i,step])
+            results.append((final_output[i], graph))
+        return results
+
+    def _run_cached(self, request):
+        session = self.prefix_cache.start(request.sentences)
+        output = session.ask(request.query, self.max_answer_length + 1)
+        graph = None
+        if request.return_graph:
+            node_strengths, node_ids, _, edge_strengths = session.graph_state
+            graph = (node_strengths[0], node_ids[0], edge_strengths[0])
+        return output, graph
+
+    def queue_depth(self):
+        with self._cond:
+            return sum(len(reqs) for reqs in self._pending.values())
+
+    def stats(self):
+        """
+        Get a dict of queue and latency statistics. Latencies are measured from
+        submission to completion, over the most recent LATENCY_WINDOW requests.
+        """
+        latencies = np.array(list(self._latencies)) * 1000
+        stats = collections.OrderedDict([
+            ("queue_depth", self.queue_depth()),
+            ("requests", self.num_requests),
+            ("batches", self.num_batches),
+            ("errors", self.num_errors),
+            ("mean_batch_size", self.num_requests/self.num_batches if self.num_batches > 0 else 0.0),
+        ])
+        for pct in (50, 90, 99):
+            stats["latency_p{}_ms".format(pct)] = float(np.percentile(latencies, pct)) if len(latencies) > 0 else 0.0
+        stats["latency_max_ms"] = float(np.max(latencies)) if len(latencies) > 0 else 0.0
+        if self.prefix_cache is not None:
+            stats.update(self.prefix_cache.stats())
+        return stats
+
+    def close(self):
+        """
+        Stop the worker thread. Requests that are still queued are cancelled.
+        """
+        with self._cond:
+            self._closed = True
+            pending = [r for reqs in self._pending.values() for r in reqs]
+            self._pending.clear()
+            self._cond.notify()
+        for request in pending:
+            request.future.cancel()
+        self._thread.join()
+
+class _RequestHandler( socketserver.StreamRequestHandler ):
+    """
+    Reads requests as lines of JSON, and writes a line of JSON in response to each one
+    """
+    def handle(self):
+        for line in self.rfile:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                response = self.server.handle_request(json.loads(line.decode('utf-8')))
+            except (ValueError, KeyError, TypeError, concurrent.futures.CancelledError) as e:
+                response = {"error": "{}: {}".format(type(e).__name__, e)}
+            self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+            self.wfile.flush()
+
+class InferenceServer( socketserver.ThreadingMixIn, socketserver.UnixStreamServer ):
+    """
+    Answers stories sent over a Unix socket, one connection thread per client, with
+    requests from all connections batched together by a DynamicBatcher.
+
+    Each request is a JSON object on its own line, of the form
+        {"story": [sentence, ...], "query": sentence, "snap": true, "graph": false}
+    where sentences are strings or lists of words. The response is
+        {"answer": [word, ...], "graph": {"nodes": [...], "edges": [...]}}
+    with "graph" only present if requested, or {"error": message}. The request
+    {"command": "stats"} returns the batcher statistics instead.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, encoder, batcher, graph_threshold=0.5):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+        self.encoder = encoder
+        self.batcher = batcher
+        self.graph_threshold = graph_threshold
+
+    def handle_request(self, request):
+        if request.get("command") == "stats":
+            return self.batcher.stats()
+        sentences = self.encoder.encode_story(request["story"])
+        query = np.array(self.encoder.encode_sentence(request["query"]), np.int32)
+        future = self.batcher.submit(sentences, query, bool(request.get("snap", True)), bool(request.get("graph", False)))
+        output, graph = future.result()
+        response = {"answer": self.encoder.decode_answer(output)}
+        if graph is not None:
+            response["graph"] = self.encoder.decode_graph(*graph, threshold=self.graph_threshold)
+        return response
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+def query_server(socket_path, request):
+    """
+    Send one request to a running server and return its response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
+
+def main(outputdir, task_dir, socket_path, backend, paramfile, function_cache_dir, max_batch_size, max_wait_ms, max_answer_length, graph_threshold, stats_interval, prefix_cache_mb):
+    with open(os.path.join(task_dir,'metadata.p'),'rb') as f:
+        metadata = pickle.load(f)
+    start_time = time.time()
+    needed_functions = ["snap_test_fn", "fuzzy_test_fn"]
+    if prefix_cache_mb is not None:
+        needed_functions.extend(["snap_step_fn", "snap_query_fn"])
+    m = load_model(outputdir, paramfile, backend, function_cache_dir, needed_functions)
+    assert m.train_with_query, "Model was not trained to answer queries"
+    print("Loaded model in {:.3f} seconds".format(time.time() - start_time))
+
+    if prefix_cache_mb is not None:
+        # Imported here, since streaming_inference itself uses this module
+        import streaming_inference
+        prefix_cache = streaming_inference.PrefixCache(m, prefix_cache_mb*1024*1024)
+    else:
+        prefix_cache = None
+    batcher = DynamicBatcher(m, metadata.buckets, max_batch_size, max_wait_ms/1000, max_answer_length, prefix_cache)
+    encoder = StoryEncoder(metadata, batcher.output_format)
+    server = InferenceServer(socket_path, encoder, batcher, graph_threshold)
+    print("Listening on {}".format(socket_path))
+    if stats_interval is not None:
+        def report():
+            while True:
+                time.sleep(stats_interval)
+                print(json.dumps(batcher.stats()), flush=True)
+        threading.Thread(target=report, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+parser = argparse.ArgumentParser(description='Serve a trained model over a Unix socket, batching concurrent requests together.')
+parser.add_argument('outputdir', help="Output directory of the training run, with model_kwargs.json and params files")
+parser.add_argument('task_dir', help="Parsed directory of the dataset the model was trained on, for its metadata")
+parser.add_argument('--socket', dest="socket_path", default="ggtnn.sock", help="Path of the Unix socket to listen on")
+parser.add_argument('--backend', choices=["theano", "numpy"], default="theano", help="Run the model with Theano, or with numpy_inference")
+parser.add_argument('--params', dest="paramfile", default=None, help="Params file to load. Defaults to the latest one in outputdir")
+parser.add_argument('--function-cache', dest="function_cache_dir", default=None, help="Directory of compiled functions to reuse, as in main.py")
+parser.add_argument('--max-batch-size', type=int, default=32, help="Most requests to run in one batch")
+parser.add_argument('--max-wait-ms', type=float, default=10, help="Longest time to wait for more requests before running a batch")
+parser.add_argument('--max-answer-length', type=int, default=5, help="Number of words to generate, for the sequence output format")
+parser.add_argument('--graph-threshold', type=float, default=0.5, help="Leave out nodes and edges with strength at most this from returned graphs")
+parser.add_argument('--prefix-cache-mb', type=float, default=None, help="Cache the snapped graph state after each story prefix, using at most this many megabytes, and resume stories from their longest cached prefix")
+parser.add_argument('--stats-interval', type=float, default=None, help="Print queue and latency statistics every this many seconds")
+
+if __name__ == '__main__':
+    args = vars(parser.parse_args())
+    main(**args)
@@ -46,6 +46,42 @@ class Layer(object):
         else:
             return self.activation( xW + b )
 
+    def process_split_input(self, ipt_parts, dropout_masks=Ellipsis):
+        """
+        Process an input given as a list of parts, which would be concatenated along the last
+        axis to form the real input. Each part is multiplied by its own rows of the weight
+        matrix, and the products are broadcast-added, so parts can have different (broadcastable)
+        shapes and the concatenated input is never built.
+
+        Params:
+            ipt_parts: List of tensors with the same number of dimensions, whose last axis sizes
+                add up to input_size
+        """
+        if dropout_masks is Ellipsis:
+            dropout_masks = None
+            append_masks = False
+        else:
+            append_masks = True
+        if self.dropout_keep != 1 and dropout_masks not in ([], None):
+            mask = dropout_masks[0].flatten()
+            dropout_masks = dropout_masks[1:]
+        else:
+            mask = None
+        xW = None
+        start = 0
+        for part in ipt_parts:
+            stop = start + part.shape[-1]
+            if mask is not None:
+                part = apply_dropout(part, mask[start:stop])
+            part_xW = T.dot(part, self._W[start:stop])
+            xW = part_xW if xW is None else xW + part_xW
+            start = stop
+        b = self._b
+        if append_masks:
+            return self.activation( xW + b ), dropout_masks
+        else:
+            return self.activation( xW + b )
+
 class LayerStack(object):
     def __init__(self, input_size, output_size, hidden_sizes=[], bias_shift=0.0, name=None, hidden_activation=T.tanh, activation=identity, dropout_keep=1, dropout_input=True, dropout_output=False):
         self.input_size = input_size
@@ -105,5 +141,33 @@ class LayerStack(object):
         else:
             return val
 
+    def process_split_input(self, ipt_parts, dropout_masks=Ellipsis):
+        """
+        Like process, but with the input given as a list of parts to be concatenated along
+        the last axis, which may have different broadcastable shapes. See
+        Layer.process_split_input. The result has the broadcasted shape of the parts,
+        with the last axis of size output_size.
+        """
+        if dropout_masks is Ellipsis:
+            dropout_masks = None
+            append_masks = False
+        else:
+            append_masks = True
+        first_layer = self.layers[0]
+        val, dropout_masks = first_layer.process_split_input(ipt_parts, dropout_masks)
+        ndim = val.ndim
+        lead_shape = val.shape[:-1]
+        val = val.reshape([-1, first_layer.output_size])
+        for layer in self.layers[1:]:
+            val, dropout_masks = layer.process(val, dropout_masks)
+        if self.dropout_keep != 1 and self.dropout_output and dropout_masks not in ([], None):
+            val = apply_dropout(val, dropout_masks[0])
+            dropout_masks = dropout_masks[1:]
+        val = val.reshape(T.concatenate([lead_shape, [self.output_size]]), ndim=ndim)
+        if append_masks:
+            return val, dropout_masks
+        else:
+            return val
+
 
 
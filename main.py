@@ -8,6 +8,9 @@ import sys
 import model
 import ggtnn_train
 import ggtnn_graph_parse
+import packed_dataset
+import function_cache
+import numpy_inference
 from ggtnn_graph_parse import MetadataList, PreppedStory
 from util import *
 
@@ -27,16 +30,16 @@ def helper_trim(bucketed, desired_total):
     trimmed_bucketed = [b[:amt] for b,amt in zip(bucketed, keep_amts)]
     return trimmed_bucketed
 
-def main(task_dir, output_format_str, state_width, process_repr_size, dynamic_nodes, mutable_nodes, wipe_node_state, direct_reference, propagate_intermediate, sequence_aggregate_repr, old_aggregate, train_with_graph, train_with_query, outputdir, num_updates, batch_size, learning_rate, dropout_keep, resume, resume_auto, visualize, visualize_snap, visualization_test, validation, validation_interval, evaluate_accuracy, check_mode, stop_at_accuracy, stop_at_loss, stop_at_overfitting, restrict_dataset, train_save_params, batch_adjust, set_exit_status, just_compile, autopickle, pickle_model, unpickle_model, interrupt_file):
+def main(task_dir, output_format_str, state_width, process_repr_size, dynamic_nodes, mutable_nodes, wipe_node_state, direct_reference, propagate_intermediate, sequence_aggregate_repr, old_aggregate, train_with_graph, train_with_query, mask_padding, dedup_sentences, compact_nodes, node_matching_str, outputdir, num_updates, batch_size, learning_rate, dropout_keep, resume, resume_auto, visualize, visualize_snap, visualization_test, validation, validation_interval, evaluate_accuracy, check_mode, stop_at_accuracy, stop_at_loss, stop_at_overfitting, restrict_dataset, train_save_params, batch_adjust, set_exit_status, just_compile, autopickle, function_cache_dir, compile_workers, specialize_buckets, unroll_max, pickle_model, unpickle_model, interrupt_file, prefetch, story_cache_mb):
     output_format = model.ModelOutputFormat[output_format_str]
 
     with open(os.path.join(task_dir,'metadata.p'),'rb') as f:
         metadata = pickle.load(f)
-    with open(os.path.join(task_dir,'file_list.p'),'rb') as f:
-        bucketed = pickle.load(f)
-        bucketed = [[os.path.join(task_dir,x) for x in b] for b in bucketed]
+    bucketed = packed_dataset.load_bucketed(task_dir)
     if restrict_dataset is not None:
         bucketed = helper_trim(bucketed, restrict_dataset)
+    if story_cache_mb > 0:
+        ggtnn_train.enable_story_cache(story_cache_mb * 1024 * 1024)
 
     sentence_length, new_nodes_per_iter, bucket_sizes, wordlist, anslist, graph_node_list, graph_edge_list = metadata
     eff_anslist = ggtnn_train.get_effective_answer_words(anslist, output_format)
@@ -47,9 +50,8 @@ def main(task_dir, output_format_str, state_width, process_repr_size, dynamic_no
     else:
         with open(os.path.join(validation,'metadata.p'),'rb') as f:
             validation_metadata = pickle.load(f)
-        with open(os.path.join(validation,'file_list.p'),'rb') as f:
-            validation_buckets = pickle.load(f)
-            validation_buckets = [[os.path.join(validation,x) for x in b] for b in validation_buckets]
+        validation_buckets = packed_dataset.load_bucketed(validation)
+        assert packed_dataset.is_multi_query(validation_buckets) == packed_dataset.is_multi_query(bucketed), "Validation set must use the same query format as the training set"
         validation_bucket_sizes = validation_metadata[2]
 
     if direct_reference:
@@ -80,14 +82,55 @@ def main(task_dir, output_format_str, state_width, process_repr_size, dynamic_no
                     dropout_keep=dropout_keep,
                     use_old_aggregate=old_aggregate,
                     best_node_match_only=True,
+                    node_matching=model.NodeMatching[node_matching_str],
                     train_with_graph=train_with_graph,
                     train_with_query=train_with_query,
+                    mask_padding=mask_padding,
+                    compact_nodes=compact_nodes,
+                    dedup_sentences=dedup_sentences,
+                    multi_query=packed_dataset.is_multi_query(bucketed),
                     setup=True,
                     check_mode=check_mode)
 
     model_kwargs = get_compatible_kwargs(model.Model, model_kwargs)
 
-    if autopickle is not None:
+    # Each mode only compiles the functions it uses
+    if visualize is not False:
+        needed_functions = ["snap_test_fn" if visualize_snap else "fuzzy_test_fn"]
+    elif evaluate_accuracy:
+        needed_functions = ["snap_test_fn" if train_with_query else "eval_fn"]
+    elif visualization_test:
+        needed_functions = ["debug_test_fn"]
+    else:
+        needed_functions = ["train_fn"]
+        if validation is not None:
+            needed_functions.append("eval_fn")
+            if train_with_query:
+                needed_functions.append("snap_test_fn")
+
+    # Training and accuracy evaluation can use functions specialised to each bucket's sentence count
+    if specialize_buckets and visualize is False and not visualization_test:
+        specialized_lengths = list(bucket_sizes) + list(validation_bucket_sizes or [])
+    else:
+        specialized_lengths = []
+
+    def compile_needed(m):
+        m.specialize(specialized_lengths, unroll_max)
+        return m.compile_functions(needed_functions, compile_workers)
+
+    if function_cache_dir is not None:
+        cache = function_cache.FunctionCache(function_cache_dir)
+        print("Looking for cached functions with key {}".format(cache.key(model_kwargs)))
+        m = cache.load(model_kwargs)
+        if m is not None:
+            print("Loaded compiled functions from cache: {}".format(", ".join(sorted(m.compiled_functions.keys()))))
+        else:
+            print("Building model from scratch")
+            m = model.Model(**model_kwargs)
+        if len(compile_needed(m)) > 0:
+            print("Saving compiled functions to cache")
+            cache.save(m, model_kwargs)
+    elif autopickle is not None:
         if not os.path.exists(autopickle):
             os.makedirs(autopickle)
         model_hash = object_hash(model_kwargs)
@@ -100,14 +143,17 @@ def main(task_dir, output_format_str, state_width, process_repr_size, dynamic_no
         else:
             print("Building model from scratch")
             m = model.Model(**model_kwargs)
+        if len(compile_needed(m)) > 0:
             print("Saving model to cache")
             sys.setrecursionlimit(100000)
             pickle.dump((m,model_kwargs), open(model_filename,'wb'), protocol=pickle.HIGHEST_PROTOCOL)
     elif unpickle_model is not None:
         print("Unpickling model...")
         m = pickle.load(open(unpickle_model, 'rb'))
+        compile_needed(m)
     else:
         m = model.Model(**model_kwargs)
+        compile_needed(m)
 
     if pickle_model is not None:
         sys.setrecursionlimit(100000)
@@ -122,6 +168,8 @@ def main(task_dir, output_format_str, state_width, process_repr_size, dynamic_no
 
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
+    # Lets numpy_inference load the trained model without Theano
+    numpy_inference.save_model_kwargs(model_kwargs, os.path.join(outputdir, numpy_inference.MODEL_KWARGS_FILE))
 
     if resume_auto:
         result = find_recent_params(outputdir)
@@ -158,7 +206,7 @@ def main(task_dir, output_format_str, state_width, process_repr_size, dynamic_no
         print("Wrote visualization files to {}.".format(outputdir))
     else:
         print("Starting to train...")
-        status = ggtnn_train.train(m, bucketed, bucket_sizes, len(eff_anslist), output_format, num_updates, outputdir, start_idx, batch_size, validation_buckets, validation_bucket_sizes, stop_at_accuracy, stop_at_loss, stop_at_overfitting, train_save_params, validation_interval, batch_adjust, interrupt_file)
+        status = ggtnn_train.train(m, bucketed, bucket_sizes, len(eff_anslist), output_format, num_updates, outputdir, start_idx, batch_size, validation_buckets, validation_bucket_sizes, stop_at_accuracy, stop_at_loss, stop_at_overfitting, train_save_params, validation_interval, batch_adjust, interrupt_file, prefetch)
         if set_exit_status:
             sys.exit(status.value)
 
@@ -176,6 +224,10 @@ parser.add_argument('--sequence-aggregate-repr', action="store_true", help="Comp
 parser.add_argument('--old-aggregate', action="store_true", help="Use the old, incorrect aggregate function")
 parser.add_argument('--no-graph', dest='train_with_graph', action="store_false", help="Don't train using graph supervision")
 parser.add_argument('--no-query', dest='train_with_query', action="store_false", help="Don't train using query supervision")
+parser.add_argument('--node-matching', dest='node_matching_str', choices=[x.name for x in model.NodeMatching], default="permutations", help="How to match proposed nodes with correct nodes for the node loss. 'permutations' tries every ordering, which is slow when many nodes can be added at once")
+parser.add_argument('--compact-nodes', action="store_true", help="When training with graph supervision, only give node slots to nodes that are actually added")
+parser.add_argument('--no-mask-padding', dest='mask_padding', action="store_false", help="Process padding sentences at the end of shorter stories like normal sentences")
+parser.add_argument('--no-dedup-sentences', dest='dedup_sentences', action="store_false", help="Run every sentence through the input network, even if the same sentence appears elsewhere in the batch")
 parser.add_argument('--outputdir', default="output", help="Directory to save output in")
 parser.add_argument('--num-updates', default="10000", type=int, help="How many iterations to train")
 parser.add_argument('--batch-size', default="10", type=int, help="Batch size to use")
@@ -197,11 +249,17 @@ parser.add_argument('--stop-at-loss', type=float, default=None, help="Stop train
 parser.add_argument('--stop-at-overfitting', type=float, default=None, help="Stop training once validation loss is this many times higher than train loss")
 parser.add_argument('--batch-adjust', type=int, default=None, help="If set, ensure that size of edge matrix does not exceed this")
 parser.add_argument('--set-exit-status', action="store_true", help="Give info about training status in the exit status")
-parser.add_argument('--just-compile', action="store_true", help="Don't run the model, just compile it")
+parser.add_argument('--just-compile', action="store_true", help="Don't run the model, just compile the functions needed for training")
 parser.add_argument('--autopickle', metavar="PICKLEDIR", default=None, help="Automatically cache model in this directory")
+parser.add_argument('--function-cache', dest="function_cache_dir", metavar="CACHEDIR", default=None, help="Cache compiled functions (without parameter values) in this directory, keyed by the model options and Theano settings")
+parser.add_argument('--compile-workers', type=int, default=1, metavar="NUM_PROCESSES", help="Compile the needed functions concurrently in this many processes")
+parser.add_argument('--specialize-buckets', action="store_true", help="Compile a version of each function for the sentence count of each bucket, with a static graph capacity")
+parser.add_argument('--unroll-max', type=int, default=0, metavar="NUM_SENTENCES", help="With --specialize-buckets, unroll the sentence loop of buckets with at most this many sentences")
 parser.add_argument('--pickle-model', metavar="MODELFILE", default=None, help="Save the compiled model to a file")
 parser.add_argument('--unpickle-model', metavar="MODELFILE", default=None, help="Load the model from a file instead of compiling it from scratch")
 parser.add_argument('--interrupt-file', default=None, help="Interrupt training if this file appears")
+parser.add_argument('--story-cache-mb', type=int, default=0, metavar="MEGABYTES", help="Keep up to this many megabytes of decoded stories in memory. Set to 0 to disable the cache")
+parser.add_argument('--prefetch', type=int, default=4, metavar="NUM_BATCHES", help="Assemble up to this many training batches in the background. Set to 0 to assemble batches synchronously")
 resume_group = parser.add_mutually_exclusive_group()
 resume_group.add_argument('--resume', nargs=2, metavar=('TIMESTEP', 'PARAMFILE'), default=None, help='Where to restore from: timestep, and file to load')
 resume_group.add_argument('--resume-auto', action='store_true', help='Automatically restore from a previous run using output directory')
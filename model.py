@@ -6,9 +6,13 @@ import numpy as np
 import util
 
 from enum import Enum
+import io
+import sys
+import pickle
 import itertools
+import multiprocessing
 import transformation_modules as tfms
-from graph_state import GraphStateSpec, GraphState 
+from graph_state import GraphStateSpec, GraphState, CapacityGraphState
 from adam import Adam
 
 from theano.compile.nanguardmode import NanGuardMode
@@ -19,12 +23,103 @@ class ModelOutputFormat( Enum ):
     subset = 2
     sequence = 3
 
+class NodeMatching( Enum ):
+    # Try every assignment of proposed nodes to correct nodes
+    permutations = 1
+    # Greedily match the most likely (proposed, correct) pairs first
+    greedy = 2
+    # Sort correct nodes by id, with nonexistent nodes last, and match them in order
+    canonical = 3
+
+# Names of the compiled functions of a Model
+FUNCTION_NAMES = ("train_fn", "eval_fn", "debug_test_fn", "fuzzy_test_fn", "snap_test_fn")
+# Names of the compiled functions for incremental inference (see Model.step and Model.query).
+# These process a single sentence or query, so they are never specialised.
+INCREMENTAL_FUNCTION_NAMES = ("fuzzy_step_fn", "snap_step_fn", "fuzzy_query_fn", "snap_query_fn")
+# Increased whenever the inputs of the compiled functions change, so that functions cached by
+# older versions (see function_cache.py) are not reused
+FUNCTION_INPUTS_VERSION = 2
+
+def _graph_shared_variables(specs):
+    """
+    Get the shared variables used by the graphs of (inputs, outputs, updates) specs,
+    in a deterministic order
+    """
+    found = []
+    for inputs, outputs, updates in specs:
+        exprs = list(outputs) + ([v for pair in updates for v in pair] if updates else [])
+        for var in theano.gof.graph.inputs(exprs):
+            if isinstance(var, theano.compile.SharedVariable) and var not in found:
+                found.append(var)
+    return found
+
+class _SharedVariablePickler( pickle.Pickler ):
+    """
+    Pickles an object, storing shared variables (and their containers and storage
+    lists) as references to their position in shared_vars instead of copying them.
+    A compiled function has its own Container for each input, which only shares the
+    storage list of the shared variable's container, so that has to be a reference too.
+    """
+    def __init__(self, file, shared_vars):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self._ids = {}
+        for i, var in enumerate(shared_vars):
+            self._ids[id(var)] = ("var", i)
+            self._ids[id(var.container)] = ("container", i)
+            self._ids[id(var.container.storage)] = ("storage", i)
+
+    def persistent_id(self, obj):
+        return self._ids.get(id(obj))
+
+class _SharedVariableUnpickler( pickle.Unpickler ):
+    """
+    Unpickles an object pickled by _SharedVariablePickler, resolving references to
+    the shared variables in shared_vars
+    """
+    def __init__(self, file, shared_vars):
+        super().__init__(file)
+        self._shared_vars = shared_vars
+
+    def persistent_load(self, pid):
+        kind, i = pid
+        var = self._shared_vars[i]
+        if kind == "var":
+            return var
+        elif kind == "container":
+            return var.container
+        else:
+            return var.container.storage
+
+def shares_shared_storage(fn):
+    """
+    Check that a compiled function reads and updates its shared variables in place,
+    rather than private copies of them (as a function whose shared variables were
+    copied when it was pickled would)
+    """
+    return all(container.storage is ipt.variable.container.storage
+               for ipt, container in zip(fn.maker.inputs, fn.input_storage)
+               if isinstance(ipt.variable, theano.compile.SharedVariable))
+
+# Set by Model._compile_parallel before forking, so the workers inherit it
+_parallel_compile_job = None
+
+def _compile_in_worker(key):
+    """
+    Compile one function in a worker process, and return it pickled
+    """
+    m, specs, shared_vars = _parallel_compile_job
+    sys.setrecursionlimit(100000)
+    fn = m._compile(*specs[key])
+    f = io.BytesIO()
+    _SharedVariablePickler(f, shared_vars).dump(fn)
+    return f.getvalue()
+
 class Model( object ):
     """
     Implements the gated graph transformer network model. 
     """
 
-    def __init__(self, num_input_words, num_output_words, num_node_ids, node_state_size, num_edge_types, input_repr_size, output_repr_size, propose_repr_size, propagate_repr_size, new_nodes_per_iter, output_format, final_propagate, word_node_mapping={},  dynamic_nodes=True, nodes_mutable=True, wipe_node_state=True, best_node_match_only=True, intermediate_propagate=0, sequence_representation=False, dropout_keep=1, use_old_aggregate=False, train_with_graph=True, train_with_query=True, setup=True, check_mode=None, learning_rate=0.0002):
+    def __init__(self, num_input_words, num_output_words, num_node_ids, node_state_size, num_edge_types, input_repr_size, output_repr_size, propose_repr_size, propagate_repr_size, new_nodes_per_iter, output_format, final_propagate, word_node_mapping={},  dynamic_nodes=True, nodes_mutable=True, wipe_node_state=True, best_node_match_only=True, node_matching=NodeMatching.permutations, intermediate_propagate=0, sequence_representation=False, dropout_keep=1, use_old_aggregate=False, train_with_graph=True, train_with_query=True, mask_padding=True, compact_nodes=False, dedup_sentences=True, multi_query=False, setup=True, check_mode=None, learning_rate=0.0002):
         """
         Parameters:
             num_input_words: How many possible words in the input
@@ -41,7 +136,10 @@ class Model( object ):
             final_propagate: How many steps to propagate info for each input sentence
             word_node_mapping: Dictionary mapping word ids to node ids for direct reference in input
             best_node_match_only: If the network should only train on the ordering with the
-                best match
+                best match. Only used with NodeMatching.permutations
+            node_matching: Member of NodeMatching, giving how proposed nodes are matched with
+                correct nodes when computing node loss and accuracy. Permutations is
+                factorial in new_nodes_per_iter, but greedy and canonical are polynomial
             intermediate_propagate: How many steps to propagate info for each input sentence
             sequence_representation: If True, compute aggregate representation across whole sequence
                 of graphs instead of just based on last graph
@@ -53,6 +151,20 @@ class Model( object ):
             wipe_node_state: Whether to wipe node state at the query
             train_with_graph: If True, use the graph to train. Otherwise ignore the graph
             train_with_query: If True, use the query to train. Otherwise ignore the query
+            mask_padding: If True, padding sentences at the end of each story do not change
+                its graph or contribute to the loss, and sentences that are padding for
+                every story in a batch are skipped entirely
+            compact_nodes: If True, when using the correct graph, only nodes that are actually
+                added get a node slot, instead of reserving new_nodes_per_iter slots for each
+                sentence. Batches must be assembled with compacted edges (see
+                ggtnn_train.assemble_batch)
+            dedup_sentences: If True, each distinct sentence (or query) in a batch is only run
+                through the input transformation once, and the result is shared by every story
+                that contains it. A query that repeats a sentence shares its result too
+            multi_query: If True, each story has several queries, asked after different
+                sentences, as produced by ggtnn_graph_parse with --multi-query. The sentences
+                are processed once, and each query reads the graph as it was at its position.
+                Not compatible with sequence_representation
             setup: Whether or not to automatically set up the model
             check_mode: If 'nan', run in NaNGuardMode. If 'debug', run in DebugMode
         """
@@ -70,6 +182,7 @@ class Model( object ):
         self.final_propagate = final_propagate
         self.word_node_mapping = word_node_mapping
         self.best_node_match_only = best_node_match_only
+        self.node_matching = node_matching
         self.intermediate_propagate = intermediate_propagate
         self.sequence_representation = sequence_representation
         self.dropout_keep = dropout_keep
@@ -79,6 +192,11 @@ class Model( object ):
         self.wipe_node_state = wipe_node_state
         self.train_with_graph = train_with_graph
         self.train_with_query = train_with_query
+        self.mask_padding = mask_padding
+        self.compact_nodes = compact_nodes
+        self.dedup_sentences = dedup_sentences
+        self.multi_query = multi_query
+        assert not (multi_query and sequence_representation), "Multi-query stories cannot use a sequence representation"
         self.check_mode = check_mode
 
         AggregateRepresentationTransformation = tfms.AggregateRepresentationTransformationSoftmax \
@@ -141,6 +259,10 @@ class Model( object ):
         self.srng = theano.sandbox.rng_mrg.MRG_RandomStreams(np.random.randint(0, 1024))
         self.learning_rate_var = theano.shared(np.array(learning_rate, theano.config.floatX))
 
+        self._compiled_functions = {}
+        self._function_builders = None
+        self.specialized_lengths = []
+        self.unroll_limit = 0
         if setup:
             self.setup()
 
@@ -150,16 +272,36 @@ class Model( object ):
 
     def setup(self):
         """
-        Set up the model to train.
+        Set up the model to train. The functions are not compiled until they are first
+        used, or until compile_functions is called.
         """
 
-        # input_words: shape (n_batch, n_sentence, sentence_len)
-        input_words = T.itensor3()
-        n_batch, n_sentences, sentence_len = input_words.shape
-        # query_words: shape (n_batch, query_len)
-        query_words = T.imatrix()
-        # correct_output: shape (n_batch, ?, num_output_words)
-        correct_output = T.ftensor3()
+        if self.dedup_sentences:
+            # sentence_pool: shape (n_unique, sentence_len), the distinct sentences and queries of the batch
+            sentence_pool = T.imatrix()
+            # sentence_index: shape (n_batch, n_sentence), index into sentence_pool of each sentence
+            sentence_index = T.imatrix()
+            n_batch, n_sentences = sentence_index.shape
+            # query_index: shape (n_batch) (or (n_batch, n_queries) if multi_query), index into sentence_pool of each query
+            query_index = T.imatrix() if self.multi_query else T.ivector()
+            story_inputs = [sentence_pool, sentence_index, query_index]
+        else:
+            # input_words: shape (n_batch, n_sentence, sentence_len)
+            input_words = T.itensor3()
+            n_batch, n_sentences, sentence_len = input_words.shape
+            # query_words: shape (n_batch, query_len) (or (n_batch, n_queries, query_len) if multi_query)
+            query_words = T.itensor3() if self.multi_query else T.imatrix()
+            story_inputs = [input_words, query_words]
+        if self.multi_query:
+            # query_positions: shape (n_batch, n_queries), number of sentences before each query, or 0 for padding queries
+            query_positions = T.imatrix()
+            n_queries = query_positions.shape[1]
+            story_inputs.append(query_positions)
+            # correct_output: shape (n_batch, n_queries, ?, num_output_words)
+            correct_output = T.ftensor4()
+        else:
+            # correct_output: shape (n_batch, ?, num_output_words)
+            correct_output = T.ftensor3()
 
         # graph_num_new_nodes: shape(n_batch, n_sentence)
         graph_num_new_nodes = T.imatrix()
@@ -169,36 +311,15 @@ class Model( object ):
         graph_new_node_ids = T.ftensor4()
         # graph_new_edges: shape(n_batch, n_sentence, pad_graph_size, pad_graph_size, num_edge_types)
         graph_new_edges = T.TensorType('floatX', (False,)*5)()
-
-        def _build(with_correct_graph, snap_to_best, using_dropout, evaluate_accuracy):
-            info = {}
-            # Process each sentence, flattened to (?, sentence_len)
-            flat_input_words = input_words.reshape([-1, sentence_len])
-            flat_input_reprs, flat_ref_matrices = self.input_transformer.process(flat_input_words)
-            # flat_input_reprs of shape (?, input_repr_size)
-            # flat_ref_matrices of shape (?, num_node_ids, input_repr_size)
-            input_reprs = flat_input_reprs.reshape([n_batch, n_sentences, self.input_repr_size])
-            ref_matrices = flat_ref_matrices.reshape([n_batch, n_sentences, self.num_node_ids, self.input_repr_size])
-
-            query_repr, query_ref_matrix = self.input_transformer.process(query_words)
-
-            if using_dropout:
-                iter_dropouts = []
-                states_mask = util.make_dropout_mask((self.node_state_size,), self.dropout_keep, self.srng)
-                if self.nodes_mutable:
-                    iter_dropouts.extend(self.node_state_updater.dropout_masks(self.srng, states_mask))
-                if len(self.word_node_mapping) > 0:
-                    iter_dropouts.extend(self.direct_reference_updater.dropout_masks(self.srng, states_mask))
-                if self.intermediate_propagate != 0:
-                    iter_dropouts.extend(self.intermediate_propagator.dropout_masks(self.srng, states_mask))
-                if self.dynamic_nodes:
-                    iter_dropouts.extend(self.new_node_adder.dropout_masks(self.srng))
-                iter_dropouts.extend(self.edge_state_updater.dropout_masks(self.srng))
-            else:
-                iter_dropouts = []
-                states_mask = None
-
-            def _iter_fn(input_repr, ref_matrix, gstate, correct_num_new_nodes=None, correct_new_strengths=None, correct_new_node_ids=None, correct_edges=None, dropout_masks=None):
+        # sentence_lengths: shape (n_batch), number of non-padding sentences of each story
+        sentence_lengths = T.ivector()
+        lengths_input = [sentence_lengths] if self.mask_padding else []
+
+        def _make_iter_fn(with_correct_graph, snap_to_best, evaluate_accuracy, compacting):
+            """
+            Get a function that processes one sentence, updating a graph state
+            """
+            def _iter_fn(input_repr, ref_matrix, gstate, correct_num_new_nodes=None, correct_new_strengths=None, correct_new_node_ids=None, correct_edges=None, correct_placement=None, dropout_masks=None):
                 # If necessary, update node state
                 if self.nodes_mutable:
                     gstate, dropout_masks = self.node_state_updater.process(gstate, input_repr, dropout_masks)
@@ -218,41 +339,65 @@ class Model( object ):
                     # new_strengths and correct_new_strengths are of shape (n_batch, new_nodes_per_iter)
                     # new_ids and correct_new_node_ids are of shape (n_batch, new_nodes_per_iter, num_node_ids)
                     if with_correct_graph:
-                        perm_idxs = np.array(list(itertools.permutations(range(self.new_nodes_per_iter))))
-                        permuted_correct_str = correct_new_strengths[:,perm_idxs]
-                        permuted_correct_ids = correct_new_node_ids[:,perm_idxs]
-                        # due to advanced indexing, we should have shape (n_batch, permutation, new_nodes_per_iter, num_node_ids)
-                        ext_new_str = T.shape_padaxis(new_strengths,1)
-                        ext_new_ids = T.shape_padaxis(new_ids,1)
-                        strength_ll = permuted_correct_str * T.log(ext_new_str + util.EPSILON) + (1-permuted_correct_str) * T.log(1-ext_new_str + util.EPSILON)
-                        ids_ll = permuted_correct_ids * T.log(ext_new_ids  + util.EPSILON)
-                        reduced_perm_lls = T.sum(strength_ll, axis=2) + T.sum(ids_ll, axis=[2,3])
-                        if self.best_node_match_only:
-                            node_loss = -T.max(reduced_perm_lls, 1)
+                        if self.node_matching != NodeMatching.permutations:
+                            # pair_lls[b,i,j] is the log likelihood of proposed node i being correct node j
+                            # This has shape (n_batch, new_nodes_per_iter, new_nodes_per_iter)
+                            pair_correct_str = T.shape_padaxis(correct_new_strengths,1)
+                            pair_correct_ids = T.shape_padaxis(correct_new_node_ids,1)
+                            pair_new_str = T.shape_padright(new_strengths)
+                            pair_new_ids = T.shape_padaxis(new_ids,2)
+                            pair_strength_ll = pair_correct_str * T.log(pair_new_str + util.EPSILON) + (1-pair_correct_str) * T.log(1-pair_new_str + util.EPSILON)
+                            pair_ids_ll = T.sum(pair_correct_ids * T.log(pair_new_ids + util.EPSILON), axis=3)
+                            pair_lls = pair_strength_ll + pair_ids_ll
+                            if self.node_matching == NodeMatching.greedy:
+                                assignment = util.greedy_assignment(pair_lls, self.new_nodes_per_iter)
+                            elif self.node_matching == NodeMatching.canonical:
+                                sort_keys = T.argmax(correct_new_node_ids, 2) + T.cast(1-correct_new_strengths, 'int64') * self.num_node_ids
+                                assignment = util.sorted_assignment(sort_keys, self.new_nodes_per_iter)
+                            node_loss = -T.sum(assignment * pair_lls, axis=[1,2])
+                            if evaluate_accuracy:
+                                best_correct_str = T.batched_dot(assignment, correct_new_strengths)
+                                best_correct_ids = T.batched_dot(assignment, correct_new_node_ids)
                         else:
-                            full_ll = util.reduce_log_sum(reduced_perm_lls, 1)
-                            # Note that some of these permutations are identical, since we likely did not add the maximum
-                            # amount of nodes. Thus we will have added repeated elements here.
-                            # We have log(x+x+...+x) = log(kx), where k is the repetition factor and x is the probability we want
-                            # log(kx) = log(k) + log(x)
-                            # Our repetition factor k is given by (new_nodes_per_iter - correct_num_new_nodes)!
-                            # Recall that n! = gamma(n+1)
-                            # so log(x) = log(kx) - log(gamma(k+1))
-                            log_rep_factor = T.gammaln(T.cast(self.new_nodes_per_iter - correct_num_new_nodes + 1, 'floatX'))
-                            scaled_ll = full_ll - log_rep_factor
-                            node_loss = -scaled_ll
+                            perm_idxs = np.array(list(itertools.permutations(range(self.new_nodes_per_iter))))
+                            permuted_correct_str = correct_new_strengths[:,perm_idxs]
+                            permuted_correct_ids = correct_new_node_ids[:,perm_idxs]
+                            # due to advanced indexing, we should have shape (n_batch, permutation, new_nodes_per_iter, num_node_ids)
+                            ext_new_str = T.shape_padaxis(new_strengths,1)
+                            ext_new_ids = T.shape_padaxis(new_ids,1)
+                            strength_ll = permuted_correct_str * T.log(ext_new_str + util.EPSILON) + (1-permuted_correct_str) * T.log(1-ext_new_str + util.EPSILON)
+                            ids_ll = permuted_correct_ids * T.log(ext_new_ids  + util.EPSILON)
+                            reduced_perm_lls = T.sum(strength_ll, axis=2) + T.sum(ids_ll, axis=[2,3])
+                            if self.best_node_match_only:
+                                node_loss = -T.max(reduced_perm_lls, 1)
+                            else:
+                                full_ll = util.reduce_log_sum(reduced_perm_lls, 1)
+                                # Note that some of these permutations are identical, since we likely did not add the maximum
+                                # amount of nodes. Thus we will have added repeated elements here.
+                                # We have log(x+x+...+x) = log(kx), where k is the repetition factor and x is the probability we want
+                                # log(kx) = log(k) + log(x)
+                                # Our repetition factor k is given by (new_nodes_per_iter - correct_num_new_nodes)!
+                                # Recall that n! = gamma(n+1)
+                                # so log(x) = log(kx) - log(gamma(k+1))
+                                log_rep_factor = T.gammaln(T.cast(self.new_nodes_per_iter - correct_num_new_nodes + 1, 'floatX'))
+                                scaled_ll = full_ll - log_rep_factor
+                                node_loss = -scaled_ll
+                            if evaluate_accuracy:
+                                best_match_idx = T.argmax(reduced_perm_lls, 1)
+                                # should be of shape (n_batch), indexing the best permutation
+                                best_correct_str = permuted_correct_str[T.arange(n_batch), best_match_idx]
+                                best_correct_ids = permuted_correct_ids[T.arange(n_batch), best_match_idx]
                         if evaluate_accuracy:
-                            best_match_idx = T.argmax(reduced_perm_lls, 1)
-                            # should be of shape (n_batch), indexing the best permutation
-                            best_correct_str = permuted_correct_str[T.arange(n_batch), best_match_idx]
-                            best_correct_ids = permuted_correct_ids[T.arange(n_batch), best_match_idx]
                             snapped_strengths = util.independent_best(new_strengths)
                             snapped_ids = util.categorical_best(new_ids) * T.shape_padright(snapped_strengths)
                             close_strengths = T.all(T.isclose(best_correct_str, snapped_strengths), (1))
                             close_ids = T.all(T.isclose(best_correct_ids, snapped_ids), (1,2))
                             node_accuracy = T.and_(close_strengths, close_ids)
                         # now substitute in the correct nodes
-                        gstate = gstate.with_additional_nodes(correct_new_strengths, correct_new_node_ids)
+                        if compacting:
+                            gstate = gstate.with_placed_nodes(correct_new_strengths, correct_new_node_ids, correct_placement)
+                        else:
+                            gstate = gstate.with_additional_nodes(correct_new_strengths, correct_new_node_ids)
                     elif snap_to_best:
                         snapped_strengths = util.independent_best(new_strengths)
                         snapped_ids = util.categorical_best(new_ids)
@@ -288,11 +433,103 @@ class Model( object ):
                     return gstate
                 else:
                     return gstate
+            return _iter_fn
+
+        def _process_query(final_gstate, query_repr, query_ref_matrix, states_mask):
+            """
+            Update the graph with the query, then propagate and aggregate it
+
+            Returns: The graph state after the query update, the graph state after propagation,
+                and the aggregated representation of shape (n_batch, output_repr_size)
+            """
+            if self.wipe_node_state:
+                final_gstate = final_gstate.with_updates(node_states=T.zeros_like(final_gstate.node_states))
+
+            qnsu_dropout_masks = self.query_node_state_updater.dropout_masks(self.srng, states_mask)
+            query_gstate, _ = self.query_node_state_updater.process(final_gstate, query_repr, qnsu_dropout_masks)
+
+            if len(self.word_node_mapping) > 0:
+                qdru_dropout_masks = self.query_direct_reference_updater.dropout_masks(self.srng, states_mask)
+                query_gstate, _ = self.query_direct_reference_updater.process(query_gstate, query_ref_matrix, qdru_dropout_masks)
+
+            fp_dropout_masks = self.final_propagator.dropout_masks(self.srng, states_mask)
+            propagated_gstate, _ = self.final_propagator.process_multiple(query_gstate, self.final_propagate, fp_dropout_masks)
+
+            agg_dropout_masks = self.aggregator.dropout_masks(self.srng)
+            aggregated_repr, _ = self.aggregator.process(propagated_gstate, agg_dropout_masks)
+            return query_gstate, propagated_gstate, aggregated_repr
+
+        def _final_output(aggregated_repr, max_seq_len, snap_to_best):
+            if self.output_format == ModelOutputFormat.sequence:
+                final_output = self.output_processor.process(aggregated_repr, max_seq_len) # shape (n_batch, ?, num_output_words)
+            else:
+                final_output = self.output_processor.process(aggregated_repr)
+
+            if snap_to_best:
+                final_output = self.output_processor.snap_to_best(final_output)
+            return final_output
+
+        def _build(with_correct_graph, snap_to_best, using_dropout, evaluate_accuracy, static_sentences=None, unroll=False):
+            info = {}
+            # A function specialised to a fixed number of sentences has a static sentence count and
+            # graph capacity, and can have its sentence loop unrolled
+            n_steps = n_sentences if static_sentences is None else static_sentences
+            # Padding sentences at the end of the batch don't count toward the average graph loss
+            n_story_steps = T.max(sentence_lengths) if self.mask_padding else n_steps
+            # When teacher forcing with compact nodes, the graph has a fixed number of slots, given by
+            # the compacted edges, and new nodes are placed into the next free slots
+            compacting = self.compact_nodes and self.dynamic_nodes and with_correct_graph
+            if self.dedup_sentences:
+                # Process each distinct sentence or query once, then gather the results for every
+                # sentence and query of every story. The gradients are scattered back through the gather.
+                unique_reprs, unique_ref_matrices = self.input_transformer.process(sentence_pool)
+                flat_sentence_index = sentence_index.flatten()
+                flat_input_reprs = unique_reprs[flat_sentence_index]
+                flat_ref_matrices = unique_ref_matrices[flat_sentence_index]
+            else:
+                # Process each sentence, flattened to (?, sentence_len)
+                flat_input_words = input_words.reshape([-1, sentence_len])
+                flat_input_reprs, flat_ref_matrices = self.input_transformer.process(flat_input_words)
+            # flat_input_reprs of shape (?, input_repr_size)
+            # flat_ref_matrices of shape (?, num_node_ids, input_repr_size)
+            input_reprs = flat_input_reprs.reshape([n_batch, n_steps, self.input_repr_size])
+            ref_matrices = flat_ref_matrices.reshape([n_batch, n_steps, self.num_node_ids, self.input_repr_size])
+
+            if self.dedup_sentences:
+                query_repr = unique_reprs[query_index.flatten()]
+                query_ref_matrix = unique_ref_matrices[query_index.flatten()]
+            elif self.multi_query:
+                query_repr, query_ref_matrix = self.input_transformer.process(query_words.reshape([-1, query_words.shape[2]]))
+            else:
+                query_repr, query_ref_matrix = self.input_transformer.process(query_words)
+            # query_repr of shape (n_batch, input_repr_size), or (n_batch*n_queries, input_repr_size) if multi_query
+
+            if using_dropout:
+                iter_dropouts = []
+                states_mask = util.make_dropout_mask((self.node_state_size,), self.dropout_keep, self.srng)
+                if self.nodes_mutable:
+                    iter_dropouts.extend(self.node_state_updater.dropout_masks(self.srng, states_mask))
+                if len(self.word_node_mapping) > 0:
+                    iter_dropouts.extend(self.direct_reference_updater.dropout_masks(self.srng, states_mask))
+                if self.intermediate_propagate != 0:
+                    iter_dropouts.extend(self.intermediate_propagator.dropout_masks(self.srng, states_mask))
+                if self.dynamic_nodes:
+                    iter_dropouts.extend(self.new_node_adder.dropout_masks(self.srng))
+                iter_dropouts.extend(self.edge_state_updater.dropout_masks(self.srng))
+            else:
+                iter_dropouts = []
+                states_mask = None
+
+            _iter_fn = _make_iter_fn(with_correct_graph, snap_to_best, evaluate_accuracy, compacting)
 
             # Scan over each sentence
-            def _scan_fn(input_repr, *stuff): # (input_repr, [ref_matrix?], [*correct_graph_stuff?], [dropout_masks?], *flat_graph_state, pad_graph_size)
+            def _scan_fn(input_repr, *stuff): # (input_repr, [step_mask?], [ref_matrix?], [*correct_graph_stuff?], [dropout_masks?], *flat_graph_state, pad_graph_size)
                 stuff = list(stuff)
 
+                if self.mask_padding:
+                    step_mask = stuff[0]
+                    stuff = stuff[1:]
+
                 if len(self.word_node_mapping) > 0:
                     ref_matrix = stuff[0]
                     stuff = stuff[1:]
@@ -303,6 +540,12 @@ class Model( object ):
                     c_num_new_nodes, c_new_strengths, c_new_node_ids, c_edges = stuff[:4]
                     stuff = stuff[4:]
 
+                if compacting:
+                    c_placement = stuff[0]
+                    stuff = stuff[1:]
+                else:
+                    c_placement = None
+
                 if using_dropout:
                     dropout_masks = stuff[:len(iter_dropouts)]
                     stuff = stuff[len(iter_dropouts):]
@@ -311,14 +554,28 @@ class Model( object ):
 
                 flat_graph_state = stuff[:-1]
                 pad_graph_size = stuff[-1]
-                gstate = GraphState.unflatten_from_const_size(flat_graph_state)
+                # The scan state is kept in buffers of size pad_graph_size, which are updated in place
+                # rather than sliced out and padded again at every step
+                gstate = CapacityGraphState.unflatten_from_const_size(flat_graph_state)
 
                 if with_correct_graph:
-                    gstate, node_loss, edge_loss, overall_accuracy = _iter_fn(input_repr, ref_matrix, gstate, c_num_new_nodes, c_new_strengths, c_new_node_ids, c_edges, dropout_masks=dropout_masks)
+                    gstate, node_loss, edge_loss, overall_accuracy = _iter_fn(input_repr, ref_matrix, gstate, c_num_new_nodes, c_new_strengths, c_new_node_ids, c_edges, c_placement, dropout_masks=dropout_masks)
                 else:
                     gstate = _iter_fn(input_repr, ref_matrix, gstate, dropout_masks=dropout_masks)
 
                 retvals = gstate.flatten_to_const_size(pad_graph_size)
+                if self.mask_padding:
+                    # Stories that have already ended keep their previous graph. New node slots are still
+                    # added for the whole batch, but they stay at zero strength for those stories.
+                    retvals = [T.switch(T.shape_padright(step_mask, new_val.ndim-1), new_val, old_val)
+                                for new_val, old_val in zip(retvals[:-1], flat_graph_state[:-1])] + retvals[-1:]
+                    float_step_mask = T.cast(step_mask, 'floatX')
+                    if with_correct_graph:
+                        if self.dynamic_nodes:
+                            node_loss = node_loss * float_step_mask
+                        edge_loss = edge_loss * float_step_mask
+                        if evaluate_accuracy:
+                            overall_accuracy = T.or_(overall_accuracy, T.invert(step_mask))
                 if with_correct_graph:
                     if self.dynamic_nodes:
                         retvals.append(node_loss)
@@ -333,13 +590,26 @@ class Model( object ):
                 initial_gstate = GraphState.create_full_unique(n_batch, self.num_node_ids, self.node_state_size, self.num_edge_types)
 
             # Account for all nodes, plus the extra padding node to prevent GPU unpleasantness
-            if self.dynamic_nodes:
-                pad_graph_size = n_sentences * self.new_nodes_per_iter + 1
+            if compacting:
+                # The edges must be compacted (see packed_dataset.compact_edges), with a slot for each node
+                # of the largest story and the padding node, or new nodes would be placed in the wrong slots
+                compact_graph_size = T.max(T.sum(graph_num_new_nodes, 1)) + 1
+                pad_graph_size = theano.tensor.opt.Assert("Edges were not assembled with compact_nodes")(
+                    graph_new_edges.shape[2], T.eq(graph_new_edges.shape[2], compact_graph_size))
+            elif self.dynamic_nodes:
+                pad_graph_size = n_steps * self.new_nodes_per_iter + 1
             else:
                 pad_graph_size = self.num_node_ids
             outputs_info = initial_gstate.flatten_to_const_size(pad_graph_size)
+            if compacting:
+                # Every slot is part of the graph from the start, and new nodes are placed into empty ones
+                outputs_info[-1] = pad_graph_size
             prepped_input = input_reprs.dimshuffle([1,0,2])
             sequences = [prepped_input]
+            if self.mask_padding:
+                # step_masks: shape (n_sentences, n_batch), true for sentences that are part of each story
+                step_masks = T.lt(T.shape_padright(T.arange(n_steps)), T.shape_padleft(sentence_lengths))
+                sequences.append(step_masks)
             if len(self.word_node_mapping) > 0:
                 sequences.append(ref_matrices.dimshuffle([1,0,2,3]))
             if with_correct_graph:
@@ -347,6 +617,14 @@ class Model( object ):
                 sequences.append(graph_new_node_strengths.swapaxes(0,1))
                 sequences.append(graph_new_node_ids.swapaxes(0,1))
                 sequences.append(graph_new_edges.swapaxes(0,1))
+                if compacting:
+                    # placements: shape (n_batch, n_sentence, new_nodes_per_iter, pad_graph_size), giving
+                    # the slot of each new node. Nodes fill slots in order, after the initial padding node
+                    prev_num_new = T.cumsum(graph_num_new_nodes, 1) - graph_num_new_nodes
+                    new_node_slots = 1 + T.shape_padright(prev_num_new) + T.arange(self.new_nodes_per_iter)
+                    is_new_node = T.lt(T.arange(self.new_nodes_per_iter), T.shape_padright(graph_num_new_nodes))
+                    placements = T.eq(T.shape_padright(new_node_slots), T.arange(pad_graph_size)) * T.shape_padright(is_new_node)
+                    sequences.append(T.cast(placements, 'floatX').swapaxes(0,1))
 
                 if self.dynamic_nodes:
                     outputs_info.extend([None])
@@ -355,7 +633,11 @@ class Model( object ):
                 outputs_info.extend([None])
             if using_dropout:
                 sequences.extend(iter_dropouts)
-            all_scan_out, _ = theano.scan(_scan_fn, sequences=sequences, outputs_info=outputs_info, non_sequences=[pad_graph_size])
+            if unroll and len(iter_dropouts) == 0:
+                all_scan_out, _ = util.unrolled_scan(_scan_fn, sequences, outputs_info, [pad_graph_size], n_steps)
+            else:
+                # The dropout masks are passed to scan as sequences, so loops with dropout are not unrolled
+                all_scan_out, _ = theano.scan(_scan_fn, sequences=sequences, outputs_info=outputs_info, non_sequences=[pad_graph_size])
             graph_accurate_list = None
             if with_correct_graph:
                 if evaluate_accuracy:
@@ -368,14 +650,14 @@ class Model( object ):
                     node_loss, edge_loss = all_scan_out[-2:]
                     reduced_node_loss = T.sum(node_loss)/T.cast(n_batch, 'floatX')
                     reduced_edge_loss = T.sum(edge_loss)/T.cast(n_batch, 'floatX')
-                    avg_graph_loss = (reduced_node_loss + reduced_edge_loss)/T.cast(input_words.shape[1], 'floatX')
+                    avg_graph_loss = (reduced_node_loss + reduced_edge_loss)/T.cast(n_story_steps, 'floatX')
                     info["node_loss"]=reduced_node_loss
                     info["edge_loss"]=reduced_edge_loss
                 else:
                     all_flat_gstates = all_scan_out[:-1]
                     edge_loss = all_scan_out[-1]
                     reduced_edge_loss = T.sum(edge_loss)/T.cast(n_batch, 'floatX')
-                    avg_graph_loss = reduced_edge_loss/T.cast(input_words.shape[1], 'floatX')
+                    avg_graph_loss = reduced_edge_loss/T.cast(n_story_steps, 'floatX')
                     info["edge_loss"]=reduced_edge_loss
             else:
                 all_flat_gstates = all_scan_out
@@ -392,57 +674,58 @@ class Model( object ):
                 # nodes here!)
                 final_flat_gstate.append(all_flat_gstates[-1][-1])
                 # We also need to repeat query_repr and query_ref_matrix so that they broadcast together
-                query_repr = T.extra_ops.repeat(query_repr, n_sentences, 0)
-                query_ref_matrix = T.extra_ops.repeat(query_ref_matrix, n_sentences, 0)
+                query_repr = T.extra_ops.repeat(query_repr, n_steps, 0)
+                query_ref_matrix = T.extra_ops.repeat(query_ref_matrix, n_steps, 0)
+            elif self.multi_query:
+                # Each part of all_flat_gstates is of shape (n_sentences, n_batch, ...) except for the last.
+                # Pick out the graph after the last sentence before each query, giving (n_batch*n_queries, ...).
+                # As above, the last part is the size of the biggest graph, and earlier graphs are padded
+                # with zero-strength nodes
+                query_steps = T.maximum(query_positions.flatten() - 1, 0)
+                query_batch_idxs = T.extra_ops.repeat(T.arange(n_batch), n_queries, 0)
+                final_flat_gstate = [x[query_steps, query_batch_idxs] for x in all_flat_gstates[:-1]]
+                final_flat_gstate.append(all_flat_gstates[-1][-1])
             else:
                 # Extract last timestep
                 final_flat_gstate = [x[-1] for x in all_flat_gstates]
             final_gstate = GraphState.unflatten_from_const_size(final_flat_gstate)
 
             if self.train_with_query:
-                if self.wipe_node_state:
-                    final_gstate = final_gstate.with_updates(node_states=T.zeros_like(final_gstate.node_states))
-
-                qnsu_dropout_masks = self.query_node_state_updater.dropout_masks(self.srng, states_mask)
-                query_gstate, _ = self.query_node_state_updater.process(final_gstate, query_repr, qnsu_dropout_masks)
+                query_gstate, propagated_gstate, aggregated_repr = _process_query(final_gstate, query_repr, query_ref_matrix, states_mask)
 
-                if len(self.word_node_mapping) > 0:
-                    qdru_dropout_masks = self.query_direct_reference_updater.dropout_masks(self.srng, states_mask)
-                    query_gstate, _ = self.query_direct_reference_updater.process(query_gstate, query_ref_matrix, qdru_dropout_masks)
-
-                fp_dropout_masks = self.final_propagator.dropout_masks(self.srng, states_mask)
-                propagated_gstate, _ = self.final_propagator.process_multiple(query_gstate, self.final_propagate, fp_dropout_masks)
-
-                agg_dropout_masks = self.aggregator.dropout_masks(self.srng)
-                aggregated_repr, _ = self.aggregator.process(propagated_gstate, agg_dropout_masks) # shape (n_batch, output_repr_size)
-                
                 if self.sequence_representation:
                     # aggregated_repr is of shape (n_batch*n_sentences, repr_width)
                     # We want to split back to timesteps: (n_batch, n_sentences, repr_width)
-                    agg_repr_seq = aggregated_repr.reshape([n_batch, n_sentences, -1])
+                    agg_repr_seq = aggregated_repr.reshape([n_batch, n_steps, -1])
                     # Now collapse it to a summary representation
                     aggsum_dropout_masks = self.aggregate_summarizer.dropout_masks(self.srng)
                     aggregated_repr, _ = self.aggregate_summarizer.process(agg_repr_seq, aggsum_dropout_masks)
                     # At this point aggregated_repr is (n_batch, repr_width) as desired
 
-                max_seq_len = correct_output.shape[1]
-                if self.output_format == ModelOutputFormat.sequence:
-                    final_output = self.output_processor.process(aggregated_repr, max_seq_len) # shape (n_batch, ?, num_output_words)
+                if self.multi_query:
+                    # Flatten to (n_batch*n_queries, ?, num_output_words) to match the queries
+                    query_correct_output = correct_output.reshape(T.concatenate([[-1], correct_output.shape[2:]]), ndim=3)
                 else:
-                    final_output = self.output_processor.process(aggregated_repr)
-
-                if snap_to_best:
-                    final_output = self.output_processor.snap_to_best(final_output)
+                    query_correct_output = correct_output
+                max_seq_len = query_correct_output.shape[1]
+                final_output = _final_output(aggregated_repr, max_seq_len, snap_to_best)
 
                 if self.output_format == ModelOutputFormat.subset:
-                    elemwise_loss = T.nnet.binary_crossentropy(final_output, correct_output)
-                    query_loss = T.sum(elemwise_loss)
+                    elemwise_loss = T.nnet.binary_crossentropy(final_output, query_correct_output)
+                    query_loss = T.sum(elemwise_loss) if not self.multi_query else T.sum(elemwise_loss, [1,2])
                 else:
                     flat_final_output = final_output.reshape([-1, self.num_output_words])
-                    flat_correct_output = correct_output.reshape([-1, self.num_output_words])
+                    flat_correct_output = query_correct_output.reshape([-1, self.num_output_words])
                     timewise_loss = T.nnet.categorical_crossentropy(flat_final_output, flat_correct_output)
-                    query_loss = T.sum(timewise_loss)
-                query_loss = query_loss/T.cast(n_batch, 'floatX')
+                    query_loss = T.sum(timewise_loss) if not self.multi_query else T.sum(timewise_loss.reshape([final_output.shape[0], -1]), 1)
+                if self.multi_query:
+                    # Padding queries don't count, and each real query counts as much as the query of a
+                    # single-query story would
+                    query_mask = T.cast(T.gt(query_positions.flatten(), 0), 'floatX')
+                    query_loss = T.sum(query_loss * query_mask)/T.maximum(T.sum(query_mask), 1.0)
+                    final_output = final_output.reshape(T.concatenate([[n_batch, n_queries], final_output.shape[1:]]), ndim=4)
+                else:
+                    query_loss = query_loss/T.cast(n_batch, 'floatX')
                 info["query_loss"] = query_loss
             else:
                 final_output = T.zeros([])
@@ -454,12 +737,14 @@ class Model( object ):
                 full_loss = full_loss + query_loss
 
             if self.train_with_query:
-                adjusted_query_gstates = [ x.reshape(T.concatenate([[n_batch, n_sentences], x.shape[1:]]), ndim=(x.ndim+1))
-                                           if self.sequence_representation else T.shape_padaxis(x,1)
-                                           for x in query_gstate.flatten()]
-                adjusted_prop_gstates =  [ x.reshape(T.concatenate([[n_batch, n_sentences], x.shape[1:]]), ndim=(x.ndim+1))
-                                           if self.sequence_representation else T.shape_padaxis(x,1)
-                                           for x in propagated_gstate.flatten()]
+                if self.sequence_representation or self.multi_query:
+                    # Split the flattened batch back into (n_batch, n_sentences or n_queries, ...)
+                    n_per_story = n_queries if self.multi_query else n_steps
+                    adjust = lambda x: x.reshape(T.concatenate([[n_batch, n_per_story], x.shape[1:]]), ndim=(x.ndim+1))
+                else:
+                    adjust = lambda x: T.shape_padaxis(x,1)
+                adjusted_query_gstates = [adjust(x) for x in query_gstate.flatten()]
+                adjusted_prop_gstates =  [adjust(x) for x in propagated_gstate.flatten()]
                 full_flat_gstates = [T.concatenate([a.swapaxes(0,1),b,c],1)
                                         for a,b,c in zip(all_flat_gstates[:-1],
                                                          adjusted_query_gstates,
@@ -469,60 +754,353 @@ class Model( object ):
                 max_seq_len = T.iscalar()
             return full_loss, final_output, full_flat_gstates, graph_accurate_list, max_seq_len, info
 
-        train_loss, _, _, _, _, train_info = _build(self.train_with_graph, False, True, False)
-        adam_updates = Adam(train_loss, self.params, lr=self.learning_rate_var)
-
-        self.info_keys = list(train_info.keys())
-
-        print("Compiling...")
-
+        graph_inputs = [correct_output, graph_num_new_nodes, graph_new_node_strengths, graph_new_node_ids, graph_new_edges]
+
+        # Each builder builds the graph of a function, and returns (inputs, outputs, updates) for _compile.
+        # The builders take the static sentence count of a specialised function (see specialize)
+        def _build_train_fn(static_sentences=None, unroll=False):
+            train_loss, _, _, _, _, train_info = _build(self.train_with_graph, False, True, False, static_sentences, unroll)
+            adam_updates = Adam(train_loss, self.params, lr=self.learning_rate_var)
+            self.info_keys = list(train_info.keys())
+            return (story_inputs + graph_inputs + lengths_input,
+                    [train_loss]+list(train_info.values()),
+                    adam_updates)
+
+        def _build_eval_fn(static_sentences=None, unroll=False):
+            eval_loss, _, _, graph_accurate_list, _, eval_info = _build(self.train_with_graph, False, False, True, static_sentences, unroll)
+            self.eval_info_keys = list(eval_info.keys())
+            return (story_inputs + graph_inputs + lengths_input,
+                    [eval_loss, graph_accurate_list]+list(eval_info.values()),
+                    None)
+
+        def _build_debug_test_fn(static_sentences=None, unroll=False):
+            _, _, full_flat_gstates, _, _, _ = _build(self.train_with_graph, False, False, True, static_sentences, unroll)
+            return (story_inputs + graph_inputs + lengths_input,
+                    full_flat_gstates,
+                    None)
+
+        def _build_test_fn(snap_to_best, static_sentences=None, unroll=False):
+            test_loss, final_output, full_flat_gstates, _, max_seq_len, _ = _build(False, snap_to_best, False, False, static_sentences, unroll)
+            return (story_inputs + ([max_seq_len] if self.output_format == ModelOutputFormat.sequence else []) + lengths_input,
+                    [final_output] + full_flat_gstates,
+                    None)
+
+        # The incremental functions work on a compact graph state, holding only the nodes proposed so
+        # far instead of padding to the largest story: node_strengths, node_ids, node_states and
+        # edge_strengths, as from GraphState.flatten
+        compact_gstate_inputs = [T.fmatrix(), T.ftensor3(), T.ftensor3(), T.ftensor4()]
+        # step_words: shape (n_batch, sentence_len), one sentence of each story
+        step_words = T.imatrix()
+        # step_query_words: shape (n_batch, query_len)
+        step_query_words = T.imatrix()
+        step_max_seq_len = T.iscalar()
+
+        def _build_step_fn(snap_to_best):
+            input_repr, ref_matrix = self.input_transformer.process(step_words)
+            gstate = GraphState.unflatten(compact_gstate_inputs)
+            gstate = _make_iter_fn(False, snap_to_best, False, False)(input_repr, ref_matrix, gstate)
+            return ([step_words] + compact_gstate_inputs,
+                    gstate.flatten(),
+                    None)
+
+        def _build_query_fn(snap_to_best):
+            assert self.train_with_query, "Model was not trained to answer queries"
+            assert not self.sequence_representation, "Queries with a sequence representation need the graph after every sentence"
+            query_repr, query_ref_matrix = self.input_transformer.process(step_query_words)
+            _, _, aggregated_repr = _process_query(GraphState.unflatten(compact_gstate_inputs), query_repr, query_ref_matrix, None)
+            final_output = _final_output(aggregated_repr, step_max_seq_len, snap_to_best)
+            return ([step_query_words] + compact_gstate_inputs + ([step_max_seq_len] if self.output_format == ModelOutputFormat.sequence else []),
+                    final_output,
+                    None)
+
+        # Functions are only built and compiled when they are first used (see get_function)
+        self._function_builders = {
+            "train_fn": _build_train_fn,
+            "eval_fn": _build_eval_fn,
+            "debug_test_fn": _build_debug_test_fn,
+            "fuzzy_test_fn": lambda *args: _build_test_fn(False, *args),
+            "snap_test_fn": lambda *args: _build_test_fn(True, *args),
+            "fuzzy_step_fn": lambda: _build_step_fn(False),
+            "snap_step_fn": lambda: _build_step_fn(True),
+            "fuzzy_query_fn": lambda: _build_query_fn(False),
+            "snap_query_fn": lambda: _build_query_fn(True),
+        }
+
+    def _compile_mode(self):
         optimizer = theano.compile.predefined_optimizers['fast_run' if self.check_mode == 'debug' else theano.config.optimizer]
         optimizer = optimizer.excluding("scanOp_pushout_output","remove_constants_and_unused_inputs_scan")
         if self.check_mode == 'nan':
-            mode = NanGuardMode(optimizer=optimizer, nan_is_error=True, inf_is_error=True, big_is_error=True)
+            return NanGuardMode(optimizer=optimizer, nan_is_error=True, inf_is_error=True, big_is_error=True)
         elif self.check_mode == 'debug':
-            mode = DebugMode(optimizer=optimizer, check_isfinite=False, check_py_code=False, stability_patience=1)
             theano.tensor.TensorType.filter_checks_isfinite = False
+            return DebugMode(optimizer=optimizer, check_isfinite=False, check_py_code=False, stability_patience=1)
         else:
-            mode = theano.Mode(optimizer=optimizer)
-        self.train_fn = theano.function([input_words, query_words, correct_output, graph_num_new_nodes, graph_new_node_strengths, graph_new_node_ids, graph_new_edges],
-                                        [train_loss]+list(train_info.values()),
-                                        updates=adam_updates,
-                                        allow_input_downcast=True,
-                                        on_unused_input='ignore',
-                                        mode=mode)
-
-        eval_loss, _, full_flat_gstates, graph_accurate_list, _, eval_info = _build(self.train_with_graph, False, False, True)
-        self.eval_info_keys = list(eval_info.keys())
-        self.eval_fn = theano.function( [input_words, query_words, correct_output, graph_num_new_nodes, graph_new_node_strengths, graph_new_node_ids, graph_new_edges],
-                                        [eval_loss, graph_accurate_list]+list(eval_info.values()),
-                                        allow_input_downcast=True,
-                                        on_unused_input='ignore',
-                                        mode=mode)
-
-        self.debug_test_fn = theano.function( [input_words, query_words, correct_output, graph_num_new_nodes, graph_new_node_strengths, graph_new_node_ids, graph_new_edges],
-                                        full_flat_gstates,
-                                        allow_input_downcast=True,
-                                        on_unused_input='ignore',
-                                        mode=mode)
-
-        test_loss, final_output, full_flat_gstates, _, max_seq_len, _ = _build(False, False, False, False)
-        self.fuzzy_test_fn = theano.function( [input_words, query_words] + ([max_seq_len] if self.output_format == ModelOutputFormat.sequence else []),
-                                        [final_output] + full_flat_gstates,
-                                        allow_input_downcast=True,
-                                        on_unused_input='ignore',
-                                        mode=mode)
-
-        test_loss, final_output, full_flat_gstates, _, max_seq_len, _ = _build(False, True, False, False)
-        self.snap_test_fn = theano.function( [input_words, query_words] + ([max_seq_len] if self.output_format == ModelOutputFormat.sequence else []),
-                                        [final_output] + full_flat_gstates,
-                                        allow_input_downcast=True,
-                                        on_unused_input='ignore',
-                                        mode=mode)
+            return theano.Mode(optimizer=optimizer)
+
+    def _compile(self, inputs, outputs, updates=None):
+        return theano.function(inputs, outputs,
+                               updates=updates,
+                               allow_input_downcast=True,
+                               on_unused_input='ignore',
+                               mode=self._compile_mode())
+
+    def specialize(self, sentence_counts, unroll_limit=0):
+        """
+        Use functions specialised to a fixed number of sentences, usually the sizes of the
+        dataset's buckets, instead of the general functions. A specialised function has a
+        static sentence count and graph capacity, and if it has at most unroll_limit sentences,
+        its sentence loop is unrolled instead of using scan, which has a large per-step overhead.
+
+        If masking padding (and not using sequence_representation), each batch is padded to the
+        smallest specialised sentence count that fits it. Otherwise, a specialised function is
+        only used for batches with exactly its number of sentences. Other batches use the
+        general functions.
+        """
+        self.specialized_lengths = sorted(set(int(n) for n in sentence_counts))
+        self.unroll_limit = unroll_limit
+
+    def _specialized_length(self, n_sentences):
+        """
+        Get the sentence count of the specialised functions to use for a batch with
+        n_sentences sentences, or None to use the general functions
+        """
+        can_pad = self.mask_padding and not self.sequence_representation
+        for length in self.specialized_lengths:
+            if length == n_sentences or (can_pad and length > n_sentences):
+                return length
+        return None
+
+    def _function_key(self, name, n_sentences=None):
+        if n_sentences is None:
+            return name
+        return "{}@{}{}".format(name, n_sentences, "-unrolled" if n_sentences <= self.unroll_limit else "")
+
+    def _function_spec(self, name, n_sentences=None):
+        if self._function_builders is None:
+            # Builders are not pickled, so set them up again after unpickling
+            self.setup()
+        if n_sentences is None:
+            return self._function_builders[name]()
+        return self._function_builders[name](n_sentences, n_sentences <= self.unroll_limit)
+
+    def get_function(self, name, n_sentences=None):
+        """
+        Get one of the model's compiled functions (one of FUNCTION_NAMES or
+        INCREMENTAL_FUNCTION_NAMES), compiling it
+        first if it has not been used yet. If n_sentences is given, get the version
+        specialised to that many sentences.
+        """
+        key = self._function_key(name, n_sentences)
+        if key not in self._compiled_functions:
+            print("Compiling {}...".format(key))
+            self._compiled_functions[key] = self._compile(*self._function_spec(name, n_sentences))
+        return self._compiled_functions[key]
+
+    def compile_functions(self, names=FUNCTION_NAMES, workers=1):
+        """
+        Make sure the given functions are compiled, so that they are ready before they are
+        needed (and are included if the model is pickled). If specialised, compile the version
+        of each function for every specialised sentence count instead. If workers > 1, the
+        functions are compiled concurrently in that many worker processes.
+
+        Returns: The keys of the functions that were compiled by this call
+        """
+        lengths = self.specialized_lengths if len(self.specialized_lengths) > 0 else [None]
+        needed = [(name, n) for name in names for n in (lengths if name in FUNCTION_NAMES else [None])
+                  if self._function_key(name, n) not in self._compiled_functions]
+        if workers > 1 and len(needed) > 1:
+            self._compile_parallel(needed, workers)
+        else:
+            for name, n in needed:
+                self.get_function(name, n)
+        return [self._function_key(name, n) for name, n in needed]
+
+    def _compile_parallel(self, needed, workers):
+        """
+        Build the graphs of several functions in this process, then compile them at the same
+        time in forked worker processes. The workers share Theano's compiledir, which Theano
+        protects with its own lock, so the C code they compile is also cached for this process.
+        Each compiled function is sent back pickled, with the shared variables of the graphs
+        replaced by references, so the unpickled functions use this process's shared variables.
+        Since the workers are forked, this should not be used once a GPU context is active.
+
+        Params:
+            needed: List of (name, n_sentences) pairs, as for get_function
+        """
+        global _parallel_compile_job
+        keys = [self._function_key(name, n) for name, n in needed]
+        print("Compiling {} in {} processes...".format(", ".join(keys), min(workers, len(keys))))
+        specs = {key: self._function_spec(name, n) for key, (name, n) in zip(keys, needed)}
+        shared_vars = _graph_shared_variables(specs.values())
+        _parallel_compile_job = (self, specs, shared_vars)
+        try:
+            with multiprocessing.get_context("fork").Pool(min(workers, len(keys))) as pool:
+                pickled_fns = pool.map(_compile_in_worker, keys, chunksize=1)
+        finally:
+            _parallel_compile_job = None
+        sys.setrecursionlimit(100000)
+        for key, pickled_fn in zip(keys, pickled_fns):
+            fn = _SharedVariableUnpickler(io.BytesIO(pickled_fn), shared_vars).load()
+            assert shares_shared_storage(fn), "Compiled function {} is not connected to the model's shared variables".format(key)
+            self._compiled_functions[key] = fn
+
+    @property
+    def compiled_functions(self):
+        """
+        Dict of the functions that have been compiled so far
+        """
+        return dict(self._compiled_functions)
+
+    train_fn = property(lambda self: self.get_function("train_fn"))
+    eval_fn = property(lambda self: self.get_function("eval_fn"))
+    debug_test_fn = property(lambda self: self.get_function("debug_test_fn"))
+    fuzzy_test_fn = property(lambda self: self.get_function("fuzzy_test_fn"))
+    snap_test_fn = property(lambda self: self.get_function("snap_test_fn"))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_function_builders"] = None
+        return state
+
+    def get_sentence_lengths(self, input_words):
+        """
+        Get the number of sentences in each story of a batch, not counting
+        padding sentences (made entirely of the padding word) at the end.
+
+        Params:
+            input_words: Array of shape (n_batch, n_sentences, sentence_len)
+
+        Returns: Int array of shape (n_batch)
+        """
+        input_words = np.asarray(input_words)
+        nonpad = np.any(input_words != 0, axis=2)
+        lengths = nonpad.shape[1] - np.argmax(nonpad[:,::-1], axis=1)
+        # Every story runs for at least one sentence
+        return np.where(np.any(nonpad, axis=1), lengths, 1).astype(np.int32)
+
+    def _prepare_args(self, args, with_graph):
+        """
+        Convert a list of function arguments to the form the compiled functions expect.
+        If masking padding, trim sentences that are padding for every story in the batch,
+        and add the sentence lengths. If there is a specialised function for the batch, pad
+        the sentences up to its sentence count. If deduplicating sentences, replace the
+        sentences and queries with a single pool of their distinct rows, and the index of each
+        sentence and query in it.
+
+        Params:
+            args: Arguments, starting with input_words, query_words (and query_positions if
+                multi_query). If with_graph, followed by correct_output and the four graph arrays,
+                as produced by ggtnn_train.assemble_batch
+
+        Returns: The converted arguments, and the sentence count of the specialised function
+            to use (or None to use the general function)
+        """
+        args = list(args)
+        graph_start = 4 if self.multi_query else 3
+        if self.mask_padding:
+            lengths = self.get_sentence_lengths(args[0])
+            max_len = int(np.max(lengths))
+        else:
+            max_len = args[0].shape[1]
+        n_sentences = self._specialized_length(max_len)
+        # Sentences past the end of every story are masked, so the batch can be trimmed, or padded
+        # up to the sentence count of a specialised function, without changing the results
+        num_sentences = max_len if n_sentences is None else n_sentences
+        if self.mask_padding:
+            args[0] = util.pad_axis(args[0][:,:num_sentences], 1, num_sentences)
+            if with_graph:
+                num_new_nodes, new_node_strengths, new_node_ids, new_edges = args[graph_start:graph_start+4]
+                graph_size = num_sentences * self.new_nodes_per_iter + 1 if self.dynamic_nodes and not self.compact_nodes else new_edges.shape[2]
+                new_edges = new_edges[:,:num_sentences,:graph_size,:graph_size]
+                for axis, size in [(1, num_sentences), (2, graph_size), (3, graph_size)]:
+                    new_edges = util.pad_axis(new_edges, axis, size)
+                args[graph_start:graph_start+4] = [util.pad_axis(arr[:,:num_sentences], 1, num_sentences)
+                                                   for arr in (num_new_nodes, new_node_strengths, new_node_ids)] + [new_edges]
+        if self.mask_padding:
+            args.append(lengths)
+        if self.dedup_sentences:
+            # Sentences and queries are padded to the same length, so they share one pool, and a
+            # query that repeats a sentence is only processed once
+            sents, queries = args[0], args[1]
+            assert sents.shape[-1] == queries.shape[-1], "Sentences and queries must be padded to the same length"
+            all_rows = np.concatenate([sents.reshape([-1, sents.shape[-1]]), queries.reshape([-1, queries.shape[-1]])])
+            sentence_pool, all_index = util.unique_rows(all_rows)
+            sentence_index = all_index[:sents.shape[0]*sents.shape[1]].reshape(sents.shape[:-1])
+            query_index = all_index[sents.shape[0]*sents.shape[1]:].reshape(queries.shape[:-1])
+            args[0:2] = [sentence_pool, sentence_index, query_index]
+        return args, n_sentences
+
+    def _call(self, name, args, with_graph, **kwargs):
+        """
+        Call a compiled function on a batch, using the specialised version if there is one
+        """
+        args, n_sentences = self._prepare_args(args, with_graph)
+        return self.get_function(name, n_sentences)(*args, **kwargs)
+
+    def debug_test(self, *args):
+        return self._call("debug_test_fn", args, True)
+
+    def fuzzy_test(self, *args):
+        return self._call("fuzzy_test_fn", args, False)
+
+    def snap_test(self, *args):
+        return self._call("snap_test_fn", args, False)
+
+    def initial_graph_state(self, n_batch=1):
+        """
+        Get the compact graph state of stories before their first sentence, for step
+
+        Returns: List of the node_strengths, node_ids, node_states and edge_strengths arrays,
+            with no padding nodes, for a batch of n_batch stories
+        """
+        K, D, E = self.num_node_ids, self.node_state_size, self.num_edge_types
+        floatX = theano.config.floatX
+        if self.dynamic_nodes:
+            # As GraphState.create_empty, a single zero-strength node
+            return [np.zeros([n_batch, 1], floatX), np.zeros([n_batch, 1, K], floatX),
+                    np.zeros([n_batch, 1, D], floatX), np.zeros([n_batch, 1, 1, E], floatX)]
+        else:
+            return [np.ones([n_batch, K], floatX), np.tile(np.eye(K, dtype=floatX), (n_batch, 1, 1)),
+                    np.zeros([n_batch, K, D], floatX), np.zeros([n_batch, K, K, E], floatX)]
+
+    def step(self, sentence_words, graph_state, snap=True):
+        """
+        Process one more sentence of each story in a batch, starting from the graph state
+        after the sentences before it. Unlike the test functions, which run the whole
+        story, this only runs the new sentence.
+
+        Params:
+            sentence_words: Array of shape (n_batch, sentence_len)
+            graph_state: Compact graph state, from initial_graph_state or an earlier step
+            snap: Whether to snap the new nodes and edges, as snap_test does
+
+        Returns: The compact graph state after the sentence, with new_nodes_per_iter more nodes
+            if nodes are dynamic. When snapping, the nodes that were not added have zero strength,
+            and streaming_inference.prune_dead_nodes can remove them
+        """
+        return self.get_function("snap_step_fn" if snap else "fuzzy_step_fn")(sentence_words, *graph_state)
+
+    def query(self, query_words, graph_state, snap=True, max_seq_len=None):
+        """
+        Answer a query about each story in a batch, given the compact graph state after
+        its sentences so far (from step). Not available with sequence_representation.
+
+        Params:
+            query_words: Array of shape (n_batch, query_len)
+            graph_state: Compact graph state
+            snap: Whether to snap the output, as snap_test does
+            max_seq_len: Number of words to output, for the sequence output format
+
+        Returns: The output for each query, as in the first output of the test functions
+        """
+        args = [query_words] + list(graph_state)
+        if self.output_format == ModelOutputFormat.sequence:
+            args.append(max_seq_len)
+        return self.get_function("snap_query_fn" if snap else "fuzzy_query_fn")(*args)
 
     def train(self, *args, **kwargs):
         try:
-            stuff = self.train_fn(*args, **kwargs)
+            stuff = self._call("train_fn", args, True, **kwargs)
         except theano.compile.debugmode.DebugModeError as e:
             if hasattr(e, 'str_diagnostic'):
                 print(e.str_diagnostic())
@@ -533,7 +1111,7 @@ class Model( object ):
         return loss, info
 
     def eval(self, *args, with_accuracy=False, **kwargs):
-        stuff = self.eval_fn(*args, **kwargs)
+        stuff = self._call("eval_fn", args, True, **kwargs)
         loss = stuff[0]
         accuracy = stuff[1]
         info = dict(zip(self.eval_info_keys, stuff[2:]))
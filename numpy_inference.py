@@ -0,0 +1,686 @@
+import os
+import re
+import json
+import time
+import enum
+import pickle
+import argparse
+import collections
+import numpy as np
+
+import packed_dataset
+
+OUTPUT_FORMATS = ("category", "subset", "sequence")
+MODEL_KWARGS_FILE = "model_kwargs.json"
+
+# The graph state of a batch, as numpy arrays:
+#   node_strengths: (n_batch, n_nodes)
+#   node_ids: (n_batch, n_nodes, num_node_ids)
+#   node_states: (n_batch, n_nodes, node_state_size)
+#   edge_strengths: (n_batch, n_nodes, n_nodes, num_edge_types)
+NumpyGraphState = collections.namedtuple("NumpyGraphState", ["node_strengths", "node_ids", "node_states", "edge_strengths"])
+
+def sigmoid(x):
+    return 1/(1 + np.exp(-x))
+
+def softmax(x):
+    e = np.exp(x - np.max(x, -1, keepdims=True))
+    return e/np.sum(e, -1, keepdims=True)
+
+def identity(x):
+    return x
+
+def independent_best(x):
+    """
+    1 in each position where the probability is at least 0.5, else 0 (as util.independent_best)
+    """
+    return (x >= 0.5).astype(np.float32)
+
+def categorical_best(x):
+    """
+    One-hot at the position of the most likely category (as util.categorical_best)
+    """
+    return (np.arange(x.shape[-1]) == np.argmax(x, -1)[...,None]).astype(np.float32)
+
+def save_model_kwargs(model_kwargs, path):
+    """
+    Save the keyword arguments of a model.Model as JSON, with enums replaced by their
+    names, so that the model can be rebuilt without importing model (and Theano)
+    """
+    class EnumEncoder(json.JSONEncoder):
+        def default(self, obj):
+            if isinstance(obj, enum.Enum):
+                return obj.name
+            return super().default(obj)
+    kwargs = dict(model_kwargs)
+    kwargs["word_node_mapping"] = sorted(kwargs.get("word_node_mapping", {}).items())
+    with open(path, 'w') as f:
+        json.dump(kwargs, f, indent=2, sort_keys=True, cls=EnumEncoder)
+
+def load_model_kwargs(path):
+    """
+    Load model keyword arguments saved by save_model_kwargs. Enums are given by name.
+    """
+    with open(path, 'r') as f:
+        kwargs = json.load(f)
+    kwargs["word_node_mapping"] = {int(word): node for word, node in kwargs.get("word_node_mapping", [])}
+    return kwargs
+
+def find_recent_params(outputdir):
+    """
+    Find the params file of the latest iteration in outputdir, as util.find_recent_params does
+
+    Returns: (iteration, path), or None if there are no params files
+    """
+    numbers = [int(m.group(1)) for m in (re.match(r"params(\d+)\.p$", x) for x in os.listdir(outputdir)) if m is not None]
+    if len(numbers) == 0:
+        return None
+    return max(numbers), os.path.join(outputdir, "params{}.p".format(max(numbers)))
+
+class ParamReader( object ):
+    """
+    Hands out parameter values in order, checking that each has the expected shape
+    """
+    def __init__(self, values):
+        self._values = [np.asarray(v, np.float32) for v in values]
+        self._pos = 0
+
+    def take(self, shape):
+        assert self._pos < len(self._values), "Not enough parameters for the model configuration"
+        value = self._values[self._pos]
+        assert value.shape == tuple(shape), "Parameter {} has shape {}, but the model configuration needs {}".format(self._pos, value.shape, tuple(shape))
+        self._pos += 1
+        return value
+
+    def check_done(self):
+        assert self._pos == len(self._values), "Got {} parameters, but the model configuration only uses {}".format(len(self._values), self._pos)
+
+class NumpyLayerStack( object ):
+    """
+    Forward pass of layer.LayerStack
+    """
+    def __init__(self, reader, input_size, output_size, hidden_sizes=[], hidden_activation=np.tanh, activation=identity):
+        sizes = [input_size] + hidden_sizes + [output_size]
+        self._layers = [(reader.take([isize, osize]), reader.take([osize])) for isize, osize in zip(sizes[:-1], sizes[1:])]
+        self._activations = [hidden_activation]*len(hidden_sizes) + [activation]
+
+    def process(self, ipt):
+        val = ipt
+        for (W, b), activation in zip(self._layers, self._activations):
+            val = activation(np.dot(val, W) + b)
+        return val
+
+class NumpyGRU( object ):
+    """
+    Forward pass of base_gru.BaseGRULayer
+    """
+    def __init__(self, reader, input_width, output_width):
+        self.input_width = input_width
+        self.output_width = output_width
+        self._reset_W = reader.take([input_width + output_width, output_width])
+        self._reset_b = reader.take([output_width])
+        self._update_W = reader.take([input_width + output_width, output_width])
+        self._update_b = reader.take([output_width])
+        self._activation_W = reader.take([input_width + output_width, output_width])
+        self._activation_b = reader.take([output_width])
+
+        w = input_width
+        self._input_W = np.concatenate([self._reset_W[:w], self._update_W[:w], self._activation_W[:w]], 1)
+        self._input_b = np.concatenate([self._reset_b, self._update_b, self._activation_b])
+        self._gates_state_W = np.concatenate([self._reset_W[w:], self._update_W[w:]], 1)
+        self._activation_state_W = self._activation_W[w:]
+
+    def initial_state(self, n_batch):
+        return np.zeros([n_batch, self.output_width], np.float32)
+
+    def project_input(self, ipt):
+        return np.dot(ipt, self._input_W) + self._input_b
+
+    def project_input_indices(self, indices):
+        return self._input_W[indices] + self._input_b
+
+    def step_projected(self, projected_ipt, state):
+        n = self.output_width
+        gates_act = projected_ipt[:,:2*n] + np.dot(state, self._gates_state_W)
+        reset = sigmoid(gates_act[:,:n])
+        update = sigmoid(gates_act[:,n:])
+        candidate_act = np.tanh(projected_ipt[:,2*n:] + np.dot(reset * state, self._activation_state_W))
+        return update * state + (1-update) * candidate_act
+
+    def step(self, ipt, state):
+        return self.step_projected(self.project_input(ipt), state)
+
+class NumpyInputSequenceDirect( object ):
+    """
+    Forward pass of transformation_modules.InputSequenceDirectTransformation
+    """
+    def __init__(self, reader, num_words, num_node_ids, word_node_mapping, output_width):
+        self._num_node_ids = num_node_ids
+        self._output_width = output_width
+        self._word_node_index = np.full([num_words], num_node_ids, np.int64)
+        for word, node in word_node_mapping.items():
+            self._word_node_index[word] = node
+        self._gru = NumpyGRU(reader, num_words, output_width)
+
+    def process(self, inputs):
+        """
+        Params:
+            inputs: Int array of shape (n_batch, input_len)
+
+        Returns: repr_vect of shape (n_batch, output_width), and node_vects of shape
+            (n_batch, num_node_ids, output_width)
+        """
+        n_batch, input_len = inputs.shape
+        projected = self._gru.project_input_indices(inputs)
+        state = self._gru.initial_state(n_batch)
+        node_vects = np.zeros([n_batch, self._num_node_ids + 1, self._output_width], np.float32)
+        for i in range(input_len):
+            state = self._gru.step_projected(projected[:,i], state)
+            np.add.at(node_vects, (np.arange(n_batch), self._word_node_index[inputs[:,i]]), state)
+        return state, node_vects[:,:self._num_node_ids]
+
+class NumpyNodeStateUpdate( object ):
+    """
+    Forward pass of transformation_modules.NodeStateUpdateTransformation
+    """
+    def __init__(self, reader, input_width, num_node_ids, node_state_size):
+        self._gru = NumpyGRU(reader, input_width + num_node_ids, node_state_size)
+
+    def process(self, gstate, input_vector):
+        n_batch, n_nodes, _ = gstate.node_states.shape
+        tiled_input = np.broadcast_to(input_vector[:,None,:], (n_batch, n_nodes, input_vector.shape[-1]))
+        full_input = np.concatenate([gstate.node_ids, tiled_input], 2)
+        return _update_node_states(self._gru, gstate, full_input)
+
+class NumpyDirectReferenceUpdate( object ):
+    """
+    Forward pass of transformation_modules.DirectReferenceUpdateTransformation
+    """
+    def __init__(self, reader, input_width, num_node_ids, node_state_size):
+        self._gru = NumpyGRU(reader, input_width + num_node_ids, node_state_size)
+
+    def process(self, gstate, ref_matrix):
+        full_input = np.concatenate([gstate.node_ids, np.matmul(gstate.node_ids, ref_matrix)], 2)
+        return _update_node_states(self._gru, gstate, full_input)
+
+def _update_node_states(gru, gstate, full_input):
+    """
+    Run a GRU step for every node, with input full_input of shape (n_batch, n_nodes, ?)
+    """
+    flat_input = full_input.reshape([-1, full_input.shape[-1]])
+    flat_state = gstate.node_states.reshape([-1, gstate.node_states.shape[-1]])
+    return gstate._replace(node_states=gru.step(flat_input, flat_state).reshape(gstate.node_states.shape))
+
+class NumpyPropagation( object ):
+    """
+    Forward pass of transformation_modules.PropagationTransformation
+    """
+    def __init__(self, reader, transfer_size, num_node_ids, node_state_size, num_edge_types, transfer_activation=np.tanh):
+        self._transfer_size = transfer_size
+        self._num_edge_types = num_edge_types
+        self._propagation_gru = NumpyGRU(reader, num_node_ids + transfer_size, node_state_size)
+        self._transfer_stack = NumpyLayerStack(reader, num_node_ids + node_state_size, 2 * num_edge_types * transfer_size, activation=transfer_activation)
+
+    def process(self, gstate):
+        n_batch, n_nodes, _ = gstate.node_states.shape
+        node_obs = np.concatenate([gstate.node_ids, gstate.node_states], 2)
+        transformed = self._transfer_stack.process(node_obs).reshape([n_batch, n_nodes, 2*self._num_edge_types, self._transfer_size])
+        scaled_transformed = transformed * gstate.node_strengths[:,:,None,None]
+        E = self._num_edge_types
+        # Forward: dest receives from source along edge_strengths[:,source,dest,:]
+        # Backward: dest receives from source along edge_strengths[:,dest,source,:]
+        reduced_result = np.einsum("bsde,bset->bdt", gstate.edge_strengths, scaled_transformed[:,:,:E]) \
+                       + np.einsum("bdse,bset->bdt", gstate.edge_strengths, scaled_transformed[:,:,E:])
+        full_input = np.concatenate([gstate.node_ids, reduced_result], 2)
+        return _update_node_states(self._propagation_gru, gstate, full_input)
+
+    def process_multiple(self, gstate, iterations):
+        for _ in range(iterations):
+            gstate = self.process(gstate)
+        return gstate
+
+class NumpyAggregateRepresentation( object ):
+    """
+    Forward pass of transformation_modules.AggregateRepresentationTransformation, or with
+    use_old_aggregate, of AggregateRepresentationTransformationSoftmax
+    """
+    def __init__(self, reader, representation_width, num_node_ids, node_state_size, use_old_aggregate=False):
+        self._use_old_aggregate = use_old_aggregate
+        self._representation_stack = NumpyLayerStack(reader, num_node_ids + node_state_size, representation_width+1)
+
+    def process(self, gstate):
+        obs = np.concatenate([gstate.node_ids, gstate.node_states], 2)
+        activations = self._representation_stack.process(obs)
+        representations = np.tanh(activations[:,:,1:])
+        if self._use_old_aggregate:
+            selector = softmax(activations[:,:,0] + np.log(gstate.node_strengths + np.float32(1e-8)))[:,:,None]
+            return np.sum(selector * representations, 1)
+        else:
+            selector = (sigmoid(activations[:,:,0]) * gstate.node_strengths)[:,:,None]
+            return np.tanh(np.sum(selector * representations, 1))
+
+class NumpyNewNodesInform( object ):
+    """
+    Forward pass of transformation_modules.NewNodesInformTransformation
+    """
+    def __init__(self, reader, input_width, inform_width, proposal_width, num_node_ids, node_state_size, use_old_aggregate=False):
+        self._proposer_gru = NumpyGRU(reader, input_width + inform_width, proposal_width)
+        self._proposer_stack = NumpyLayerStack(reader, proposal_width, 1+num_node_ids, [proposal_width])
+        self._inform_aggregate = NumpyAggregateRepresentation(reader, inform_width, num_node_ids, node_state_size, use_old_aggregate)
+
+    def get_candidates(self, gstate, input_vector, max_candidates):
+        """
+        Returns: new_strengths of shape (n_batch, max_candidates), and new_ids of shape
+            (n_batch, max_candidates, num_node_ids)
+        """
+        aggregated_repr = self._inform_aggregate.process(gstate)
+        projected_input = self._proposer_gru.project_input(np.concatenate([input_vector, aggregated_repr], 1))
+        state = self._proposer_gru.initial_state(input_vector.shape[0])
+        raw_acts = []
+        for _ in range(max_candidates):
+            state = self._proposer_gru.step_projected(projected_input, state)
+            raw_acts.append(state)
+        processed_acts = self._proposer_stack.process(np.stack(raw_acts, 1))
+        return sigmoid(processed_acts[:,:,0]), softmax(processed_acts[:,:,1:])
+
+class NumpyEdgeStateUpdate( object ):
+    """
+    Forward pass of transformation_modules.EdgeStateUpdateTransformation
+    """
+    def __init__(self, reader, input_width, num_node_ids, node_state_size, num_edge_types):
+        self._num_edge_types = num_edge_types
+        process_input_size = input_width + 2*(num_node_ids + node_state_size)
+        self._update_stack = NumpyLayerStack(reader, process_input_size, 2*num_edge_types, [process_input_size], activation=sigmoid)
+        # The first layer is applied to the input vector, source, and dest parts separately, as in the model
+        self._input_rows = slice(0, input_width)
+        self._source_rows = slice(input_width, input_width + num_node_ids + node_state_size)
+        self._dest_rows = slice(input_width + num_node_ids + node_state_size, process_input_size)
+
+    def process(self, gstate, input_vector):
+        n_batch, n_nodes, _ = gstate.node_states.shape
+        (first_W, first_b), (out_W, out_b) = self._update_stack._layers
+        node_obs = np.concatenate([gstate.node_ids, gstate.node_states], 2)
+        hidden = np.tanh(np.dot(input_vector, first_W[self._input_rows])[:,None,None,:]
+                         + np.dot(node_obs, first_W[self._source_rows])[:,:,None,:]
+                         + np.dot(node_obs, first_W[self._dest_rows])[:,None,:,:]
+                         + first_b)
+        result = sigmoid(np.dot(hidden, out_W) + out_b).reshape([n_batch, n_nodes, n_nodes, self._num_edge_types, 2])
+        should_set = result[...,0]
+        should_clear = result[...,1]
+        edges = gstate.edge_strengths
+        return gstate._replace(edge_strengths=edges*(1-should_clear) + (1-edges)*should_set)
+
+class NumpySequenceAggregateSummary( object ):
+    """
+    Forward pass of transformation_modules.SequenceAggregateSummaryTransformation
+    """
+    def __init__(self, reader, input_representation_width, output_representation_width):
+        self._seq_gru = NumpyGRU(reader, input_representation_width, output_representation_width)
+
+    def process(self, input_sequence):
+        state = self._seq_gru.initial_state(input_sequence.shape[0])
+        for t in range(input_sequence.shape[1]):
+            state = self._seq_gru.step(input_sequence[:,t], state)
+        return state
+
+class NumpyOutput( object ):
+    """
+    Forward pass of transformation_modules.OutputCategoryTransformation, OutputSetTransformation,
+    or OutputSequenceTransformation, depending on output_format
+    """
+    def __init__(self, reader, output_format, input_width, num_words):
+        self._output_format = output_format
+        if output_format == "category":
+            self._transform_stack = NumpyLayerStack(reader, input_width, num_words, activation=softmax)
+        elif output_format == "subset":
+            self._transform_stack = NumpyLayerStack(reader, input_width, num_words, activation=sigmoid)
+        elif output_format == "sequence":
+            self._seq_gru = NumpyGRU(reader, input_width, input_width)
+            self._transform_stack = NumpyLayerStack(reader, input_width, num_words, activation=softmax)
+
+    def process(self, input_vector, seq_len=None):
+        """
+        Returns: Output distribution of shape (n_batch, 1, num_words), or (n_batch, seq_len, num_words)
+            for the sequence format
+        """
+        if self._output_format != "sequence":
+            return self._transform_stack.process(input_vector)[:,None,:]
+        projected_input = self._seq_gru.project_input(input_vector)
+        state = self._seq_gru.initial_state(input_vector.shape[0])
+        states = []
+        for _ in range(seq_len):
+            state = self._seq_gru.step_projected(projected_input, state)
+            states.append(state)
+        return self._transform_stack.process(np.stack(states, 1))
+
+    def snap_to_best(self, answer):
+        return independent_best(answer) if self._output_format == "subset" else categorical_best(answer)
+
+def _pad_nodes(gstate, capacity):
+    """
+    Pad a graph state with zero-strength nodes up to capacity nodes
+    """
+    n_pad = capacity - gstate.node_strengths.shape[1]
+    if n_pad == 0:
+        return gstate
+    return NumpyGraphState(*(np.pad(x, [(0,0)] + [(0,n_pad)]*nd + [(0,0)]*(x.ndim-1-nd), 'constant')
+                             for x, nd in zip(gstate, (1,1,1,2))))
+
+class NumpyModel( object ):
+    """
+    A NumPy implementation of the forward pass of model.Model, for running trained models
+    without Theano. It only supports inference: fuzzy_test and snap_test give the same
+    outputs as the model's fuzzy_test_fn and snap_test_fn (up to floating point error).
+    """
+    def __init__(self, num_input_words, num_output_words, num_node_ids, node_state_size, num_edge_types, input_repr_size, output_repr_size, propose_repr_size, propagate_repr_size, new_nodes_per_iter, output_format, final_propagate, word_node_mapping={}, dynamic_nodes=True, nodes_mutable=True, wipe_node_state=True, intermediate_propagate=0, sequence_representation=False, use_old_aggregate=False, train_with_query=True, mask_padding=True, multi_query=False, params=None, **unused_kwargs):
+        """
+        Params:
+            The same as for model.Model (options that only affect training are ignored), except:
+            output_format: Member of model.ModelOutputFormat, or its name
+            params: List of parameter values, in the order of model.Model.params, as saved
+                by util.save_params. If None, load them later with load_params
+        """
+        self.num_node_ids = num_node_ids
+        self.node_state_size = node_state_size
+        self.num_edge_types = num_edge_types
+        self.new_nodes_per_iter = new_nodes_per_iter
+        self.output_format = getattr(output_format, "name", output_format)
+        assert self.output_format in OUTPUT_FORMATS, "Invalid output format {}".format(output_format)
+        self.final_propagate = final_propagate
+        self.word_node_mapping = word_node_mapping
+        self.dynamic_nodes = dynamic_nodes
+        self.nodes_mutable = nodes_mutable
+        self.wipe_node_state = wipe_node_state
+        self.intermediate_propagate = intermediate_propagate
+        self.sequence_representation = sequence_representation
+        self.train_with_query = train_with_query
+        self.mask_padding = mask_padding
+        self.multi_query = multi_query
+
+        self._config = dict(num_input_words=num_input_words, num_output_words=num_output_words, input_repr_size=input_repr_size,
+                            output_repr_size=output_repr_size, propose_repr_size=propose_repr_size,
+                            propagate_repr_size=propagate_repr_size, use_old_aggregate=use_old_aggregate)
+        if params is not None:
+            self.set_params(params)
+
+    @classmethod
+    def from_output_dir(cls, outputdir, paramfile=None):
+        """
+        Load a model trained by main.py, using the model_kwargs.json it saved, and the params
+        file of its latest iteration (or paramfile, if given)
+        """
+        kwargs = load_model_kwargs(os.path.join(outputdir, MODEL_KWARGS_FILE))
+        if paramfile is None:
+            found = find_recent_params(outputdir)
+            assert found is not None, "No params files in {}".format(outputdir)
+            _, paramfile = found
+        m = cls(**kwargs)
+        with open(paramfile, 'rb') as f:
+            m.load_params(f)
+        return m
+
+    def load_params(self, file):
+        """
+        Load params from a pickle file written by util.save_params
+        """
+        self.set_params(pickle.load(file))
+
+    def set_params(self, values):
+        """
+        Set up the modules from a list of parameter values, in the order of model.Model.params
+        """
+        c = self._config
+        K, D, E = self.num_node_ids, self.node_state_size, self.num_edge_types
+        reader = ParamReader(values)
+        # Modules are created in the same order as in model.Model, so they read their parameters in order
+        self.input_transformer = NumpyInputSequenceDirect(reader, c["num_input_words"], K, self.word_node_mapping, c["input_repr_size"])
+        if self.nodes_mutable:
+            self.node_state_updater = NumpyNodeStateUpdate(reader, c["input_repr_size"], K, D)
+        if len(self.word_node_mapping) > 0:
+            self.direct_reference_updater = NumpyDirectReferenceUpdate(reader, c["input_repr_size"], K, D)
+        if self.intermediate_propagate != 0:
+            self.intermediate_propagator = NumpyPropagation(reader, c["propagate_repr_size"], K, D, E)
+        if self.dynamic_nodes:
+            self.new_node_adder = NumpyNewNodesInform(reader, c["input_repr_size"], c["propose_repr_size"], c["propose_repr_size"], K, D, c["use_old_aggregate"])
+        self.edge_state_updater = NumpyEdgeStateUpdate(reader, c["input_repr_size"], K, D, E)
+        if self.train_with_query:
+            self.query_node_state_updater = NumpyNodeStateUpdate(reader, c["input_repr_size"], K, D)
+            if len(self.word_node_mapping) > 0:
+                self.query_direct_reference_updater = NumpyDirectReferenceUpdate(reader, c["input_repr_size"], K, D)
+            self.final_propagator = NumpyPropagation(reader, c["propagate_repr_size"], K, D, E)
+            self.aggregator = NumpyAggregateRepresentation(reader, c["output_repr_size"], K, D, c["use_old_aggregate"])
+            if self.sequence_representation:
+                self.aggregate_summarizer = NumpySequenceAggregateSummary(reader, c["output_repr_size"], c["output_repr_size"])
+            self.output_processor = NumpyOutput(reader, self.output_format, c["output_repr_size"], c["num_output_words"])
+        reader.check_done()
+
+    def get_sentence_lengths(self, input_words):
+        """
+        Get the number of sentences in each story of a batch, as model.Model.get_sentence_lengths
+        """
+        nonpad = np.any(input_words != 0, axis=2)
+        lengths = nonpad.shape[1] - np.argmax(nonpad[:,::-1], axis=1)
+        return np.where(np.any(nonpad, axis=1), lengths, 1).astype(np.int32)
+
+    def _iter_step(self, input_repr, ref_matrix, gstate, snap_to_best):
+        """
+        Process one sentence, as in the sentence loop of model.Model.setup
+        """
+        if self.nodes_mutable:
+            gstate = self.node_state_updater.process(gstate, input_repr)
+        if len(self.word_node_mapping) > 0:
+            gstate = self.direct_reference_updater.process(gstate, ref_matrix)
+        if self.intermediate_propagate != 0:
+            gstate = self.intermediate_propagator.process_multiple(gstate, self.intermediate_propagate)
+        if self.dynamic_nodes:
+            new_strengths, new_ids = self.new_node_adder.get_candidates(gstate, input_repr, self.new_nodes_per_iter)
+            if snap_to_best:
+                new_strengths, new_ids = independent_best(new_strengths), categorical_best(new_ids)
+            n_batch, n_new = new_strengths.shape
+            gstate = _pad_nodes(gstate, gstate.node_strengths.shape[1] + n_new)._replace(
+                node_strengths=np.concatenate([gstate.node_strengths, new_strengths], 1),
+                node_ids=np.concatenate([gstate.node_ids, new_ids], 1))
+        gstate = self.edge_state_updater.process(gstate, input_repr)
+        if snap_to_best:
+            gstate = gstate._replace(edge_strengths=independent_best(gstate.edge_strengths))
+        return gstate
+
+    def _process_query(self, final_gstate, query_repr, query_ref_matrix):
+        """
+        Update the graph with the query, then propagate and aggregate it, as in model.Model.setup
+
+        Returns: The graph state after the query update, the graph state after propagation,
+            and the aggregated representation
+        """
+        if self.wipe_node_state:
+            final_gstate = final_gstate._replace(node_states=np.zeros_like(final_gstate.node_states))
+        query_gstate = self.query_node_state_updater.process(final_gstate, query_repr)
+        if len(self.word_node_mapping) > 0:
+            query_gstate = self.query_direct_reference_updater.process(query_gstate, query_ref_matrix)
+        propagated_gstate = self.final_propagator.process_multiple(query_gstate, self.final_propagate)
+        return query_gstate, propagated_gstate, self.aggregator.process(propagated_gstate)
+
+    def _final_output(self, aggregated_repr, max_seq_len, snap_to_best):
+        final_output = self.output_processor.process(aggregated_repr, max_seq_len)
+        if snap_to_best:
+            final_output = self.output_processor.snap_to_best(final_output)
+        return final_output
+
+    def _run(self, args, snap_to_best):
+        args = [np.asarray(a) for a in args]
+        input_words, query_words = args[:2]
+        if self.multi_query:
+            query_positions = args[2]
+            args = args[3:]
+        else:
+            args = args[2:]
+        max_seq_len = int(args[0]) if self.output_format == "sequence" and self.train_with_query else None
+
+        if self.mask_padding:
+            lengths = self.get_sentence_lengths(input_words)
+            input_words = input_words[:,:int(np.max(lengths))]
+        n_batch, n_sentences, sentence_len = input_words.shape
+
+        flat_reprs, flat_ref_matrices = self.input_transformer.process(input_words.reshape([-1, sentence_len]))
+        input_reprs = flat_reprs.reshape([n_batch, n_sentences, -1])
+        ref_matrices = flat_ref_matrices.reshape([n_batch, n_sentences, self.num_node_ids, -1])
+        query_repr, query_ref_matrix = self.input_transformer.process(query_words.reshape([-1, query_words.shape[-1]]))
+
+        capacity = n_sentences * self.new_nodes_per_iter + 1 if self.dynamic_nodes else self.num_node_ids
+        gstate = self.initial_graph_state(n_batch)
+        # As in the model, the state after each sentence is kept padded to capacity nodes, and
+        # stories that have already ended keep their previous graph
+        bufs = _pad_nodes(gstate, capacity)
+        n_nodes = gstate.node_strengths.shape[1]
+        all_bufs = []
+        for t in range(n_sentences):
+            live = NumpyGraphState(bufs.node_strengths[:,:n_nodes], bufs.node_ids[:,:n_nodes],
+                                   bufs.node_states[:,:n_nodes], bufs.edge_strengths[:,:n_nodes,:n_nodes])
+            new_live = self._iter_step(input_reprs[:,t], ref_matrices[:,t], live, snap_to_best)
+            n_nodes = new_live.node_strengths.shape[1]
+            new_bufs = _pad_nodes(new_live, capacity)
+            if self.mask_padding:
+                step_mask = t < lengths
+                new_bufs = NumpyGraphState(*(np.where(step_mask.reshape([-1] + [1]*(new.ndim-1)), new, old)
+                                             for new, old in zip(new_bufs, bufs)))
+            bufs = new_bufs
+            all_bufs.append(bufs)
+        # Each part has shape (n_batch, n_sentences, capacity, ...)
+        all_flat_gstates = [np.stack(parts, 1) for parts in zip(*all_bufs)]
+
+        if not self.train_with_query:
+            return [np.zeros([], np.float32)] + all_flat_gstates
+
+        if self.sequence_representation:
+            final_gstate = NumpyGraphState(*(x.reshape((-1,) + x.shape[2:]) for x in all_flat_gstates))
+            query_repr = np.repeat(query_repr, n_sentences, 0)
+            query_ref_matrix = np.repeat(query_ref_matrix, n_sentences, 0)
+            per_story = n_sentences
+        elif self.multi_query:
+            query_steps = np.maximum(query_positions.flatten() - 1, 0)
+            query_batch_idxs = np.repeat(np.arange(n_batch), query_positions.shape[1])
+            final_gstate = NumpyGraphState(*(x[query_batch_idxs, query_steps] for x in all_flat_gstates))
+            per_story = query_positions.shape[1]
+        else:
+            final_gstate = NumpyGraphState(*(x[:,-1] for x in all_flat_gstates))
+            per_story = None
+        final_gstate = NumpyGraphState(final_gstate.node_strengths[:,:n_nodes], final_gstate.node_ids[:,:n_nodes],
+                                       final_gstate.node_states[:,:n_nodes], final_gstate.edge_strengths[:,:n_nodes,:n_nodes])
+
+        query_gstate, propagated_gstate, aggregated_repr = self._process_query(final_gstate, query_repr, query_ref_matrix)
+        if self.sequence_representation:
+            aggregated_repr = self.aggregate_summarizer.process(aggregated_repr.reshape([n_batch, n_sentences, -1]))
+
+        final_output = self._final_output(aggregated_repr, max_seq_len, snap_to_best)
+        if self.multi_query:
+            final_output = final_output.reshape((n_batch, per_story) + final_output.shape[1:])
+
+        if per_story is None:
+            adjust = lambda x: x[:,None]
+        else:
+            adjust = lambda x: x.reshape((n_batch, per_story) + x.shape[1:])
+        full_flat_gstates = [np.concatenate([a, adjust(b), adjust(c)], 1)
+                             for a, b, c in zip(all_flat_gstates, _pad_nodes(query_gstate, capacity), _pad_nodes(propagated_gstate, capacity))]
+        return [final_output] + full_flat_gstates
+
+    def fuzzy_test(self, *args):
+        """
+        Run the model on a batch, like model.Model.fuzzy_test
+
+        Params:
+            args: input_words, query_words (and query_positions if multi_query), then
+                max_seq_len if using the sequence output format
+
+        Returns: final_output, node_strengths, node_ids, node_states, edge_strengths
+        """
+        return self._run(args, False)
+
+    def snap_test(self, *args):
+        """
+        Like fuzzy_test, but snapping to the most likely option at each step, like
+        model.Model.snap_test
+        """
+        return self._run(args, True)
+
+    def initial_graph_state(self, n_batch=1):
+        """
+        Get the graph state of stories before their first sentence, like
+        model.Model.initial_graph_state
+        """
+        K, D, E = self.num_node_ids, self.node_state_size, self.num_edge_types
+        if self.dynamic_nodes:
+            return NumpyGraphState(np.zeros([n_batch, 1], np.float32), np.zeros([n_batch, 1, K], np.float32),
+                                   np.zeros([n_batch, 1, D], np.float32), np.zeros([n_batch, 1, 1, E], np.float32))
+        else:
+            return NumpyGraphState(np.ones([n_batch, K], np.float32), np.tile(np.eye(K, dtype=np.float32), (n_batch,1,1)),
+                                   np.zeros([n_batch, K, D], np.float32), np.zeros([n_batch, K, K, E], np.float32))
+
+    def step(self, sentence_words, graph_state, snap=True):
+        """
+        Process one more sentence of each story in a batch, like model.Model.step
+        """
+        input_repr, ref_matrix = self.input_transformer.process(np.asarray(sentence_words))
+        return self._iter_step(input_repr, ref_matrix, NumpyGraphState(*graph_state), snap)
+
+    def query(self, query_words, graph_state, snap=True, max_seq_len=None):
+        """
+        Answer a query about each story in a batch, given its graph state, like model.Model.query
+        """
+        assert not self.sequence_representation, "Queries with a sequence representation need the graph after every sentence"
+        query_repr, query_ref_matrix = self.input_transformer.process(np.asarray(query_words))
+        _, _, aggregated_repr = self._process_query(NumpyGraphState(*graph_state), query_repr, query_ref_matrix)
+        return self._final_output(aggregated_repr, max_seq_len, snap)
+
+def answer_is_correct(output, answer, output_format, num_output_words):
+    """
+    Check a snapped output of shape (?, num_output_words) against an answer, given as a list of
+    answer word indices (as stored in a parsed dataset)
+    """
+    if output_format == "category":
+        return np.argmax(output[0]) == answer[0]
+    elif output_format == "subset":
+        return set(np.nonzero(output[0] >= 0.5)[0].tolist()) == set(answer)
+    elif output_format == "sequence":
+        # The last output word is the stop word, which pads the rest of the sequence
+        expected = list(answer) + [num_output_words-1]*(output.shape[0]-len(answer))
+        return np.argmax(output, -1).tolist() == expected
+
+def main(outputdir, task_dir, paramfile, batch_size):
+    start_time = time.time()
+    m = NumpyModel.from_output_dir(outputdir, paramfile)
+    print("Loaded model in {:.3f} seconds".format(time.time() - start_time))
+    num_output_words = m._config["num_output_words"]
+
+    correct = 0
+    out_of = 0
+    start_time = time.time()
+    for bucket in packed_dataset.load_bucketed(task_dir):
+        for start_idx in range(0, len(bucket), batch_size):
+            sents, queries, answers, _ = packed_dataset.load_story_batch(bucket[start_idx:start_idx+batch_size])
+            if m.multi_query:
+                max_ans_len = max(len(a) for story_answers in answers for a in story_answers)
+                args = [sents, queries.words, queries.positions]
+            else:
+                max_ans_len = max(len(a) for a in answers)
+                args = [sents, queries]
+                answers = [[a] for a in answers]
+            if m.output_format == "sequence":
+                args.append(max_ans_len + 1)
+            outputs = m.snap_test(*args)[0]
+            if not m.multi_query:
+                outputs = outputs[:,None]
+            for story_outputs, story_answers in zip(outputs, answers):
+                for output, answer in zip(story_outputs, story_answers):
+                    correct += answer_is_correct(output, answer, m.output_format, num_output_words)
+                    out_of += 1
+    print("Accuracy: {} ({} of {} queries), in {:.3f} seconds".format(correct/out_of, correct, out_of, time.time() - start_time))
+
+parser = argparse.ArgumentParser(description='Evaluate a trained model on a parsed dataset using NumPy only, without Theano.')
+parser.add_argument('outputdir', help="Output directory of the training run, with model_kwargs.json and params files")
+parser.add_argument('task_dir', help="Parsed (packed) directory of stories to answer")
+parser.add_argument('--params', dest="paramfile", default=None, help="Params file to load. Defaults to the latest one in outputdir")
+parser.add_argument('--batch-size', type=int, default=10, help="Number of stories to run at once")
+
+if __name__ == '__main__':
+    args = vars(parser.parse_args())
+    main(**args)
@@ -0,0 +1,436 @@
+import os
+import pickle
+import shutil
+import collections
+import numpy as np
+
+BUCKET_LIST_FILE = "bucket_list.p"
+BUCKET_INFO_FILE = "bucket_info.p"
+
+PackedStoryRef = collections.namedtuple("PackedStoryRef", ["bucket", "index"])
+# The queries of a batch of multi-query stories. words has shape (n_batch, max_queries, sentence_length),
+# and positions has shape (n_batch, max_queries), giving the number of sentences before each query,
+# or 0 for padding queries (real queries always have at least one sentence before them)
+MultiQuery = collections.namedtuple("MultiQuery", ["words", "positions"])
+
+class PackedBucketWriter( object ):
+    """
+    Writes the stories of a single bucket into a directory of flat column files.
+
+    Columns with a fixed per-story shape are stored as one row per story. Ragged
+    columns are stored as the concatenation of every story's rows, along with an
+    offset index giving where each story starts.
+    """
+    def __init__(self, bucket_dir, attrs=None):
+        """
+        Params:
+            bucket_dir: Directory to write the bucket into
+            attrs: Optional dict of extra information about the bucket (such as
+                the padded graph size) to store alongside the columns
+        """
+        self._bucket_dir = bucket_dir
+        self._attrs = {} if attrs is None else dict(attrs)
+        if not os.path.exists(bucket_dir):
+            os.makedirs(bucket_dir)
+        self._files = {}
+        self._specs = None
+        self._ragged_lengths = {}
+        self._story_ids = []
+
+    def _write(self, name, arr, dtype, shape):
+        arr = np.asarray(arr, dtype)
+        assert arr.shape[arr.ndim-len(shape):] == tuple(shape), \
+            "Column {} should have trailing shape {}, got {}".format(name, shape, arr.shape)
+        if name not in self._files:
+            self._files[name] = open(os.path.join(self._bucket_dir, name + ".bin"), 'wb')
+        self._files[name].write(np.ascontiguousarray(arr).tobytes())
+
+    def append(self, story_id, fixed, ragged):
+        """
+        Add a story to the bucket.
+
+        Params:
+            story_id: Index of the story in the original task file
+            fixed: Dict from column name to an array of the same shape for every story
+            ragged: Dict from column name to an array of shape (n_rows, ...), where
+                n_rows can differ between stories
+        """
+        if self._specs is None:
+            self._specs = {}
+            for name, arr in fixed.items():
+                arr = np.asarray(arr)
+                self._specs[name] = (arr.dtype.str, arr.shape, False)
+            for name, arr in ragged.items():
+                arr = np.asarray(arr)
+                self._specs[name] = (arr.dtype.str, arr.shape[1:], True)
+                self._ragged_lengths[name] = []
+        assert set(self._specs.keys()) == set(fixed.keys()) | set(ragged.keys()), "Columns changed between stories"
+
+        for name, arr in fixed.items():
+            dtype, shape, _ = self._specs[name]
+            self._write(name, arr, dtype, shape)
+        for name, arr in ragged.items():
+            dtype, shape, _ = self._specs[name]
+            arr = np.asarray(arr, dtype).reshape((-1,) + shape)
+            self._write(name, arr, dtype, shape)
+            self._ragged_lengths[name].append(arr.shape[0])
+        self._story_ids.append(story_id)
+
+    def extend_from(self, bucket_dir):
+        """
+        Append every story of another (closed) bucket directory to this bucket, in order,
+        by copying its column data directly.
+        """
+        with open(os.path.join(bucket_dir, BUCKET_INFO_FILE), 'rb') as f:
+            info = pickle.load(f)
+        if info["count"] == 0:
+            return
+        if self._specs is None:
+            self._specs = info["columns"]
+            self._ragged_lengths = {name:[] for name, (_, _, is_ragged) in self._specs.items() if is_ragged}
+        assert self._specs == info["columns"], "Cannot merge buckets with different columns"
+        for name, (_, _, is_ragged) in self._specs.items():
+            if name not in self._files:
+                self._files[name] = open(os.path.join(self._bucket_dir, name + ".bin"), 'wb')
+            with open(os.path.join(bucket_dir, name + ".bin"), 'rb') as f:
+                shutil.copyfileobj(f, self._files[name])
+            if is_ragged:
+                offsets = np.fromfile(os.path.join(bucket_dir, name + "_offsets.bin"), np.int64)
+                self._ragged_lengths[name].extend(np.diff(offsets).tolist())
+        self._story_ids.extend(info["story_ids"].tolist())
+
+    def close(self):
+        """
+        Finish writing the bucket, and write out the offset index and column info
+        """
+        for f in self._files.values():
+            f.close()
+        specs = {} if self._specs is None else self._specs
+        for name, lengths in self._ragged_lengths.items():
+            offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+            with open(os.path.join(self._bucket_dir, name + "_offsets.bin"), 'wb') as f:
+                f.write(offsets.tobytes())
+        info = {
+            "count": len(self._story_ids),
+            "story_ids": np.array(self._story_ids, np.int64),
+            "columns": specs,
+            "attrs": self._attrs,
+        }
+        with open(os.path.join(self._bucket_dir, BUCKET_INFO_FILE), 'wb') as f:
+            pickle.dump(info, f)
+
+def _map_column(path, dtype, shape):
+    dtype = np.dtype(dtype)
+    if shape[0] == 0 or int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+class PackedBucket( object ):
+    """
+    A read-only view of a packed bucket on disk. Behaves like a list of story
+    references, so it can be sampled from, sliced, and trimmed like a list of
+    story filenames.
+    """
+    def __init__(self, bucket_dir, indices=None):
+        """
+        Params:
+            bucket_dir: Directory the bucket was written to by PackedBucketWriter
+            indices: Optional array of story indices in this view. If not
+                given, the view contains every story in the bucket
+        """
+        self._bucket_dir = bucket_dir
+        with open(os.path.join(bucket_dir, BUCKET_INFO_FILE), 'rb') as f:
+            info = pickle.load(f)
+        self._count = info["count"]
+        self._story_ids = info["story_ids"]
+        self._specs = info["columns"]
+        self._attrs = info.get("attrs", {})
+        self._columns = {}
+        self._offsets = {}
+        for name, (dtype, shape, is_ragged) in self._specs.items():
+            path = os.path.join(bucket_dir, name + ".bin")
+            if is_ragged:
+                offsets = _map_column(os.path.join(bucket_dir, name + "_offsets.bin"), np.int64, (self._count+1,))
+                self._offsets[name] = offsets
+                self._columns[name] = _map_column(path, dtype, (int(offsets[-1]),) + tuple(shape))
+            else:
+                self._columns[name] = _map_column(path, dtype, (self._count,) + tuple(shape))
+        self._indices = np.arange(self._count) if indices is None else np.asarray(indices, np.int64)
+
+    def __getstate__(self):
+        return {"bucket_dir":self._bucket_dir, "indices":self._indices}
+
+    def __setstate__(self, state):
+        self.__init__(state["bucket_dir"], state["indices"])
+
+    @property
+    def bucket_dir(self):
+        return self._bucket_dir
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            view = object.__new__(type(self))
+            view.__dict__.update(self.__dict__)
+            view._indices = self._indices[item]
+            return view
+        return PackedStoryRef(self, int(self._indices[item]))
+
+    def __iter__(self):
+        for idx in self._indices:
+            yield PackedStoryRef(self, int(idx))
+
+    def story_id(self, index):
+        """
+        Get the index of a story in the original task file
+        """
+        return int(self._story_ids[index])
+
+    @property
+    def attrs(self):
+        return self._attrs
+
+    def has_column(self, name):
+        return name in self._columns
+
+    def is_ragged(self, name):
+        return name in self._offsets
+
+    def load(self, indices):
+        """
+        Load a set of stories from the bucket.
+
+        Params:
+            indices: List of story indices (relative to the full bucket, as in PackedStoryRef.index)
+
+        Returns: A dict from column name to data. Fixed columns are stacked into an
+            array of shape (len(indices), ...), and ragged columns are given as a list
+            with one array per story.
+        """
+        indices = np.asarray(indices, np.int64)
+        result = {}
+        for name, column in self._columns.items():
+            if name in self._offsets:
+                offsets = self._offsets[name]
+                result[name] = [np.array(column[offsets[i]:offsets[i+1]]) for i in indices]
+            else:
+                result[name] = np.array(column[indices])
+        return result
+
+def converted_to_columns(cvtd):
+    """
+    Split a story converted by ggtnn_graph_parse.convert_story into fixed and ragged columns
+    """
+    sentence_arr, graphs, query_arr, answer_arr = cvtd
+    num_new_nodes, new_node_strengths, new_node_ids, next_edges = graphs
+    fixed = {
+        "sentences": np.array(sentence_arr, np.int32),
+        "queries": np.array(query_arr, np.int32),
+        "num_new_nodes": np.array(num_new_nodes, np.int32),
+        "strengths": np.array(new_node_strengths, np.float32),
+        "ids": np.array(new_node_ids, np.float32),
+    }
+    ragged = {
+        "answers": np.array(answer_arr, np.int32),
+        "edges": np.array(next_edges, np.int32).reshape([-1, 4]),
+    }
+    return fixed, ragged
+
+def multiquery_to_columns(cvtd):
+    """
+    Split a story converted by ggtnn_graph_parse.convert_multiquery_story into fixed and ragged columns
+    """
+    sentence_arr, graphs, query_list = cvtd
+    num_new_nodes, new_node_strengths, new_node_ids, next_edges = graphs
+    positions, query_arrs, answer_arrs = zip(*query_list)
+    fixed = {
+        "sentences": np.array(sentence_arr, np.int32),
+        "num_new_nodes": np.array(num_new_nodes, np.int32),
+        "strengths": np.array(new_node_strengths, np.float32),
+        "ids": np.array(new_node_ids, np.float32),
+    }
+    ragged = {
+        "queries": np.array(query_arrs, np.int32),
+        "query_positions": np.array(positions, np.int32),
+        "answers": np.array([w for a in answer_arrs for w in a], np.int32),
+        "answer_lengths": np.array([len(a) for a in answer_arrs], np.int32),
+        "edges": np.array(next_edges, np.int32).reshape([-1, 4]),
+    }
+    return fixed, ragged
+
+def pad_queries(query_arrs, query_positions, answer_words, answer_lengths):
+    """
+    Combine the ragged query columns of a batch of multi-query stories
+
+    Returns: queries, answers
+        queries: A MultiQuery, padded to the largest number of queries in the batch
+        answers: List, for each story, of the answer index lists of its queries
+    """
+    max_queries = max(len(p) for p in query_positions)
+    sentence_length = query_arrs[0].shape[1]
+    words = np.zeros([len(query_arrs), max_queries, sentence_length], np.int32)
+    positions = np.zeros([len(query_arrs), max_queries], np.int32)
+    answers = []
+    for i, (q, p, a, l) in enumerate(zip(query_arrs, query_positions, answer_words, answer_lengths)):
+        assert np.all(p > 0), "Query with no sentences before it would be treated as padding"
+        words[i,:len(p)] = q
+        positions[i,:len(p)] = p
+        answers.append([x.tolist() for x in np.split(a, np.cumsum(l)[:-1])])
+    return MultiQuery(words, positions), answers
+
+def index_queries(queries, index):
+    """
+    Get the queries of a single story of a batch, from either a query array or a MultiQuery
+    """
+    if isinstance(queries, MultiQuery):
+        return MultiQuery(queries.words[index], queries.positions[index])
+    return queries[index]
+
+def densify_edges(edge_lists, num_sentences, graph_size, num_edge_types):
+    """
+    Expand sparse edge lists into a dense edge array.
+
+    Params:
+        edge_lists: List of int arrays of shape (n_edges, 4), one per story, with rows
+            (sentence index, source node slot, dest node slot, edge type)
+        num_sentences: Number of sentences in each story
+        graph_size: Number of node slots in the padded graph
+        num_edge_types: Number of edge types
+
+    Returns: Array of shape (n_stories, num_sentences, graph_size, graph_size, num_edge_types)
+    """
+    dense = np.zeros([len(edge_lists), num_sentences, graph_size, graph_size, num_edge_types], np.float32)
+    story_idxs = np.concatenate([np.full([len(e)], i, np.int64) for i,e in enumerate(edge_lists)] + [np.zeros([0], np.int64)])
+    all_edges = np.concatenate([np.reshape(e, [-1, 4]) for e in edge_lists] + [np.zeros([0, 4], np.int32)])
+    dense[story_idxs, all_edges[:,0], all_edges[:,1], all_edges[:,2], all_edges[:,3]] = 1.0
+    return dense
+
+def compact_edges(edge_lists, num_new_nodes, new_nodes_per_iter):
+    """
+    Renumber the node slots in sparse edge lists so that only nodes that were actually
+    added get a slot. Normally, each sentence reserves new_nodes_per_iter slots whether
+    or not they are used. After compaction, the nodes of each story are numbered
+    consecutively (after the initial padding node) in the order they were added.
+
+    Params:
+        edge_lists: List of int arrays of shape (n_edges, 4), as for densify_edges
+        num_new_nodes: Int array of shape (n_stories, num_sentences)
+        new_nodes_per_iter: Number of slots reserved for each sentence
+
+    Returns: compacted_edge_lists, graph_size
+        graph_size is the number of slots needed to hold the largest story
+    """
+    num_new_nodes = np.asarray(num_new_nodes, np.int64)
+    n_stories = num_new_nodes.shape[0]
+    prev_new = np.cumsum(num_new_nodes, 1) - num_new_nodes
+    new_slots = 1 + prev_new[:,:,None] + np.arange(new_nodes_per_iter)
+    new_slots = np.where(np.arange(new_nodes_per_iter) < num_new_nodes[:,:,None], new_slots, -1)
+    # slot_maps[i,j] is the compacted slot for original slot j of story i, or -1 if it is never used
+    slot_maps = np.concatenate([np.zeros([n_stories, 1], np.int64), new_slots.reshape([n_stories, -1])], 1)
+    compacted = []
+    for slot_map, edges in zip(slot_maps, edge_lists):
+        edges = np.array(edges, np.int32).reshape([-1, 4])
+        edges[:,1] = slot_map[edges[:,1]]
+        edges[:,2] = slot_map[edges[:,2]]
+        assert np.all(edges[:,1:3] >= 0), "Edge refers to a node that was never added"
+        compacted.append(edges)
+    graph_size = int(np.max(np.sum(num_new_nodes, 1), initial=0)) + 1
+    return compacted, graph_size
+
+def compact_dense_edges(edges, num_new_nodes, new_nodes_per_iter):
+    """
+    Like compact_edges, but for a dense edge array of shape
+    (n_stories, num_sentences, graph_size, graph_size, num_edge_types)
+    """
+    edge_lists = [np.argwhere(e) for e in edges]
+    compacted, graph_size = compact_edges(edge_lists, num_new_nodes, new_nodes_per_iter)
+    return densify_edges(compacted, edges.shape[1], graph_size, edges.shape[4])
+
+def split_columns(cols):
+    """
+    Split columns from PackedBucket.load into a list with one dict of columns per story
+    """
+    names = list(cols.keys())
+    return [dict(zip(names, vals)) for vals in zip(*(cols[name] for name in names))]
+
+def stack_columns(bucket, story_cols):
+    """
+    Combine a list of per-story column dicts (from split_columns) back into batched
+    columns, as returned by bucket.load
+    """
+    result = {}
+    for name in story_cols[0].keys():
+        vals = [c[name] for c in story_cols]
+        result[name] = vals if bucket.is_ragged(name) else np.stack(vals)
+    return result
+
+def columns_to_batch(bucket, cols, compact_nodes=False):
+    """
+    Convert loaded columns of a bucket into batch arrays. See load_story_batch.
+    If compact_nodes, node slots in the edge array are renumbered as in compact_edges.
+    """
+    if bucket.is_ragged("queries"):
+        queries, answers = pad_queries(cols["queries"], cols["query_positions"], cols["answers"], cols["answer_lengths"])
+    else:
+        queries = cols["queries"]
+        answers = [a.tolist() for a in cols["answers"]]
+    num_sentences = cols["sentences"].shape[1]
+    new_nodes_per_iter = cols["strengths"].shape[2]
+    if compact_nodes and new_nodes_per_iter > 0:
+        edge_lists, graph_size = compact_edges(cols["edges"], cols["num_new_nodes"], new_nodes_per_iter)
+    else:
+        edge_lists, graph_size = cols["edges"], bucket.attrs["graph_size"]
+    edges = densify_edges(edge_lists, num_sentences, graph_size, bucket.attrs["num_edge_types"])
+    graphs = (cols["num_new_nodes"], cols["strengths"], cols["ids"], edges)
+    return cols["sentences"], queries, answers, graphs
+
+def load_story_batch(story_refs):
+    """
+    Load a batch of stories, all from the same packed bucket.
+
+    Returns: sents, queries, answers, graphs
+        sents: Array of shape (n_batch, n_sentences, sentence_length)
+        queries: Array of shape (n_batch, sentence_length), or a MultiQuery for multi-query buckets
+        answers: List of answer index lists, or for multi-query buckets, a list of them per story
+        graphs: Tuple (num_new_nodes, new_node_strengths, new_node_ids, next_edges) of stacked arrays
+    """
+    bucket = story_refs[0].bucket
+    assert all(ref.bucket is bucket for ref in story_refs), "Batch contains stories from multiple buckets"
+    cols = bucket.load([ref.index for ref in story_refs])
+    return columns_to_batch(bucket, cols)
+
+def load_converted_story(story_ref):
+    """
+    Load a single story in the format produced by ggtnn_graph_parse.convert_story
+    """
+    sents, queries, answers, graphs = load_story_batch([story_ref])
+    return (sents[0], tuple(g[0] for g in graphs), index_queries(queries, 0), answers[0])
+
+def write_bucket_list(savedir, bucket_dirs):
+    with open(os.path.join(savedir, BUCKET_LIST_FILE), 'wb') as f:
+        pickle.dump([os.path.relpath(d, savedir) for d in bucket_dirs], f)
+
+def is_multi_query(bucketed):
+    """
+    Check whether buckets from load_bucketed hold multi-query stories
+    """
+    return isinstance(bucketed[0], PackedBucket) and bucketed[0].attrs.get("multi_query", False)
+
+def is_packed(task_dir):
+    return os.path.isfile(os.path.join(task_dir, BUCKET_LIST_FILE))
+
+def load_bucketed(task_dir):
+    """
+    Load the buckets of a parsed task directory. For packed directories, this gives a
+    list of PackedBucket. For directories in the old one-file-per-story format, this
+    gives a list of lists of story filenames.
+    """
+    if is_packed(task_dir):
+        with open(os.path.join(task_dir, BUCKET_LIST_FILE), 'rb') as f:
+            bucket_dirs = pickle.load(f)
+        return [PackedBucket(os.path.join(task_dir, d)) for d in bucket_dirs]
+    with open(os.path.join(task_dir,'file_list.p'),'rb') as f:
+        bucketed = pickle.load(f)
+    return [[os.path.join(task_dir,x) for x in b] for b in bucketed]
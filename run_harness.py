@@ -10,7 +10,7 @@ from termcolor import colored
 
 TaskSpec = collections.namedtuple("TaskSpec", ["task_name", "variant_name", "run_params"])
 
-def run(tasks_dir, output_dir, base_params, specs, stop_on_error=False, skip_complete=False):
+def run(tasks_dir, output_dir, base_params, specs, stop_on_error=False, skip_complete=False, parse_workers=1):
     base_params_split = shlex.split(base_params)
     for spec in specs:
         print(colored("### Task {} ({}) ###".format(spec.task_name, spec.variant_name), "yellow"))
@@ -20,14 +20,14 @@ def run(tasks_dir, output_dir, base_params, specs, stop_on_error=False, skip_com
         if not os.path.isdir(task_folder_train):
             print(colored("Train directory doesn't exist. Parsing text file...", attrs=["dark"]))
             textfile = task_folder_train + ".txt"
-            subprocess.run(["python3","ggtnn_graph_parse.py",textfile], check=True)
+            subprocess.run(["python3","ggtnn_graph_parse.py",textfile,"--workers",str(parse_workers)], check=True)
 
         task_folder_valid = os.path.join(tasks_dir, "{}_valid".format(spec.task_name))
         if not os.path.isdir(task_folder_valid):
             print(colored("Validation directory doesn't exist. Parsing text file...", attrs=["dark"]))
             textfile = task_folder_valid + ".txt"
             try:
-                subprocess.run(["python3","ggtnn_graph_parse.py",textfile,"--metadata-file",os.path.join(task_folder_train,"metadata.p")], check=True)
+                subprocess.run(["python3","ggtnn_graph_parse.py",textfile,"--metadata-file",os.path.join(task_folder_train,"metadata.p"),"--workers",str(parse_workers)], check=True)
             except subprocess.CalledProcessError:
                 print(colored("Could not parse validation set! Skipping. You may need to regenerate the training set.","magenta"))
                 continue
@@ -51,7 +51,7 @@ def run(tasks_dir, output_dir, base_params, specs, stop_on_error=False, skip_com
         all_params.extend(["--validation", task_folder_valid])
         all_params.extend(["--set-exit-status"])
         all_params.extend(["--resume-auto"])
-        all_params.extend(["--autopickle", os.path.join(output_dir, "model_cache")])
+        all_params.extend(["--function-cache", os.path.join(output_dir, "function_cache")])
         print("Running command: " + " ".join(all_params))
         with open(stdout_fn, 'a', 1) as stdout_file:
             proc = subprocess.Popen(all_params, bufsize=1, universal_newlines=True, stdout=stdout_file, stderr=subprocess.STDOUT)
@@ -0,0 +1,220 @@
+import os
+import sys
+import pickle
+import hashlib
+import argparse
+import collections
+import numpy as np
+
+import inference_server
+from byte_lru_cache import ByteLRUCache
+from ggtnn_graph_parse import MetadataList
+
+STREAMING_FUNCTIONS = ["snap_step_fn", "snap_query_fn", "fuzzy_step_fn", "fuzzy_query_fn"]
+
+def prune_dead_nodes(graph_state):
+    """
+    Remove the nodes with zero strength in every story of a snapped graph state. Snapping
+    leaves a zero-strength node for each proposed node that was not added, and these have
+    no effect on the rest of the graph, so without this the state would grow by
+    new_nodes_per_iter nodes every sentence. At least one node is always kept.
+    """
+    node_strengths, node_ids, node_states, edge_strengths = graph_state
+    keep = np.any(node_strengths != 0, axis=0)
+    if not np.any(keep):
+        keep[0] = True
+    return [node_strengths[:,keep], node_ids[:,keep], node_states[:,keep], edge_strengths[:,keep][:,:,keep]]
+
+class StorySession( object ):
+    """
+    A story that is read one sentence at a time, and can be queried after any sentence.
+    Only the graph state after the latest sentence is kept, so each new sentence is
+    processed on its own, instead of running the whole story again from an empty graph
+    for every query. When snapping, nodes that were not added are removed after each
+    sentence, so the state (and the cost of a sentence) grows with the number of nodes
+    in the graph, not with the number of sentences read. The model can be a model.Model
+    or a numpy_inference.NumpyModel.
+    """
+    def __init__(self, m, snap=True, graph_state=None, num_sentences=0):
+        """
+        Params:
+            m: The model, with its step and query functions
+            snap: Whether to snap the graph after each sentence, and the answers, as snap_test does
+            graph_state: Graph state to resume from, with a batch size of 1. Defaults to an empty story
+            num_sentences: Number of sentences already read into graph_state
+        """
+        self.m = m
+        self.snap = snap
+        self.graph_state = m.initial_graph_state(1) if graph_state is None else graph_state
+        self.num_sentences = num_sentences
+
+    def add_sentence(self, sentence_words):
+        """
+        Read the next sentence of the story
+
+        Params:
+            sentence_words: Word indices of shape (sentence_len,)
+        """
+        self.graph_state = self.m.step(np.array([sentence_words], np.int32), self.graph_state, self.snap)
+        if self.snap:
+            self.graph_state = prune_dead_nodes(self.graph_state)
+        self.num_sentences += 1
+
+    def ask(self, query_words, max_seq_len=None):
+        """
+        Answer a query about the story so far
+
+        Params:
+            query_words: Word indices of shape (query_len,)
+            max_seq_len: Number of words to output, for the sequence output format
+
+        Returns: The output for the query, of shape (?, num_output_words)
+        """
+        return self.m.query(np.array([query_words], np.int32), self.graph_state, self.snap, max_seq_len)[0]
+
+    def save(self, file):
+        """
+        Save the state of the session (but not the model) to a file or path, as a .npz archive
+        """
+        node_strengths, node_ids, node_states, edge_strengths = self.graph_state
+        np.savez_compressed(file, node_strengths=node_strengths, node_ids=node_ids, node_states=node_states,
+                            edge_strengths=edge_strengths, snap=self.snap, num_sentences=self.num_sentences)
+
+    @classmethod
+    def load(cls, m, file):
+        """
+        Resume a session saved by save, using the model m
+        """
+        with np.load(file) as saved:
+            graph_state = [saved[k] for k in ("node_strengths", "node_ids", "node_states", "edge_strengths")]
+            return cls(m, bool(saved["snap"]), graph_state, int(saved["num_sentences"]))
+
+def prefix_keys(sentences):
+    """
+    Get a key for each prefix of a story, from a hash of the word indices of its sentences.
+    Each key extends the hash of the prefix before it, so all of them take a single pass.
+
+    Params:
+        sentences: Word indices of shape (n_sentences, sentence_len)
+
+    Returns: List of n_sentences keys, the first for the story's first sentence alone
+    """
+    keys = []
+    h = hashlib.sha1()
+    for sentence in sentences:
+        h.update(np.asarray(sentence, np.int32).tobytes())
+        keys.append(h.hexdigest())
+    return keys
+
+class PrefixCache( object ):
+    """
+    Caches the graph state after each prefix of the stories it runs, so that a story
+    starting with the same sentences as an earlier one (such as the same rules, followed
+    by a different input) only has to run the sentences after the longest cached prefix.
+    Entries are evicted least recently used first, to stay under a memory budget.
+    """
+    def __init__(self, m, max_bytes, snap=True):
+        """
+        Params:
+            m: The model, with its step and query functions
+            max_bytes: Memory budget for the cached graph states
+            snap: Whether to snap the graph after each sentence, as in StorySession
+        """
+        self.m = m
+        self.snap = snap
+        self._cache = ByteLRUCache(max_bytes)
+        self.lookups = 0
+        self.hits = 0
+        self.steps_run = 0
+        self.steps_saved = 0
+
+    def start(self, sentences):
+        """
+        Read a story into a new session, resuming from the longest prefix of it in the
+        cache, and caching the graph state after each sentence that has to be run
+
+        Params:
+            sentences: Word indices of shape (n_sentences, sentence_len)
+
+        Returns: A StorySession that has read the sentences
+        """
+        keys = prefix_keys(sentences)
+        self.lookups += 1
+        session = StorySession(self.m, self.snap)
+        for n in range(len(keys), 0, -1):
+            graph_state = self._cache.get(keys[n-1])
+            if graph_state is not None:
+                session = StorySession(self.m, self.snap, graph_state, n)
+                self.hits += 1
+                self.steps_saved += n
+                break
+        for key, sentence in zip(keys[session.num_sentences:], sentences[session.num_sentences:]):
+            session.add_sentence(sentence)
+            self._cache.put(key, session.graph_state)
+            self.steps_run += 1
+        return session
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        """
+        Get a dict of statistics: how many stories were found to start with a cached prefix,
+        and how many sentences were run or skipped
+        """
+        total_steps = self.steps_run + self.steps_saved
+        stats = collections.OrderedDict([
+            ("prefix_lookups", self.lookups),
+            ("prefix_hits", self.hits),
+            ("prefix_hit_rate", self.hits/self.lookups if self.lookups > 0 else 0.0),
+            ("steps_run", self.steps_run),
+            ("steps_saved", self.steps_saved),
+            ("saved_step_fraction", self.steps_saved/total_steps if total_steps > 0 else 0.0),
+        ])
+        # The underlying cache counts a miss for every shorter prefix that is tried
+        stats.update((k, v) for k, v in self._cache.stats().items() if k not in ("cache_hits", "cache_misses", "cache_hit_rate"))
+        return stats
+
+def main(outputdir, task_dir, backend, paramfile, function_cache_dir, fuzzy, max_answer_length, session_file):
+    with open(os.path.join(task_dir,'metadata.p'),'rb') as f:
+        metadata = pickle.load(f)
+    m = inference_server.load_model(outputdir, paramfile, backend, function_cache_dir, STREAMING_FUNCTIONS)
+    output_format = getattr(m.output_format, "name", m.output_format)
+    encoder = inference_server.StoryEncoder(metadata, output_format)
+    if session_file is not None and os.path.isfile(session_file):
+        session = StorySession.load(m, session_file)
+        print("Resumed story with {} sentences".format(session.num_sentences))
+    else:
+        session = StorySession(m, snap=not fuzzy)
+
+    print("Enter the sentences of the story, one per line. Lines ending with '?' are queries.")
+    for line in sys.stdin:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            words = encoder.encode_sentence(line)
+        except ValueError as e:
+            print(e)
+            continue
+        if line.endswith("?"):
+            output = session.ask(words, max_answer_length + 1)
+            print(" ".join(encoder.decode_answer(output)))
+        else:
+            session.add_sentence(words)
+    if session_file is not None:
+        session.save(session_file)
+
+parser = argparse.ArgumentParser(description='Read a story from standard input one sentence at a time, answering queries as they come.')
+parser.add_argument('outputdir', help="Output directory of the training run, with model_kwargs.json and params files")
+parser.add_argument('task_dir', help="Parsed directory of the dataset the model was trained on, for its metadata")
+parser.add_argument('--backend', choices=["theano", "numpy"], default="theano", help="Run the model with Theano, or with numpy_inference")
+parser.add_argument('--params', dest="paramfile", default=None, help="Params file to load. Defaults to the latest one in outputdir")
+parser.add_argument('--function-cache', dest="function_cache_dir", default=None, help="Directory of compiled functions to reuse, as in main.py")
+parser.add_argument('--fuzzy', action="store_true", help="Don't snap the graph to the most likely nodes and edges after each sentence")
+parser.add_argument('--max-answer-length', type=int, default=5, help="Number of words to generate, for the sequence output format")
+parser.add_argument('--session', dest="session_file", default=None, help="Resume the story saved in this file (if it exists), and save it there at the end")
+
+if __name__ == '__main__':
+    args = vars(parser.parse_args())
+    main(**args)
@@ -45,16 +45,14 @@ class EdgeStateUpdateTransformation( object ):
             append_masks = True
 
         # gstate.edge_states is of shape (n_batch, n_nodes, n_nodes, id+state)
-        # combined input should be broadcasted to (n_batch, n_nodes, n_nodes, X)
+        # combined input is conceptually broadcasted to (n_batch, n_nodes, n_nodes, X)
+        # but the first layer is applied to each part separately, once per batch for the input
+        # vector and once per node for the source and dest, and the results are broadcast-added
         input_vector_part = T.shape_padaxis(T.shape_padaxis(input_vector, 1), 2)
         source_state_part = T.shape_padaxis(T.concatenate([gstate.node_ids, gstate.node_states], 2), 2)
         dest_state_part = T.shape_padaxis(T.concatenate([gstate.node_ids, gstate.node_states], 2), 1)
-        full_input = broadcast_concat([input_vector_part, source_state_part, dest_state_part], 3)
-
-        # we flatten to process updates
-        flat_input = full_input.reshape([-1, self._process_input_size])
-        flat_result, dropout_masks = self._update_stack.process(flat_input, dropout_masks)
-        result = flat_result.reshape([gstate.n_batch, gstate.n_nodes, gstate.n_nodes, self._graph_spec.num_edge_types, 2])
+        result, dropout_masks = self._update_stack.process_split_input([input_vector_part, source_state_part, dest_state_part], dropout_masks)
+        result = result.reshape([gstate.n_batch, gstate.n_nodes, gstate.n_nodes, self._graph_spec.num_edge_types, 2])
         should_set = result[:,:,:,:,0]
         should_clear = result[:,:,:,:,1]
 
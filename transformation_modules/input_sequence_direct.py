@@ -20,9 +20,10 @@ class InputSequenceDirectTransformation( object ):
         self._word_node_mapping = word_node_mapping
         self._output_width = output_width
 
-        self._word_node_matrix = np.zeros([num_words, num_node_ids], np.float32)
+        # Index of the node each word refers to, or num_node_ids for words that don't refer to a node
+        self._word_node_index = np.full([num_words], num_node_ids, np.int64)
         for word,node in word_node_mapping.items():
-            self._word_node_matrix[word,node] = 1.0
+            self._word_node_index[word] = node
 
         self._gru = BaseGRULayer(num_words, output_width, name="input_sequence")
 
@@ -43,29 +44,27 @@ class InputSequenceDirectTransformation( object ):
         """
         n_batch, input_len = inputs.shape
         valseq = inputs.dimshuffle([1,0])
-        one_hot_vals = T.extra_ops.to_one_hot(inputs.flatten(), self._num_words)\
-                    .reshape([n_batch, input_len, self._num_words])
-        one_hot_valseq = one_hot_vals.dimshuffle([1,0,2])
 
-        def scan_fn(idx_ipt, onehot_ipt, last_accum, last_state):
-            # last_accum stores accumulated outputs per word type
-            # and is of shape (n_batch, word_idx, output_width)
-            gru_state = self._gru.step(onehot_ipt, last_state)
-            new_accum = T.inc_subtensor(last_accum[T.arange(n_batch), idx_ipt, :], gru_state)
-            return new_accum, gru_state
+        # Multiplying a one-hot input by the GRU weights just picks out a row, so look the rows up directly
+        projected_valseq = self._gru.project_input_indices(valseq)
+
+        def scan_fn(projected_ipt, last_state):
+            return self._gru.step_projected(projected_ipt, last_state)
+
+        outputs_info = [self._gru.initial_state(n_batch)]
+        all_out, _ = theano.scan(scan_fn, sequences=[projected_valseq], outputs_info=outputs_info)
 
-        outputs_info = [T.zeros([n_batch, self._num_words, self._output_width]), self._gru.initial_state(n_batch)]
-        (all_accum, all_out), _ = theano.scan(scan_fn, sequences=[valseq, one_hot_valseq], outputs_info=outputs_info)
-        
         # all_out is of shape (input_len, n_batch, self.output_width). We want last timestep
         repr_vect = all_out[-1,:,:]
 
-        final_accum = all_accum[-1,:,:,:]
-        # Now we also want to extract and accumulate the outputs that directly map to each word
-        # We can do this by multipying the final accum's second dimension (word_idx) through by
-        # the word_node_matrix
-        resh_flat_final_accum = final_accum.dimshuffle([0,2,1]).reshape([-1, self._num_words])
-        resh_flat_node_mat = T.dot(resh_flat_final_accum, self._word_node_matrix)
-        node_vects = resh_flat_node_mat.reshape([n_batch, self._output_width, self._num_node_ids]).dimshuffle([0,2,1])
+        # Now we also want to accumulate the outputs at each word that directly maps to a node.
+        # We add each output into a (n_batch, num_node_ids+1, output_width) buffer at the node for
+        # its word, with words that don't map to a node going into the extra slot, which is dropped.
+        node_idxs = T.constant(self._word_node_index)[valseq]
+        num_slots = self._num_node_ids + 1
+        flat_slot_idxs = (T.shape_padleft(T.arange(n_batch)) * num_slots + node_idxs).flatten()
+        flat_out = all_out.reshape([-1, self._output_width])
+        flat_accum = T.inc_subtensor(T.zeros([n_batch * num_slots, self._output_width])[flat_slot_idxs], flat_out)
+        node_vects = flat_accum.reshape([n_batch, num_slots, self._output_width])[:,:self._num_node_ids,:]
 
         return repr_vect, node_vects
@@ -78,8 +78,10 @@ class NewNodesInformTransformation( object ):
 
         outputs_info = [self._proposer_gru.initial_state(n_batch)]
         gru_dropout_masks, dropout_masks = self._proposer_gru.split_dropout_masks(dropout_masks)
-        proposer_step = lambda st,ipt,*dm: self._proposer_gru.step(ipt, st, dm if dropout_masks is not None else None)[0]
-        raw_proposal_acts, _ = theano.scan(proposer_step, n_steps=max_candidates, non_sequences=[full_input]+gru_dropout_masks, outputs_info=outputs_info)
+        # The input is the same for every candidate, so only project it once
+        projected_input, gru_dropout_masks = self._proposer_gru.project_input(full_input, gru_dropout_masks)
+        proposer_step = lambda st,proj_ipt,*dm: self._proposer_gru.step_projected(proj_ipt, st, dm if dropout_masks is not None else None)[0]
+        raw_proposal_acts, _ = theano.scan(proposer_step, n_steps=max_candidates, non_sequences=[projected_input]+list(gru_dropout_masks), outputs_info=outputs_info)
 
         # raw_proposal_acts is of shape (candidate, n_batch, blah)
         flat_raw_acts = raw_proposal_acts.reshape([-1, self._proposal_width])
@@ -36,8 +36,10 @@ class OutputSequenceTransformation( object ):
         """
         n_batch = input_vector.shape[0]
         outputs_info = [self._seq_gru.initial_state(n_batch)]
-        scan_step = lambda state, ipt: self._seq_gru.step(ipt, state)
-        all_out, _ = theano.scan(scan_step, non_sequences=[input_vector], n_steps=seq_len, outputs_info=outputs_info)
+        # The input is the same at every step, so only project it once
+        projected_input = self._seq_gru.project_input(input_vector)
+        scan_step = lambda state, proj_ipt: self._seq_gru.step_projected(proj_ipt, state)
+        all_out, _ = theano.scan(scan_step, non_sequences=[projected_input], n_steps=seq_len, outputs_info=outputs_info)
 
         # all_out is of shape (seq_len, n_batch, state_size). Squash and apply layer
         flat_out = all_out.reshape([-1, self._state_size])
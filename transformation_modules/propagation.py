@@ -62,14 +62,22 @@ class PropagationTransformation( object ):
         scaled_transformed = transformed * T.shape_padright(T.shape_padright(gstate.node_strengths))
         # scaled_transformed is of shape (n_batch, n_nodes, 2*num_edge_types, transfer_size)
         # We want to multiply  through by edge strengths, which are of shape
-        # (n_batch, n_nodes, n_nodes, num_edge_types), both fwd and backward
-        edge_strength_scale = T.concatenate([gstate.edge_strengths, gstate.edge_strengths.swapaxes(1,2)], 3)
-        # edge_strength_scale is of (n_batch, n_nodes, n_nodes, 2*num_edge_types)
-        intermed = T.shape_padaxis(scaled_transformed, 2) * T.shape_padright(edge_strength_scale)
-        # intermed is of shape (n_batch, n_nodes "source", n_nodes "dest", 2*num_edge_types, transfer_size)
-        # now reduce along the "source" and "edge_types" dimensions to get dest activations
-        # of shape (n_batch, n_nodes, transfer_size)
-        reduced_result = T.sum(T.sum(intermed, 3), 1)
+        # (n_batch, n_nodes, n_nodes, num_edge_types), both fwd and backward, and then
+        # sum along the "source" and "edge_types" dimensions to get dest activations
+        # of shape (n_batch, n_nodes, transfer_size).
+        # Rather than building the (n_batch, source, dest, 2*num_edge_types, transfer_size)
+        # product and summing it, we flatten source and edge type together and contract
+        # them with a batched matrix product, once for each edge direction.
+        num_edge_types = self._graph_spec.num_edge_types
+        flat_edge_shape = [gstate.n_batch, gstate.n_nodes, gstate.n_nodes*num_edge_types]
+        flat_transfer_shape = [gstate.n_batch, gstate.n_nodes*num_edge_types, self._transfer_size]
+        # Forward: dest receives from source along edge_strengths[:,source,dest,:]
+        fwd_edges = gstate.edge_strengths.dimshuffle(0,2,1,3).reshape(flat_edge_shape)
+        fwd_transfer = scaled_transformed[:,:,:num_edge_types,:].reshape(flat_transfer_shape)
+        # Backward: dest receives from source along edge_strengths[:,dest,source,:]
+        bwd_edges = gstate.edge_strengths.reshape(flat_edge_shape)
+        bwd_transfer = scaled_transformed[:,:,num_edge_types:,:].reshape(flat_transfer_shape)
+        reduced_result = T.batched_dot(fwd_edges, fwd_transfer) + T.batched_dot(bwd_edges, bwd_transfer)
 
         # now add information fom current node id
         full_input = T.concatenate([gstate.node_ids, reduced_result], 2)
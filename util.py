@@ -113,6 +113,31 @@ def reduce_log_sum(tensor, axis=None, guaranteed_finite=False):
     logsum = maxval + T.log(reduced_sum)
     return logsum
 
+def unrolled_scan(fn, sequences, outputs_info, non_sequences, n_steps):
+    """
+    Like theano.scan, but unrolls the loop into n_steps copies of the step graph, which
+    avoids the per-step overhead of scan when the number of steps is small and known.
+    Each entry of outputs_info is either an initial value, for outputs that are fed back
+    into the next step, or None. Always returns a list of outputs, and an empty dict of updates.
+    """
+    state = [o for o in outputs_info if o is not None]
+    step_outputs = []
+    for t in range(n_steps):
+        retvals = fn(*([s[t] for s in sequences] + state + list(non_sequences)))
+        step_outputs.append(retvals)
+        state = [r for r,o in zip(retvals, outputs_info) if o is not None]
+    return [T.stack([step[i] for step in step_outputs]) for i in range(len(outputs_info))], {}
+
+def pad_axis(array, axis, size):
+    """
+    Pad a numpy array with zeros at the end of axis, up to size
+    """
+    if array.shape[axis] == size:
+        return array
+    padding = [(0,0)]*array.ndim
+    padding[axis] = (0, size - array.shape[axis])
+    return np.pad(array, padding, 'constant')
+
 def shape_padaxes(tensor, axes):
     for axis in axes:
         tensor = T.shape_padaxis(tensor, axis)
@@ -144,6 +169,62 @@ def categorical_best(tensor):
     snapped = flat_snapped.reshape(tensor.shape)
     return snapped
 
+def greedy_assignment(scores, n):
+    """
+    Greedily match rows to columns of a batch of square score matrices, by repeatedly
+    choosing the highest scoring pair whose row and column are both unmatched.
+    Takes n steps, each of cost O(n^2).
+
+    Params:
+        scores: Tensor of shape (n_batch, n, n)
+        n: Python integer giving the size of the score matrices
+
+    Returns: Tensor of shape (n_batch, n, n), with assignment[b,i,j] = 1 if row i
+        is matched with column j, else 0. No gradient flows through it.
+    """
+    n_batch = scores.shape[0]
+    assignment = T.zeros_like(scores)
+    available = T.ones_like(scores)
+    for _ in range(n):
+        masked_scores = T.switch(available, scores, -np.inf)
+        best_pair = T.argmax(masked_scores.reshape([n_batch, n*n]), 1)
+        row_onehot = T.cast(T.eq(T.shape_padright(best_pair // n), T.arange(n)), 'floatX')
+        col_onehot = T.cast(T.eq(T.shape_padright(best_pair % n), T.arange(n)), 'floatX')
+        assignment = assignment + T.shape_padright(row_onehot) * T.shape_padaxis(col_onehot, 1)
+        available = available * T.shape_padright(1-row_onehot) * T.shape_padaxis(1-col_onehot, 1)
+    return theano.gradient.disconnected_grad(assignment)
+
+def sorted_assignment(keys, n):
+    """
+    Match rows to columns such that row i is matched with the column with the i-th
+    smallest key.
+
+    Params:
+        keys: Tensor of shape (n_batch, n)
+        n: Python integer giving the number of keys
+
+    Returns: Tensor of shape (n_batch, n, n), as in greedy_assignment
+    """
+    order = T.argsort(keys, axis=1)
+    assignment = T.cast(T.eq(T.shape_padright(order), T.arange(n)), 'floatX')
+    return theano.gradient.disconnected_grad(assignment)
+
+def unique_rows(array):
+    """
+    Find the distinct rows of an array, along with where each row appears among them
+
+    Params:
+        array: Array of shape (..., row_len)
+
+    Returns: unique, index
+        unique: Array of shape (n_unique, row_len) of the distinct rows
+        index: Int32 array of shape (...), such that unique[index] == array
+    """
+    array = np.asarray(array)
+    flat_array = array.reshape([-1, array.shape[-1]])
+    unique, index = np.unique(flat_array, axis=0, return_inverse=True)
+    return unique, index.reshape(array.shape[:-1]).astype(np.int32)
+
 def make_dropout_mask(shape, keep_frac, srng):
     return T.shape_padleft(T.cast(srng.binomial(shape, p=keep_frac), 'float32') / keep_frac)
 